@@ -0,0 +1,9 @@
+import os
+from randomfile import create_app
+from randomfile.asgi import AsgiApp
+
+# Get configuration from the environment or use default
+config_name = os.environ.get('FLASK_CONFIG') or 'default'
+
+# Create the application, served by an ASGI server such as uvicorn
+app = AsgiApp(create_app(config_name))
@@ -0,0 +1,59 @@
+import argparse
+import json
+import sys
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+def _key(result: Dict[str, Any]) -> Tuple[str, str, int]:
+    return result['name'], result['shape'], result['files']
+
+def compare(baseline: Dict[str, Any], current: Dict[str, Any], threshold: float = 0.1) -> List[Dict[str, Any]]:
+    """
+    Compare two benchmark reports.
+
+    Args:
+        baseline (Dict[str, Any]): Report of the earlier run
+        current (Dict[str, Any]): Report of the later run
+        threshold (float): Relative slowdown of the median counted as a regression
+
+    Returns:
+        List[Dict[str, Any]]: For every benchmark that ran in both, the medians,
+            their ratio and whether it regressed
+    """
+    before = {_key(result): result for result in baseline['results'] if 'median' in result}
+    rows = []
+    for result in current['results']:
+        old = before.get(_key(result))
+        if old is None or 'median' not in result:
+            continue
+        ratio = result['median'] / old['median'] if old['median'] else float('inf')
+        rows.append({
+            'name': result['name'], 'shape': result['shape'], 'files': result['files'],
+            'before': old['median'], 'after': result['median'], 'ratio': ratio,
+            'regressed': ratio > 1 + threshold
+        })
+    return rows
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Compare two benchmark result files")
+    parser.add_argument('baseline', type=Path)
+    parser.add_argument('current', type=Path)
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help="Relative slowdown counted as a regression (default: 0.1)")
+    args = parser.parse_args(argv)
+
+    baseline = json.loads(args.baseline.read_text())
+    current = json.loads(args.current.read_text())
+    print(f"baseline {baseline['meta'].get('commit')}  current {current['meta'].get('commit')}")
+
+    rows = compare(baseline, current, args.threshold)
+    for row in rows:
+        flag = '  REGRESSED' if row['regressed'] else ''
+        print(f"{row['name']:45} {row['shape']:>8} {row['files']:>8}  "
+              f"{row['before'] * 1e6:12.1f} us -> {row['after'] * 1e6:12.1f} us  x{row['ratio']:.2f}{flag}")
+
+    # A non-zero exit lets CI fail on regressions
+    sys.exit(1 if any(row['regressed'] for row in rows) else 0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+import errno
+import json
+import math
+import os
+import random
+import shutil
+import subprocess
+from pathlib import Path
+from typing import Any, Dict, List, Tuple
+
+# Tree shapes: how the files are spread over directories
+SHAPES = ('balanced', 'deep', 'wide')
+
+# Silent MPEG-1 Layer III frame: 32 kbps, 32 kHz, mono. The zeroed side
+# information makes every granule empty, so decoders output silence.
+_MP3_FRAME = bytes([0xFF, 0xFB, 0x18, 0xC4]) + bytes(140)
+
+# The sample file shipped with the repo, used for OGG when ffmpeg is missing
+_SAMPLE_OGG = Path(__file__).resolve().parent.parent / 'data' / 'Attack_From_Mars' / 'voice' / \
+    '2082754476-nothing_can_defeat_us' / 'nothing___LEGACY.ogg'
+
+# Words file names are made of, so prefix filters and searches have something to match
+_WORDS = ('alpha', 'bravo', 'charlie', 'delta', 'echo', 'foxtrot', 'golf', 'hotel', 'india', 'juliet',
+          'kilo', 'lima', 'mars', 'november', 'oscar', 'papa', 'quebec', 'romeo', 'sierra', 'tango')
+
+# Written to a generated library so it can be reused when the same one is asked for again
+_MANIFEST = '.benchmark-library.json'
+
+def write_mp3(path: Path, size: int) -> None:
+    """
+    Write a silent MP3 file.
+
+    Args:
+        path (Path): The file to write
+        size (int): Approximate size in bytes, rounded down to whole frames
+    """
+    path.write_bytes(_MP3_FRAME * max(1, size // len(_MP3_FRAME)))
+
+def write_fixtures(directory: Path) -> Dict[str, Path]:
+    """
+    Create tiny silent audio files to populate libraries with.
+
+    MP3 frames are written directly. OGG needs an encoder, so it is made with
+    ffmpeg where available and copied from the repo's sample file otherwise.
+
+    Args:
+        directory (Path): Where to write the fixtures
+
+    Returns:
+        Dict[str, Path]: Fixture by extension ('.mp3', '.ogg')
+    """
+    directory.mkdir(parents=True, exist_ok=True)
+    fixtures = {'.mp3': directory / 'silence.mp3', '.ogg': directory / 'silence.ogg'}
+
+    # 28 frames, about one second
+    write_mp3(fixtures['.mp3'], 28 * len(_MP3_FRAME))
+
+    if not fixtures['.ogg'].exists():
+        try:
+            subprocess.run(
+                ['ffmpeg', '-y', '-loglevel', 'error', '-f', 'lavfi', '-i', 'anullsrc=r=8000:cl=mono',
+                 '-t', '1', '-c:a', 'libvorbis', str(fixtures['.ogg'])],
+                check=True, capture_output=True, timeout=60
+            )
+        except (OSError, subprocess.SubprocessError):
+            shutil.copyfile(_SAMPLE_OGG, fixtures['.ogg'])
+    return fixtures
+
+def _layout(files: int, shape: str) -> Tuple[int, int]:
+    """Pick the depth and fanout of the leaf directories for a shape."""
+    if shape == 'wide':
+        # A single level of directories holding about 1,000 files each
+        return 1, max(1, math.ceil(files / 1000))
+    if shape == 'deep':
+        # A binary tree with about 10 files per leaf, at most 16 levels deep
+        return max(1, min(16, math.ceil(math.log2(max(2, files / 10))))), 2
+    # Ten subdirectories per directory with about 100 files per leaf
+    return max(1, math.ceil(math.log10(max(10, files / 100)))), 10
+
+def _leaf_directories(depth: int, fanout: int) -> List[str]:
+    """List the leaf directories of a tree as relative paths."""
+    leaves = ['']
+    for level in range(depth):
+        leaves = [f"{parent}/d{level}_{i:02d}" if parent else f"d{level}_{i:02d}"
+                  for parent in leaves for i in range(fanout)]
+    return leaves
+
+def generate_library(root: Path, files: int, shape: str = 'balanced', formats: Tuple[str, ...] = ('.mp3',),
+                     seed: int = 0, link: bool = True) -> Dict[str, Any]:
+    """
+    Generate a synthetic audio library, or reuse one generated with the same parameters.
+
+    Files are spread evenly over the leaf directories of a tree whose shape
+    is one of SHAPES. They are hard links to a few silent fixtures unless
+    ``link`` is false, so even a million files take little disk space.
+
+    Args:
+        root (Path): Directory to create the library in
+        files (int): Number of audio files
+        shape (str): One of SHAPES
+        formats (Tuple[str, ...]): Extensions of the files, used in turn
+        seed (int): Seed for the file names
+        link (bool): Hard link files to the fixtures instead of copying them
+
+    Returns:
+        Dict[str, Any]: Parameters of the library with its number of leaf
+            directories and one of the deepest
+    """
+    if shape not in SHAPES:
+        raise ValueError(f"Unknown shape: {shape}")
+
+    params = {'files': files, 'shape': shape, 'formats': list(formats), 'seed': seed, 'link': link}
+    manifest_path = root / _MANIFEST
+    if manifest_path.exists():
+        manifest = json.loads(manifest_path.read_text())
+        if {key: manifest.get(key) for key in params} == params:
+            return manifest
+    if root.exists():
+        shutil.rmtree(root)
+
+    fixtures = write_fixtures(root.parent / f"{root.name}-fixtures")
+    depth, fanout = _layout(files, shape)
+    leaves = _leaf_directories(depth, fanout)
+    rng = random.Random(seed)
+
+    for rel_dir in leaves:
+        (root / rel_dir).mkdir(parents=True, exist_ok=True)
+    sources = dict(fixtures)
+    for i in range(files):
+        extension = formats[i % len(formats)]
+        name = f"{rng.choice(_WORDS)}_{rng.choice(_WORDS)}_{i:07d}{extension}"
+        path = root / leaves[i % len(leaves)] / name
+        if not link:
+            shutil.copyfile(fixtures[extension], path)
+            continue
+        try:
+            os.link(sources[extension], path)
+        except OSError as e:
+            if e.errno != errno.EMLINK:
+                raise
+            # Filesystems cap the links per file (65,000 on ext4), so continue from a fresh copy
+            sources[extension] = fixtures[extension].with_name(f"silence-{i}{extension}")
+            shutil.copyfile(fixtures[extension], sources[extension])
+            os.link(sources[extension], path)
+
+    manifest = dict(params, leaf_directories=len(leaves), deepest=leaves[-1])
+    manifest_path.write_text(json.dumps(manifest))
+    return manifest
@@ -0,0 +1,560 @@
+import argparse
+import datetime
+import http.client
+import json
+import math
+import os
+import platform
+import random
+import shutil
+import signal
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from collections import Counter, defaultdict
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from urllib.parse import quote, urlencode
+
+from benchmarks.library import SHAPES, generate_library, write_mp3
+from benchmarks.run import REPO_PATH, git_revision
+
+# Directory inside the library for files the load test creates, removed afterwards
+_LOAD_DIR = '_load'
+
+# Requests of each kind, relative to each other
+DEFAULT_MIX = {
+    'browse': 10,
+    'tree': 5,
+    'list': 10,
+    'search': 5,
+    'random_audio': 20,
+    'random_batch': 10,
+    'static_range': 25,
+    'download': 5,
+    'upload': 5,
+    'convert': 1
+}
+
+# Errors a kept-alive connection raises when the server closed it in the meantime
+_STALE_CONNECTION = (http.client.RemoteDisconnected, BrokenPipeError, ConnectionResetError)
+
+# Bytes read from a response at a time
+_READ_SIZE = 64 * 1024
+
+class Client:
+    """
+    A keep-alive HTTP connection that times and records every request it sends.
+
+    Each load thread has its own client, so recording needs no locking. A
+    connection the server closed (sync workers close every one) is reopened
+    transparently; the latency of a request includes connecting.
+    """
+
+    def __init__(self, host: str, port: int, timeout: float, record_after: float, client_kbps: int = 0):
+        """
+        Args:
+            host (str): Server address
+            port (int): Server port
+            timeout (float): Seconds to wait for the server
+            record_after (float): perf_counter time before which requests are not recorded (warmup)
+            client_kbps (int): Read downloads at most this fast, like a slow client (0 for no limit)
+        """
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.record_after = record_after
+        self.client_kbps = client_kbps
+        self.conn: Optional[http.client.HTTPConnection] = None
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.statuses: Dict[str, Counter] = defaultdict(Counter)
+        self.bytes: Counter = Counter()
+
+    def close(self) -> None:
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def _send(self, method: str, path: str, body: Optional[bytes], headers: Dict[str, str],
+              throttle: bool) -> Tuple[int, Dict[str, str], bytes, int]:
+        if self.conn is None:
+            self.conn = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+        self.conn.request(method, path, body=body, headers=headers)
+        response = self.conn.getresponse()
+
+        data = b''
+        received = 0
+        started = time.perf_counter()
+        while True:
+            chunk = response.read(_READ_SIZE)
+            if not chunk:
+                break
+            received += len(chunk)
+            if not throttle:
+                data += chunk
+            elif self.client_kbps:
+                # Sleep until the bytes so far would have arrived at the client's rate
+                delay = started + received / (self.client_kbps * 1024) - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+
+        if response.will_close:
+            self.close()
+        return response.status, dict(response.getheaders()), data, received
+
+    def request(self, route: str, method: str, path: str, body: Optional[bytes] = None,
+                headers: Optional[Dict[str, str]] = None, throttle: bool = False) -> Tuple[int, Dict[str, str], bytes]:
+        """
+        Send a request, read the whole response and record it under a route.
+
+        Args:
+            route (str): Name the request is reported under
+            method (str): HTTP method
+            path (str): Path and query string
+            body (Optional[bytes]): Request body
+            headers (Optional[Dict[str, str]]): Request headers
+            throttle (bool): Read the response at the client rate and discard it instead of returning it
+
+        Returns:
+            Tuple[int, Dict[str, str], bytes]: Status (0 if the request failed), headers and body
+        """
+        headers = headers or {}
+        reused = self.conn is not None
+        start = time.perf_counter()
+        try:
+            try:
+                status, response_headers, data, received = self._send(method, path, body, headers, throttle)
+            except _STALE_CONNECTION:
+                if not reused:
+                    raise
+                # The server closed the idle connection, so send the request again on a new one
+                self.close()
+                start = time.perf_counter()
+                status, response_headers, data, received = self._send(method, path, body, headers, throttle)
+        except (OSError, http.client.HTTPException):
+            self.close()
+            status, response_headers, data, received = 0, {}, b'', 0
+
+        if start >= self.record_after:
+            self.latencies[route].append(time.perf_counter() - start)
+            self.statuses[route][status] += 1
+            self.bytes[route] += received
+        return status, response_headers, data
+
+class Workload:
+    """
+    The paths a load test requests and the requests it sends, one method per entry of DEFAULT_MIX.
+    """
+
+    def __init__(self, library: Path, files: List[str], directories: List[str], upload_bytes: int,
+                 chunk_bytes: int, ogg_fixture: Path):
+        """
+        Args:
+            library (Path): Root of the library the server serves
+            files (List[str]): Files to request, relative to the library root
+            directories (List[str]): Directories to browse, relative to the library root
+            upload_bytes (int): Size of each uploaded file
+            chunk_bytes (int): Size of each chunk of an upload
+            ogg_fixture (Path): File copied into a fresh directory for each conversion
+        """
+        self.library = library
+        self.files = files
+        self.directories = directories
+        self.upload_bytes = upload_bytes
+        self.chunk_bytes = chunk_bytes
+        self.ogg_fixture = ogg_fixture
+
+    def browse(self, client: Client, rng: random.Random) -> None:
+        client.request('browse', 'GET', f"/browse/{quote(rng.choice(self.directories))}")
+
+    def tree(self, client: Client, rng: random.Random) -> None:
+        client.request('tree', 'GET', f"/api/tree/{quote(rng.choice(self.directories))}")
+
+    def list(self, client: Client, rng: random.Random) -> None:
+        client.request('list', 'GET', f"/api/list/{quote(rng.choice(self.directories))}?limit=100")
+
+    def search(self, client: Client, rng: random.Random) -> None:
+        term = rng.choice(self.files).rsplit('/', 1)[-1].split('_')[0]
+        client.request('search', 'GET', f"/search?{urlencode({'q': term})}")
+
+    def random_audio(self, client: Client, rng: random.Random) -> None:
+        directory = rng.choice(self.directories)
+        client.request('random_audio', 'GET', f"/audio/{quote(directory)}" if directory else '/audio', throttle=True)
+
+    def random_batch(self, client: Client, rng: random.Random) -> None:
+        client.request('random_batch', 'GET', "/api/random?count=10")
+
+    def static_range(self, client: Client, rng: random.Random) -> None:
+        # Seeking: a kilobyte from the start or the middle of the file
+        start = rng.choice((0, 1024, 2048))
+        client.request('static_range', 'GET', f"/audio/{quote(rng.choice(self.files))}?static=true",
+                       headers={'Range': f"bytes={start}-{start + 1023}"}, throttle=True)
+
+    def download(self, client: Client, rng: random.Random) -> None:
+        client.request('download', 'GET', f"/audio/{_LOAD_DIR}/large.mp3?static=true", throttle=True)
+
+    def upload(self, client: Client, rng: random.Random) -> None:
+        data = rng.randbytes(self.upload_bytes)
+        start = {'directory': f"{_LOAD_DIR}/uploads", 'filename': f"load-{uuid.uuid4().hex}.mp3", 'size': len(data)}
+        status, _, body = client.request('upload.start', 'POST', '/upload', json.dumps(start).encode(),
+                                         {'Content-Type': 'application/json'})
+        if status != 201:
+            return
+        upload_id = json.loads(body)['id']
+        for offset in range(0, len(data), self.chunk_bytes):
+            chunk = data[offset:offset + self.chunk_bytes]
+            status, _, _ = client.request('upload.chunk', 'PUT', f"/upload/{upload_id}", chunk,
+                                          {'Upload-Offset': str(offset), 'Content-Type': 'application/octet-stream'})
+            if status not in (200, 201):
+                return
+
+    def convert(self, client: Client, rng: random.Random) -> None:
+        # Conversion replaces the originals, so each job gets a copy of its own
+        directory = f"{_LOAD_DIR}/convert/{uuid.uuid4().hex}"
+        (self.library / directory).mkdir(parents=True)
+        shutil.copyfile(self.ogg_fixture, self.library / directory / 'silence.ogg')
+        client.request('convert', 'POST', '/convert', json.dumps({'directory': directory}).encode(),
+                       {'Content-Type': 'application/json'})
+
+def sample_library(library: Path, limit: int, rng: random.Random) -> Tuple[List[str], List[str]]:
+    """
+    Pick files and directories of a library to request.
+
+    Args:
+        library (Path): Root of the library
+        limit (int): Most files to pick, chosen uniformly
+        rng (random.Random): Random source
+
+    Returns:
+        Tuple[List[str], List[str]]: Files and all directories, relative to the library root
+    """
+    files: List[str] = []
+    directories = ['']
+    seen = 0
+    for root, dirnames, filenames in os.walk(library):
+        dirnames[:] = sorted(name for name in dirnames if not name.startswith('.') and name != _LOAD_DIR)
+        rel_root = os.path.relpath(root, library)
+        if rel_root != '.':
+            directories.append(rel_root)
+        for name in filenames:
+            if name.startswith('.'):
+                continue
+            rel_path = name if rel_root == '.' else f"{rel_root}/{name}"
+            # Reservoir sampling keeps memory flat on a million files
+            seen += 1
+            if len(files) < limit:
+                files.append(rel_path)
+            elif (slot := rng.randrange(seen)) < limit:
+                files[slot] = rel_path
+    return files, directories
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def start_server(library: Path, state: Path, port: int, workers: int, worker_class: str, threads: int,
+                 extra_args: List[str], env: Dict[str, str], app: str = 'app:app') -> subprocess.Popen:
+    """
+    Start the app under gunicorn with its library and state in the given directories.
+
+    Rate limits and CSRF checks are turned off, since every request comes
+    from the same address and without a session.
+
+    Args:
+        library (Path): Library to serve
+        state (Path): Directory for the app state and the server log
+        port (int): Port to listen on at 127.0.0.1
+        workers (int): Worker processes
+        worker_class (str): Gunicorn worker class (sync, gthread, ...)
+        threads (int): Threads per worker
+        extra_args (List[str]): Further gunicorn arguments
+        env (Dict[str, str]): Further environment of the app, e.g. configuration overrides
+        app (str): The application to serve, 'app:app' (WSGI) or 'asgi:app' with an ASGI worker class
+
+    Returns:
+        subprocess.Popen: The gunicorn master process
+    """
+    command = [
+        sys.executable, '-m', 'gunicorn',
+        '--workers', str(workers), '--worker-class', worker_class, '--threads', str(threads),
+        '--bind', f"127.0.0.1:{port}", '--pythonpath', str(REPO_PATH), '--timeout', '120',
+        *extra_args, app
+    ]
+    server_env = dict(os.environ, FLASK_CONFIG='production', BASE_PATH=str(library), STATE_PATH=str(state),
+                      RATELIMIT_ENABLED='false', WTF_CSRF_ENABLED='false', **env)
+    log = open(state / 'gunicorn.log', 'wb')
+    try:
+        # The app logs to its working directory, so keep that out of the repo
+        return subprocess.Popen(command, cwd=state, env=server_env, stdout=log, stderr=subprocess.STDOUT)
+    finally:
+        log.close()
+
+def wait_until_ready(server: subprocess.Popen, port: int, timeout: float = 60) -> None:
+    """Wait until the server answers, or raise RuntimeError if it exits or takes too long."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f"gunicorn exited with status {server.returncode}")
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+            conn.request('GET', '/api/tree/')
+            if conn.getresponse().status == 200:
+                conn.close()
+                return
+            conn.close()
+        except (OSError, http.client.HTTPException):
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"gunicorn did not answer within {timeout:.0f}s")
+
+def stop_server(server: subprocess.Popen) -> None:
+    """Shut gunicorn down gracefully, or kill it if that takes too long."""
+    server.send_signal(signal.SIGTERM)
+    try:
+        server.wait(timeout=30)
+    except subprocess.TimeoutExpired:
+        server.kill()
+        server.wait()
+
+def percentile(values: List[float], fraction: float) -> float:
+    """The nearest-rank percentile of sorted values."""
+    return values[max(0, math.ceil(fraction * len(values)) - 1)]
+
+def summarize(route: str, latencies: List[float], statuses: Counter, received: int, seconds: float) -> Dict[str, Any]:
+    """
+    Summarize the requests to a route.
+
+    Failed requests (status 0) and error statuses count as errors but their
+    latencies are included, since a slow error is still a slow response.
+
+    Returns:
+        Dict[str, Any]: Requests, errors, statuses, throughput (per second),
+            bytes received and latency percentiles in seconds
+    """
+    latencies = sorted(latencies)
+    return {
+        'route': route,
+        'requests': len(latencies),
+        'errors': sum(count for status, count in statuses.items() if status == 0 or status >= 400),
+        'statuses': {str(status): count for status, count in sorted(statuses.items())},
+        'throughput': len(latencies) / seconds,
+        'bytes': received,
+        'mean': statistics.fmean(latencies),
+        'p50': percentile(latencies, 0.50),
+        'p95': percentile(latencies, 0.95),
+        'p99': percentile(latencies, 0.99),
+        'max': latencies[-1]
+    }
+
+def drive(port: int, workload: Workload, mix: Dict[str, int], concurrency: int, duration: float, warmup: float,
+          timeout: float, client_kbps: int, seed: int) -> Tuple[List[Client], float]:
+    """
+    Send mixed requests from concurrent clients until the time is up.
+
+    Each client picks the next kind of request at random with the weights of
+    the mix and sends it as soon as the previous one is answered (a closed
+    loop), so throughput is bounded by the server and the concurrency.
+
+    Args:
+        port (int): Server port at 127.0.0.1
+        workload (Workload): The requests
+        mix (Dict[str, int]): Weight of each kind of request
+        concurrency (int): Number of clients
+        duration (float): Seconds to record requests for
+        warmup (float): Seconds to send requests before recording them
+        timeout (float): Seconds a client waits for a response
+        client_kbps (int): Download rate of each client (0 for no limit)
+        seed (int): Seed of the clients' random choices
+
+    Returns:
+        Tuple[List[Client], float]: The clients with their recordings, and the seconds recorded
+    """
+    kinds: List[str] = list(mix)
+    weights = [mix[kind] for kind in kinds]
+    actions: Dict[str, Callable[[Client, random.Random], None]] = {kind: getattr(workload, kind) for kind in kinds}
+    record_after = time.perf_counter() + warmup
+    deadline = record_after + duration
+    clients = [Client('127.0.0.1', port, timeout, record_after, client_kbps) for _ in range(concurrency)]
+
+    def loop(client: Client, rng: random.Random) -> None:
+        try:
+            while time.perf_counter() < deadline:
+                actions[rng.choices(kinds, weights)[0]](client, rng)
+        finally:
+            client.close()
+
+    threads = [threading.Thread(target=loop, args=(client, random.Random(seed + i)), daemon=True)
+               for i, client in enumerate(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # Requests still running at the deadline finish and are recorded, so measure until the last one
+    return clients, max(duration, time.perf_counter() - record_after)
+
+def run(files: int, shape: str, formats: List[str], work_dir: Path, mix: Dict[str, int], concurrency: int,
+        duration: float, warmup: float = 5, workers: int = 4, worker_class: str = 'sync', threads: int = 1,
+        app: str = 'app:app', gunicorn_args: Optional[List[str]] = None, env: Optional[Dict[str, str]] = None, download_mb: int = 20,
+        client_kbps: int = 0, upload_kb: int = 512, timeout: float = 60, seed: int = 0) -> Dict[str, Any]:
+    """
+    Load the app under gunicorn with mixed traffic and measure each route.
+
+    Args:
+        files (int): Number of files in the synthetic library
+        shape (str): Tree shape from SHAPES
+        formats (List[str]): Extensions of the generated files
+        work_dir (Path): Where the library is kept and reused, and the app state is created
+        mix (Dict[str, int]): Weight of each kind of request, out of DEFAULT_MIX
+        concurrency (int): Number of concurrent clients
+        duration (float): Seconds to record requests for
+        warmup (float): Seconds of load before recording starts
+        workers (int): Gunicorn worker processes
+        worker_class (str): Gunicorn worker class
+        threads (int): Threads per gunicorn worker
+        app (str): The application to serve, 'app:app' (WSGI) or 'asgi:app' with an ASGI worker class
+        gunicorn_args (Optional[List[str]]): Further gunicorn arguments
+        env (Optional[Dict[str, str]]): Configuration overrides passed to the app
+        download_mb (int): Size of the file the download requests fetch
+        client_kbps (int): Download rate of each client, to tie workers up like slow clients (0 for no limit)
+        upload_kb (int): Size of each uploaded file, sent in chunks of at most 256 KiB
+        timeout (float): Seconds a client waits for a response
+        seed (int): Seed of the library and the clients' random choices
+
+    Returns:
+        Dict[str, Any]: Run metadata, a summary per route and the total
+    """
+    unknown = set(mix) - set(DEFAULT_MIX)
+    if unknown:
+        raise ValueError(f"Unknown request kinds: {', '.join(sorted(unknown))}")
+
+    library = work_dir / f"library-{shape}-{files}"
+    manifest = generate_library(library, files, shape, tuple(formats), seed)
+    load_dir = library / _LOAD_DIR
+    if load_dir.exists():
+        shutil.rmtree(load_dir)
+    (load_dir / 'uploads').mkdir(parents=True)
+    write_mp3(load_dir / 'large.mp3', download_mb * 1024 * 1024)
+
+    rng = random.Random(seed)
+    sampled_files, directories = sample_library(library, 10000, rng)
+    workload = Workload(library, sampled_files, directories, upload_kb * 1024, 256 * 1024,
+                        work_dir / f"{library.name}-fixtures" / 'silence.ogg')
+
+    meta = {
+        **git_revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'started_at': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+        'library': {key: manifest[key] for key in ('files', 'shape', 'formats')},
+        'app': app, 'workers': workers, 'worker_class': worker_class, 'threads': threads,
+        'gunicorn_args': gunicorn_args or [], 'env': env or {},
+        'concurrency': concurrency, 'duration': duration, 'warmup': warmup, 'mix': mix,
+        'download_mb': download_mb, 'client_kbps': client_kbps, 'upload_kb': upload_kb
+    }
+
+    port = _free_port()
+    with tempfile.TemporaryDirectory(dir=work_dir) as state:
+        server = start_server(library, Path(state), port, workers, worker_class, threads,
+                              gunicorn_args or [], env or {}, app)
+        try:
+            try:
+                wait_until_ready(server, port)
+            except RuntimeError:
+                sys.stderr.write((Path(state) / 'gunicorn.log').read_text(errors='replace')[-4000:])
+                raise
+            print(f"# gunicorn ready on port {port}: {app} on {workers} {worker_class} workers x {threads} threads, "
+                  f"{concurrency} clients for {warmup:.0f}s + {duration:.0f}s", file=sys.stderr)
+            clients, seconds = drive(port, workload, mix, concurrency, duration, warmup, timeout, client_kbps, seed)
+        finally:
+            stop_server(server)
+            shutil.rmtree(load_dir, ignore_errors=True)
+
+    latencies: Dict[str, List[float]] = defaultdict(list)
+    statuses: Dict[str, Counter] = defaultdict(Counter)
+    received: Counter = Counter()
+    for client in clients:
+        for route, values in client.latencies.items():
+            latencies[route].extend(values)
+            statuses[route].update(client.statuses[route])
+            received[route] += client.bytes[route]
+
+    routes = [summarize(route, latencies[route], statuses[route], received[route], seconds)
+              for route in sorted(latencies)]
+    total = summarize('total', [value for values in latencies.values() for value in values],
+                      sum(statuses.values(), Counter()), sum(received.values()), seconds) if routes else None
+    return {'meta': meta, 'routes': routes, 'total': total}
+
+def _parse_mix(text: str) -> Dict[str, int]:
+    """Parse 'kind=weight,...', where a bare kind keeps its default weight."""
+    mix = {}
+    for part in filter(None, text.split(',')):
+        kind, _, weight = part.partition('=')
+        mix[kind.strip()] = int(weight) if weight else DEFAULT_MIX.get(kind.strip(), 1)
+    return mix
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Load the app under gunicorn with mixed HTTP traffic")
+    parser.add_argument('--files', type=int, default=10000, help="Files in the synthetic library (default: 10000)")
+    parser.add_argument('--shape', default='balanced', choices=SHAPES, help="Tree shape (default: balanced)")
+    parser.add_argument('--formats', default='.mp3',
+                        help="Comma-separated file extensions in the library; other formats than MP3 are "
+                             "transcoded by random requests (default: .mp3)")
+    parser.add_argument('--mix', default=','.join(f"{kind}={weight}" for kind, weight in DEFAULT_MIX.items()),
+                        help="Comma-separated kind=weight of the requests sent (default: %(default)s)")
+    parser.add_argument('--concurrency', type=int, default=16, help="Concurrent clients (default: 16)")
+    parser.add_argument('--duration', type=float, default=30, help="Seconds to measure (default: 30)")
+    parser.add_argument('--warmup', type=float, default=5, help="Seconds of load before measuring (default: 5)")
+    parser.add_argument('--workers', type=int, default=4, help="Gunicorn workers (default: 4)")
+    parser.add_argument('--worker-class', default='sync', help="Gunicorn worker class (default: sync)")
+    parser.add_argument('--threads', type=int, default=1, help="Threads per gunicorn worker (default: 1)")
+    parser.add_argument('--app', default='app:app',
+                        help="Application to serve: app:app (WSGI) or asgi:app with "
+                             "--worker-class uvicorn.workers.UvicornWorker (default: app:app)")
+    parser.add_argument('--gunicorn-arg', action='append', default=[], dest='gunicorn_args',
+                        help="Extra gunicorn argument, e.g. --gunicorn-arg=--keep-alive=5 (repeatable)")
+    parser.add_argument('--env', action='append', default=[],
+                        help="Configuration override passed to the app as KEY=VALUE (repeatable)")
+    parser.add_argument('--download-mb', type=int, default=20, help="Size of the downloaded file (default: 20)")
+    parser.add_argument('--client-kbps', type=int, default=0,
+                        help="Download rate of each client in KiB/s, to emulate slow clients (default: no limit)")
+    parser.add_argument('--upload-kb', type=int, default=512, help="Size of each uploaded file (default: 512)")
+    parser.add_argument('--timeout', type=float, default=60, help="Seconds to wait for a response (default: 60)")
+    parser.add_argument('--seed', type=int, default=0, help="Random seed (default: 0)")
+    parser.add_argument('--work-dir', type=Path, default=Path(tempfile.gettempdir()) / 'randomfile-benchmarks',
+                        help="Where generated libraries are kept and reused")
+    parser.add_argument('--output', type=Path,
+                        help="Results file (default: benchmarks/results/load-<time>-<commit>.json)")
+    args = parser.parse_args(argv)
+
+    args.work_dir.mkdir(parents=True, exist_ok=True)
+    report = run(
+        args.files, args.shape, [f".{extension.lstrip('.')}" for extension in args.formats.split(',')],
+        args.work_dir.resolve(), _parse_mix(args.mix), args.concurrency, args.duration, args.warmup,
+        args.workers, args.worker_class, args.threads, args.app, args.gunicorn_args,
+        dict(override.split('=', 1) for override in args.env), args.download_mb, args.client_kbps,
+        args.upload_kb, args.timeout, args.seed
+    )
+
+    print(f"{'route':15} {'requests':>9} {'errors':>7} {'req/s':>9} {'p50 ms':>9} {'p95 ms':>9} "
+          f"{'p99 ms':>9} {'max ms':>9}")
+    for row in report['routes'] + ([report['total']] if report['total'] else []):
+        print(f"{row['route']:15} {row['requests']:>9} {row['errors']:>7} {row['throughput']:>9.1f} "
+              f"{row['p50'] * 1e3:>9.1f} {row['p95'] * 1e3:>9.1f} {row['p99'] * 1e3:>9.1f} {row['max'] * 1e3:>9.1f}")
+
+    output = args.output
+    if output is None:
+        stamp = datetime.datetime.now().strftime('%Y%m%d-%H%M%S')
+        output = REPO_PATH / 'benchmarks' / 'results' / f"load-{stamp}-{(report['meta']['commit'] or 'unknown')[:8]}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(report, indent=2))
+    print(f"# Results written to {output}", file=sys.stderr)
+
+if __name__ == '__main__':
+    main()
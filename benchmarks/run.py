@@ -0,0 +1,286 @@
+import argparse
+import datetime
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional
+
+from flask import Flask
+
+from benchmarks.library import SHAPES, generate_library
+from randomfile import create_app
+from randomfile.utils import audio_utils, file_utils, metrics
+
+REPO_PATH = Path(__file__).resolve().parent.parent
+
+class Skip(Exception):
+    """Raised by a benchmark that cannot run in this environment."""
+
+class Context:
+    """What a benchmark gets to set itself up: the app and the library it runs against."""
+
+    def __init__(self, app: Flask, library: Path, manifest: Dict[str, Any], work_dir: Path):
+        self.app = app
+        self.library = library
+        self.manifest = manifest
+        self.work_dir = work_dir
+
+    @property
+    def deepest(self) -> Path:
+        """One of the library's deepest directories."""
+        return self.library / self.manifest['deepest']
+
+# Benchmark name -> setup returning the callable to time
+BENCHMARKS: Dict[str, Callable[[Context], Callable[[], Any]]] = {}
+
+def benchmark(name: str) -> Callable:
+    """Register a benchmark setup under a name."""
+    def register(setup: Callable[[Context], Callable[[], Any]]) -> Callable[[Context], Callable[[], Any]]:
+        BENCHMARKS[name] = setup
+        return setup
+    return register
+
+@benchmark('file_utils.validate_path')
+def _validate_path(ctx: Context) -> Callable[[], Any]:
+    return lambda: file_utils.validate_path(ctx.deepest)
+
+@benchmark('library_index.build')
+def _index_build(ctx: Context) -> Callable[[], Any]:
+    index = file_utils.get_index()
+    return index.build
+
+@benchmark('file_utils.get_files_and_dirs')
+def _get_files_and_dirs(ctx: Context) -> Callable[[], Any]:
+    return lambda: file_utils.get_files_and_dirs(ctx.deepest)
+
+@benchmark('file_utils.list_directory_page')
+def _list_directory_page(ctx: Context) -> Callable[[], Any]:
+    return lambda: file_utils.list_directory_page(ctx.deepest, limit=100, entry_type='file')
+
+@benchmark('file_utils.get_directory_tree[cached]')
+def _get_directory_tree_cached(ctx: Context) -> Callable[[], Any]:
+    return lambda: file_utils.get_directory_tree(ctx.library, expand_to=ctx.deepest)
+
+@benchmark('file_utils.get_directory_tree[uncached]')
+def _get_directory_tree_uncached(ctx: Context) -> Callable[[], Any]:
+    def run() -> Any:
+        file_utils._tree_cache.clear()
+        return file_utils.get_directory_tree(ctx.library, expand_to=ctx.deepest)
+    return run
+
+@benchmark('file_utils.get_directory_tree[full]')
+def _get_directory_tree_full(ctx: Context) -> Callable[[], Any]:
+    def run() -> Any:
+        file_utils._tree_cache.clear()
+        return file_utils.get_directory_tree(ctx.library)
+    return run
+
+@benchmark('file_utils.get_random_file[file]')
+def _get_random_file(ctx: Context) -> Callable[[], Any]:
+    return lambda: file_utils.get_random_file(ctx.library, 'file')
+
+@benchmark('file_utils.get_random_file[directory]')
+def _get_random_file_directory(ctx: Context) -> Callable[[], Any]:
+    return lambda: file_utils.get_random_file(ctx.library, 'directory')
+
+@benchmark('file_utils.get_random_files[10]')
+def _get_random_files(ctx: Context) -> Callable[[], Any]:
+    return lambda: file_utils.get_random_files(ctx.library, 10, 'file')
+
+@benchmark('file_utils.search_files')
+def _search_files(ctx: Context) -> Callable[[], Any]:
+    catalog = file_utils.get_catalog(ctx.app)
+    catalog.add_pending(file_utils.get_index().files())
+    return lambda: file_utils.search_files('mars tango', limit=50)
+
+@benchmark('audio_utils.find_audio_files')
+def _find_audio_files(ctx: Context) -> Callable[[], Any]:
+    return lambda: audio_utils.find_audio_files(ctx.library, ('.ogg',))
+
+@benchmark('audio_utils.probe_audio_file')
+def _probe_audio_file(ctx: Context) -> Callable[[], Any]:
+    if shutil.which('ffprobe') is None:
+        raise Skip("ffprobe not found")
+    sample = next(iter(file_utils.get_index().files()))
+    return lambda: audio_utils.probe_audio_file(str(ctx.library / sample))
+
+@benchmark('audio_utils.convert_audio_file')
+def _convert_audio_file(ctx: Context) -> Callable[[], Any]:
+    if shutil.which('ffmpeg') is None:
+        raise Skip("ffmpeg not found")
+    source = ctx.library.parent / f"{ctx.library.name}-fixtures" / 'silence.ogg'
+    target = ctx.work_dir / 'convert' / 'silence.ogg'
+    target.parent.mkdir(parents=True, exist_ok=True)
+
+    def run() -> Any:
+        shutil.copyfile(source, target)
+        return audio_utils.convert_audio_file(str(target), 'mp3')
+    return run
+
+def measure(fn: Callable[[], Any], repeat: int = 5, min_time: float = 0.2) -> Dict[str, Any]:
+    """
+    Time a callable.
+
+    The number of calls per round is chosen so a round takes at least
+    ``min_time`` seconds, like timeit's autorange.
+
+    Args:
+        fn (Callable[[], Any]): What to time
+        repeat (int): Number of rounds
+        min_time (float): Shortest round in seconds
+
+    Returns:
+        Dict[str, Any]: Seconds per call (best, median, mean and stdev over the rounds) and calls per round
+    """
+    fn()  # Warm up caches and lazily built state
+    calls = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(calls):
+            fn()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            break
+        calls = max(calls * 2, int(calls * min_time / max(elapsed, 1e-9)))
+
+    rounds = [elapsed / calls]
+    for _ in range(repeat - 1):
+        start = time.perf_counter()
+        for _ in range(calls):
+            fn()
+        rounds.append((time.perf_counter() - start) / calls)
+    return {
+        'calls': calls,
+        'best': min(rounds),
+        'median': statistics.median(rounds),
+        'mean': statistics.fmean(rounds),
+        'stdev': statistics.stdev(rounds) if len(rounds) > 1 else 0.0
+    }
+
+def create_benchmark_app(library: Path, state: Path) -> Flask:
+    """Create the app with its library and state in the benchmark's directories."""
+    app = create_app('testing')
+    app.config.update(
+        BASE_PATH=library,
+        STATE_PATH=state,
+        LIBRARY_INDEX_REFRESH=0,
+        LIBRARY_INDEX_PATH=state / 'library.idx',
+        CATALOG_DB_PATH=state / 'catalog.db',
+        SAMPLING_DB_PATH=state / 'sampling.db',
+        JOB_DB_PATH=state / 'jobs.db',
+        UPLOAD_DB_PATH=state / 'uploads.db',
+        TRANSCODE_CACHE_PATH=state / 'transcodes',
+        METRICS_PATH=state / 'metrics'
+    )
+    metrics.configure(app.config['METRICS_PATH'])
+    return app
+
+def git_revision() -> Dict[str, Any]:
+    """Get the commit being benchmarked and whether the tree has uncommitted changes."""
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=REPO_PATH, capture_output=True,
+                                text=True, check=True).stdout.strip()
+        status = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=REPO_PATH,
+                                capture_output=True, text=True, check=True).stdout
+        return {'commit': commit, 'dirty': bool(status.strip())}
+    except (OSError, subprocess.SubprocessError):
+        return {'commit': None, 'dirty': None}
+
+def run(sizes: List[int], shapes: List[str], formats: List[str], work_dir: Path, names: Optional[List[str]] = None,
+        repeat: int = 5, min_time: float = 0.2) -> Dict[str, Any]:
+    """
+    Run the benchmarks on every combination of library size and shape.
+
+    Args:
+        sizes (List[int]): Numbers of files
+        shapes (List[str]): Tree shapes from SHAPES
+        formats (List[str]): Extensions of the generated files
+        work_dir (Path): Where libraries and app state are kept; libraries are reused between runs
+        names (Optional[List[str]]): Only run benchmarks whose name contains one of these
+        repeat (int): Rounds per benchmark
+        min_time (float): Shortest round in seconds
+
+    Returns:
+        Dict[str, Any]: Run metadata and one result per benchmark and library
+    """
+    results = []
+    meta = {
+        **git_revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'started_at': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+        'repeat': repeat,
+        'min_time': min_time
+    }
+
+    for files in sizes:
+        for shape in shapes:
+            library = work_dir / f"library-{shape}-{files}"
+            start = time.perf_counter()
+            manifest = generate_library(library, files, shape, tuple(formats))
+            print(f"# {shape} library with {files} files ready in {time.perf_counter() - start:.1f}s", file=sys.stderr)
+
+            with tempfile.TemporaryDirectory(dir=work_dir) as state:
+                app = create_benchmark_app(library, Path(state))
+                with app.app_context():
+                    ctx = Context(app, library, manifest, Path(state))
+                    for name, setup in BENCHMARKS.items():
+                        if names and not any(part in name for part in names):
+                            continue
+                        result = {'name': name, 'files': files, 'shape': shape, 'formats': formats}
+                        try:
+                            result.update(measure(setup(ctx), repeat, min_time))
+                            print(f"{name:45} {shape:>8} {files:>8}  {result['median'] * 1e6:12.1f} us",
+                                  file=sys.stderr)
+                        except Skip as e:
+                            result['skipped'] = str(e)
+                            print(f"{name:45} {shape:>8} {files:>8}  skipped: {e}", file=sys.stderr)
+                        results.append(result)
+
+    return {'meta': meta, 'results': results}
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Time the file and audio utilities on synthetic libraries")
+    parser.add_argument('--files', default='1000,10000',
+                        help="Comma-separated library sizes in files (default: 1000,10000)")
+    parser.add_argument('--shapes', default=','.join(SHAPES),
+                        help=f"Comma-separated tree shapes out of {', '.join(SHAPES)} (default: all)")
+    parser.add_argument('--formats', default='.mp3,.ogg',
+                        help="Comma-separated file extensions in the library (default: .mp3,.ogg)")
+    parser.add_argument('--only', default='', help="Comma-separated parts of the benchmark names to run")
+    parser.add_argument('--repeat', type=int, default=5, help="Rounds per benchmark (default: 5)")
+    parser.add_argument('--min-time', type=float, default=0.2, help="Shortest round in seconds (default: 0.2)")
+    parser.add_argument('--work-dir', type=Path, default=Path(tempfile.gettempdir()) / 'randomfile-benchmarks',
+                        help="Where generated libraries are kept and reused")
+    parser.add_argument('--output', type=Path, help="Results file (default: benchmarks/results/<time>-<commit>.json)")
+    args = parser.parse_args(argv)
+
+    args.work_dir.mkdir(parents=True, exist_ok=True)
+    report = run(
+        [int(size) for size in args.files.split(',')],
+        args.shapes.split(','),
+        [f".{extension.lstrip('.')}" for extension in args.formats.split(',')],
+        args.work_dir.resolve(),
+        [name for name in args.only.split(',') if name],
+        args.repeat,
+        args.min_time
+    )
+
+    output = args.output
+    if output is None:
+        stamp = datetime.datetime.now().strftime('%Y%m%d-%H%M%S')
+        output = REPO_PATH / 'benchmarks' / 'results' / f"{stamp}-{(report['meta']['commit'] or 'unknown')[:8]}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(report, indent=2))
+    print(f"# Results written to {output}", file=sys.stderr)
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,8 @@
 from flask import Flask
+import atexit
 import logging
+import queue
+from logging.handlers import QueueHandler, QueueListener
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
 
@@ -33,7 +36,12 @@ def create_app(config_name='default'):
         file_handler.setFormatter(logging.Formatter(
             '%(asctime)s %(levelname)s: %(message)s [in %(pathname)s:%(lineno)d]'
         ))
-        app.logger.addHandler(file_handler)
+        # Records are written by a listener thread, so logging never waits on the disk
+        log_queue = queue.SimpleQueue()
+        listener = QueueListener(log_queue, file_handler, respect_handler_level=True)
+        listener.start()
+        atexit.register(listener.stop)
+        app.logger.addHandler(QueueHandler(log_queue))
         app.logger.setLevel(logging.INFO)
         app.logger.info('RandomFile startup')
 
@@ -44,10 +52,50 @@ def create_app(config_name='default'):
     # Initialize limiter
     limiter.init_app(app)
 
+    # Time requests and share metrics between the worker processes
+    from randomfile.utils.metrics import init_metrics
+    init_metrics(app)
+
+    # Log each request as a JSON line from a background thread
+    from randomfile.utils.access_log import init_access_log
+    init_access_log(app)
+
+    # Keep stack profiles of slow requests
+    from randomfile.utils.profiler import init_profiler
+    init_profiler(app)
+
     # Register blueprints
     from randomfile.routes.main import main_bp
     from randomfile.routes.audio import audio_bp
     app.register_blueprint(main_bp)
     app.register_blueprint(audio_bp)
 
+    # Delete the partial files of abandoned uploads
+    from randomfile.utils.uploads import get_upload_store
+    get_upload_store(app).start_sweeper()
+
+    # Keep the library index current as files change on disk
+    if app.config.get('LIBRARY_WATCH'):
+        from randomfile.utils.catalog import get_catalog
+        from randomfile.utils.file_utils import get_index
+        from randomfile.utils.watcher import start_watcher
+        with app.app_context():
+            # Changed files are queued for the catalog scanner rather than found by a full pass
+            index = get_index()
+            catalog = get_catalog(app)
+            start_watcher(index, app.config['LIBRARY_WATCH_POLL_INTERVAL'],
+                          lambda changes: catalog.record_changes(index, changes))
+
+    # Fill the metadata catalog in the background
+    if app.config.get('CATALOG_SCAN'):
+        from randomfile.utils.catalog import get_catalog, start_scanner
+        from randomfile.utils.file_utils import get_deduplicator, get_index
+        with app.app_context():
+            # Duplicates are looked for after each pass, by the same process
+            start_scanner(
+                get_catalog(app), get_index(),
+                app.config['CATALOG_SCAN_INTERVAL'], app.config['CATALOG_SCAN_WORKERS'],
+                get_deduplicator().scan if app.config['DEDUP_SCAN'] else None
+            )
+
     return app
@@ -0,0 +1,343 @@
+import asyncio
+import errno
+import io
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional, Tuple
+
+from flask import Flask
+from werkzeug.datastructures import ContentRange
+from werkzeug.http import parse_date, parse_if_range_header, parse_range_header, unquote_etag
+
+from randomfile.utils.delivery import ASGI_SENDFILE, ASGI_SENDFILE_HEADER, ASGI_SENDFILE_OFFSET_HEADER
+from randomfile.utils.metrics import BYTES_SENT_ENVIRON, ENDPOINT_ENVIRON, RESPONSE_BYTES, STATUS_ENVIRON
+
+Scope = Dict[str, Any]
+Message = Dict[str, Any]
+Receive = Callable[[], Awaitable[Message]]
+Send = Callable[[Message], Awaitable[None]]
+
+# Bytes of a file read and sent at a time, the only buffer a stream holds
+_CHUNK_SIZE = 64 * 1024
+
+# Linux can read without blocking when the data is in the page cache
+_NOWAIT = getattr(os, 'RWF_NOWAIT', None) if hasattr(os, 'preadv') else None
+
+class _RequestBody(io.RawIOBase):
+    """
+    The request body as the wsgi.input of a handler running on a thread.
+
+    Chunks are pulled from the ASGI server as the handler reads, so large
+    uploads stream through without being held in memory.
+    """
+
+    def __init__(self, receive: Receive, loop: asyncio.AbstractEventLoop):
+        self._receive = receive
+        self._loop = loop
+        self._buffer = b''
+        self._done = False
+
+    def readable(self) -> bool:
+        return True
+
+    def _fill(self) -> None:
+        message = asyncio.run_coroutine_threadsafe(self._receive(), self._loop).result()
+        if message['type'] == 'http.disconnect':
+            self._done = True
+            raise OSError("Client disconnected")
+        self._buffer += message.get('body', b'')
+        self._done = not message.get('more_body', False)
+
+    def readinto(self, buffer) -> int:
+        while not self._buffer and not self._done:
+            self._fill()
+        size = min(len(buffer), len(self._buffer))
+        buffer[:size] = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        return size
+
+class _Response:
+    """Status and headers a WSGI handler started its response with."""
+
+    def __init__(self):
+        self.status: Optional[int] = None
+        self.headers: List[Tuple[str, str]] = []
+
+    def start(self, status: str, headers: List[Tuple[str, str]], exc_info=None) -> Callable[[bytes], None]:
+        if exc_info is not None and self.status is not None:
+            raise exc_info[1].with_traceback(exc_info[2])
+        self.status = int(status.split(' ', 1)[0])
+        self.headers = headers
+
+        def write(data: bytes) -> None:
+            raise NotImplementedError("The write callable is not supported")
+        return write
+
+    def header(self, name: str) -> Optional[str]:
+        name = name.lower()
+        return next((value for key, value in self.headers if key.lower() == name), None)
+
+    def asgi_headers(self) -> List[Tuple[bytes, bytes]]:
+        return [(key.lower().encode('latin-1'), value.encode('latin-1')) for key, value in self.headers]
+
+def build_environ(scope: Scope, body: io.RawIOBase) -> Dict[str, Any]:
+    """
+    Translate an ASGI HTTP scope to a WSGI environ.
+
+    Args:
+        scope (Scope): The ASGI connection scope
+        body (io.RawIOBase): The request body stream
+
+    Returns:
+        Dict[str, Any]: The WSGI environ
+    """
+    root_path = scope.get('root_path', '')
+    path = scope['path']
+    if root_path and path.startswith(root_path):
+        path = path[len(root_path):]
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': root_path.encode('utf-8').decode('latin-1'),
+        # WSGI carries the raw path bytes as latin-1
+        'PATH_INFO': path.encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1] or 80),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': client[0],
+        'REMOTE_PORT': str(client[1]),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BufferedReader(body, _CHUNK_SIZE),
+        'wsgi.input_terminated': True,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+        ASGI_SENDFILE: True
+    }
+    for name, value in scope.get('headers', []):
+        key = name.decode('latin-1').upper().replace('-', '_')
+        if key not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            key = f"HTTP_{key}"
+        value = value.decode('latin-1')
+        environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+def _if_range_matches(if_range: Optional[str], response: _Response) -> bool:
+    """Check an If-Range header against the validators of the response."""
+    if not if_range:
+        return True
+    condition = parse_if_range_header(if_range)
+    if condition.etag is not None:
+        etag, weak = unquote_etag(response.header('ETag'))
+        return not weak and etag == condition.etag
+    last_modified = parse_date(response.header('Last-Modified'))
+    return condition.date is not None and last_modified is not None and condition.date == last_modified
+
+class AsgiApp:
+    """
+    Serves the Flask app over ASGI, streaming audio files on the event loop.
+
+    Requests are handled by the Flask app on a pool of threads, so routes,
+    templates, sessions and error handling behave exactly as under a WSGI
+    server. Audio files are the exception: the handler only sets the
+    headers (see delivery.send_audio_file) and the file is streamed here
+    without holding a thread, honouring byte ranges. Each stream holds one
+    open file and a single chunk buffer, so a process can serve thousands
+    of listeners with flat memory while the threads stay free for short
+    requests.
+    """
+
+    def __init__(self, app: Flask, threads: Optional[int] = None):
+        """
+        Args:
+            app (Flask): The Flask application
+            threads (Optional[int]): Threads handling requests (default: the app's ASGI_THREADS)
+        """
+        self.app = app
+        self.executor = ThreadPoolExecutor(max_workers=threads or app.config.get('ASGI_THREADS') or 32,
+                                           thread_name_prefix="asgi-handler")
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self._http(scope, receive, send)
+        else:
+            raise RuntimeError(f"Unsupported ASGI scope type: {scope['type']}")
+
+    async def _lifespan(self, receive: Receive, send: Send) -> None:
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.executor.shutdown(wait=False, cancel_futures=True)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def _http(self, scope: Scope, receive: Receive, send: Send) -> None:
+        loop = asyncio.get_running_loop()
+        environ = build_environ(scope, _RequestBody(receive, loop))
+        response = _Response()
+
+        def send_from_thread(message: Message) -> None:
+            asyncio.run_coroutine_threadsafe(send(message), loop).result()
+
+        result = await loop.run_in_executor(self.executor, self._run_wsgi, environ, response, send_from_thread)
+        if result is None:
+            return
+
+        # The handler left the file to us; the response is closed once it has been sent
+        path, offset, iterable = result
+
+        async def send_file_message(message: Message) -> None:
+            # The status may become a 206, 404 or 416 here, after the app has logged 200
+            if message['type'] == 'http.response.start':
+                environ[STATUS_ENVIRON] = message['status']
+            await send(message)
+
+        try:
+            sent = await self._send_file(environ, response, path, offset, receive, send_file_message)
+            environ[BYTES_SENT_ENVIRON] = sent
+            RESPONSE_BYTES.inc(sent, endpoint=environ.get(ENDPOINT_ENVIRON, 'unmatched'))
+        finally:
+            if hasattr(iterable, 'close'):
+                iterable.close()
+
+    def _run_wsgi(self, environ: Dict[str, Any], response: _Response,
+                  send: Callable[[Message], None]) -> Optional[Tuple[str, int, Iterable[bytes]]]:
+        """
+        Run the Flask app on a handler thread and send its response.
+
+        Returns:
+            Optional[Tuple[str, int, Iterable[bytes]]]: The file to stream, the offset its
+                body starts at and the response to close afterwards, or None if the
+                response has been sent
+        """
+        iterable = self.app(environ, response.start)
+        handed_over = False
+        try:
+            chunks = iter(iterable)
+            first = next(chunks, b'') if response.status is None else b''
+            path = response.header(ASGI_SENDFILE_HEADER)
+            if path is not None:
+                offset = int(response.header(ASGI_SENDFILE_OFFSET_HEADER) or 0)
+                internal = (ASGI_SENDFILE_HEADER.lower(), ASGI_SENDFILE_OFFSET_HEADER.lower())
+                response.headers = [(key, value) for key, value in response.headers if key.lower() not in internal]
+                handed_over = True
+                return path, offset, iterable
+
+            send({'type': 'http.response.start', 'status': response.status, 'headers': response.asgi_headers()})
+            if first:
+                send({'type': 'http.response.body', 'body': first, 'more_body': True})
+            # Streamed bodies (transcodes, progress events) keep this thread until they end
+            for chunk in chunks:
+                if chunk:
+                    send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+            return None
+        finally:
+            if not handed_over and hasattr(iterable, 'close'):
+                iterable.close()
+
+    async def _send_file(self, environ: Dict[str, Any], response: _Response, path: str, offset: int,
+                         receive: Receive, send: Send) -> int:
+        """
+        Stream a file the handler left to the adapter, from a byte offset on.
+
+        Revalidations were answered by the handler; here a 200 response
+        becomes a 206 for a satisfiable single byte range that still matches
+        If-Range, or a 416 for an unsatisfiable one. Ranges count from the
+        offset.
+
+        Returns:
+            int: Bytes of the file sent
+        """
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except OSError:
+            await send({'type': 'http.response.start', 'status': 404, 'headers': [(b'content-length', b'0')]})
+            await send({'type': 'http.response.body', 'body': b''})
+            return 0
+
+        try:
+            status = response.status
+            headers = response.asgi_headers()
+            if status != 200:
+                # 304 Not Modified and the like carry no body
+                await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+                await send({'type': 'http.response.body', 'body': b''})
+                return 0
+
+            size = max(0, os.fstat(fd).st_size - offset)
+            start, stop = 0, size
+            ranges = parse_range_header(environ.get('HTTP_RANGE'))
+            # Several ranges are answered with the whole file, like the WSGI path does
+            if ranges is not None and len(ranges.ranges) == 1 and \
+                    _if_range_matches(environ.get('HTTP_IF_RANGE'), response):
+                bounds = ranges.range_for_length(size)
+                if bounds is None:
+                    headers.append((b'content-range', f"bytes */{size}".encode()))
+                    headers.append((b'content-length', b'0'))
+                    await send({'type': 'http.response.start', 'status': 416, 'headers': headers})
+                    await send({'type': 'http.response.body', 'body': b''})
+                    return 0
+                start, stop = bounds
+                status = 206
+                headers.append((b'content-range', ContentRange('bytes', start, stop, size).to_header().encode()))
+            headers = [(key, value) for key, value in headers if key != b'content-length']
+            headers.append((b'content-length', str(stop - start).encode()))
+
+            await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+            if environ['REQUEST_METHOD'] == 'HEAD':
+                await send({'type': 'http.response.body', 'body': b''})
+                return 0
+            return await self._stream(fd, offset + start, offset + stop, receive, send)
+        finally:
+            os.close(fd)
+
+    async def _stream(self, fd: int, start: int, stop: int, receive: Receive, send: Send) -> int:
+        """Send a byte range of an open file, stopping early if the client goes away."""
+        global _NOWAIT
+        loop = asyncio.get_running_loop()
+
+        async def wait_for_disconnect() -> None:
+            while (await receive())['type'] != 'http.disconnect':
+                pass
+
+        disconnected = asyncio.ensure_future(wait_for_disconnect())
+        offset = start
+        try:
+            while offset < stop and not disconnected.done():
+                size = min(_CHUNK_SIZE, stop - offset)
+                data = None
+                if _NOWAIT is not None:
+                    # Pages already cached are read right here, skipping the trip to a thread
+                    buffer = bytearray(size)
+                    try:
+                        data = bytes(buffer[:os.preadv(fd, [buffer], offset, _NOWAIT)])
+                    except BlockingIOError:
+                        pass
+                    except OSError as e:
+                        if e.errno not in (errno.EOPNOTSUPP, errno.EINVAL):
+                            raise
+                        # The filesystem does not support it
+                        _NOWAIT = None
+                if data is None:
+                    data = await loop.run_in_executor(None, os.pread, fd, size, offset)
+                if not data:
+                    # The file was truncated while it was sent
+                    break
+                offset += len(data)
+                await send({'type': 'http.response.body', 'body': data, 'more_body': offset < stop})
+            if offset < stop or start == stop:
+                await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            disconnected.cancel()
+        return offset - start
@@ -5,6 +5,106 @@ class Config:
     """Base configuration class."""
     SECRET_KEY = os.environ.get('SECRET_KEY') or 'hard-to-guess-string'
     BASE_PATH = Path(os.environ.get('BASE_PATH') or 'data/').resolve()
+    # Directory for application state shared between workers (databases, caches)
+    STATE_PATH = Path(os.environ.get('STATE_PATH') or '.randomfile/').resolve()
+    # Seconds between checks of the library for changes made outside the app (0 disables them)
+    LIBRARY_INDEX_REFRESH = int(os.environ.get('LIBRARY_INDEX_REFRESH') or 30)
+    # Library index snapshot, memory-mapped by every worker
+    LIBRARY_INDEX_PATH = Path(os.environ.get('LIBRARY_INDEX_PATH') or STATE_PATH / 'library.idx')
+    # Watch the library for changes made outside the app (inotify, or polling elsewhere)
+    LIBRARY_WATCH = os.environ.get('LIBRARY_WATCH', 'true').lower() in ('1', 'true', 'yes')
+    # Seconds between scans when the watcher has to poll
+    LIBRARY_WATCH_POLL_INTERVAL = float(os.environ.get('LIBRARY_WATCH_POLL_INTERVAL') or 5)
+    # Audio metadata catalog (duration, bitrate, tags)
+    CATALOG_DB_PATH = Path(os.environ.get('CATALOG_DB_PATH') or STATE_PATH / 'catalog.db')
+    # Fill the catalog in the background
+    CATALOG_SCAN = os.environ.get('CATALOG_SCAN', 'true').lower() in ('1', 'true', 'yes')
+    # Seconds between full catalog scans (changed files are probed in between as they are reported)
+    CATALOG_SCAN_INTERVAL = int(os.environ.get('CATALOG_SCAN_INTERVAL') or 300)
+    # Files probed at the same time while scanning
+    CATALOG_SCAN_WORKERS = int(os.environ.get('CATALOG_SCAN_WORKERS') or 4)
+    # Hash files that share their size with another file after each catalog scan, to find duplicates
+    DEDUP_SCAN = os.environ.get('DEDUP_SCAN', 'true').lower() in ('1', 'true', 'yes')
+    # Files hashed at the same time while looking for duplicates
+    DEDUP_HASH_WORKERS = int(os.environ.get('DEDUP_HASH_WORKERS') or 4)
+    # Store an upload that duplicates a file in the library as a hard link to it
+    DEDUP_LINK_UPLOADS = os.environ.get('DEDUP_LINK_UPLOADS', 'true').lower() in ('1', 'true', 'yes')
+    # Shared shuffle bags for random picks that do not repeat
+    SAMPLING_DB_PATH = Path(os.environ.get('SAMPLING_DB_PATH') or STATE_PATH / 'sampling.db')
+    # How random files are sampled: file, directory, duration, plays, shuffle or unique
+    RANDOM_STRATEGY = os.environ.get('RANDOM_STRATEGY') or 'file'
+    # Most files one call to the random batch API may return
+    RANDOM_BATCH_MAX = int(os.environ.get('RANDOM_BATCH_MAX') or 50)
+    # Entries per page of the directory listing API and the browse page
+    LISTING_PAGE_SIZE = int(os.environ.get('LISTING_PAGE_SIZE') or 100)
+    # Rendered browse page fragments (directory trees and file lists) kept per process
+    BROWSE_CACHE_SIZE = int(os.environ.get('BROWSE_CACHE_SIZE') or 256)
+    # SQLite database tracking resumable uploads
+    UPLOAD_DB_PATH = Path(os.environ.get('UPLOAD_DB_PATH') or STATE_PATH / 'uploads.db')
+    # Largest file that can be uploaded
+    UPLOAD_MAX_BYTES = int(os.environ.get('UPLOAD_MAX_BYTES') or 4 * 1024 ** 3)
+    # Largest chunk of a resumable upload sent in one request
+    UPLOAD_CHUNK_SIZE = int(os.environ.get('UPLOAD_CHUNK_SIZE') or 8 * 1024 ** 2)
+    # Largest request body accepted, which also bounds single-request uploads
+    MAX_CONTENT_LENGTH = UPLOAD_MAX_BYTES + 1024 ** 2
+    # Worker processes used for audio conversion (default: one per CPU)
+    CONVERSION_WORKERS = int(os.environ.get('CONVERSION_WORKERS') or 0) or None
+    # Seconds allowed to convert a single file
+    CONVERSION_TIMEOUT = int(os.environ.get('CONVERSION_TIMEOUT') or 600)
+    # SQLite database holding background conversion jobs
+    JOB_DB_PATH = Path(os.environ.get('JOB_DB_PATH') or STATE_PATH / 'jobs.db')
+    # Disk cache for files transcoded to MP3 on the fly, and its size limit
+    TRANSCODE_CACHE_PATH = Path(os.environ.get('TRANSCODE_CACHE_PATH') or STATE_PATH / 'transcodes')
+    TRANSCODE_CACHE_MAX_BYTES = int(os.environ.get('TRANSCODE_CACHE_MAX_BYTES') or 2 * 1024 ** 3)
+    # Seconds browsers may reuse a directly requested audio file before revalidating it
+    AUDIO_MAX_AGE = int(os.environ.get('AUDIO_MAX_AGE') or 3600)
+    # Let the reverse proxy send audio files: '' (disabled), 'x-accel' (nginx) or 'x-sendfile'
+    AUDIO_OFFLOAD = os.environ.get('AUDIO_OFFLOAD') or ''
+    # Internal proxy locations for X-Accel-Redirect, keyed by the directory they serve
+    AUDIO_ACCEL_LOCATIONS = {
+        BASE_PATH: os.environ.get('AUDIO_ACCEL_LIBRARY_LOCATION') or '/internal/library/',
+        TRANSCODE_CACHE_PATH: os.environ.get('AUDIO_ACCEL_TRANSCODE_LOCATION') or '/internal/transcodes/'
+    }
+    # Threads running request handlers per process when served over ASGI (audio files are streamed without one)
+    ASGI_THREADS = int(os.environ.get('ASGI_THREADS') or 32)
+    # Offer progress event streams for jobs; only used by threaded servers, as each stream holds a worker
+    JOB_EVENTS = os.environ.get('JOB_EVENTS', 'false').lower() in ('1', 'true', 'yes')
+    # Seconds a progress event stream stays open before the client reconnects
+    JOB_EVENTS_MAX_SECONDS = int(os.environ.get('JOB_EVENTS_MAX_SECONDS') or 25)
+    # Record request, scan, conversion and cache metrics and expose them on /metrics
+    METRICS_ENABLED = os.environ.get('METRICS_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+    # Directory where each worker process keeps its metric values
+    METRICS_PATH = Path(os.environ.get('METRICS_PATH') or STATE_PATH / 'metrics')
+    # Write a JSON line per request from a background thread
+    ACCESS_LOG = os.environ.get('ACCESS_LOG', 'true').lower() in ('1', 'true', 'yes')
+    # File the access log is written to, shared by all worker processes
+    ACCESS_LOG_PATH = Path(os.environ.get('ACCESS_LOG_PATH') or 'access.log')
+    # Size in bytes at which the access log is rotated (0 never rotates)
+    ACCESS_LOG_MAX_BYTES = int(os.environ.get('ACCESS_LOG_MAX_BYTES') or 100 * 1024 * 1024)
+    # Number of rotated access logs kept
+    ACCESS_LOG_BACKUPS = int(os.environ.get('ACCESS_LOG_BACKUPS') or 5)
+    # Fraction of successful requests logged per endpoint or blueprint, e.g. "audio=0.1,main.browse=0.5"
+    ACCESS_LOG_SAMPLE = os.environ.get('ACCESS_LOG_SAMPLE') or ''
+    # Records held in memory for the writer before new ones are dropped
+    ACCESS_LOG_QUEUE_SIZE = int(os.environ.get('ACCESS_LOG_QUEUE_SIZE') or 10000)
+    # Sample the stacks of slow requests and of requests carrying the profile header
+    PROFILER = os.environ.get('PROFILER', 'false').lower() in ('1', 'true', 'yes')
+    # Latency in milliseconds above which a request's profile is kept (0 keeps only those asked for)
+    PROFILE_SLOW_MS = float(os.environ.get('PROFILE_SLOW_MS') or 1000)
+    # Milliseconds between stack samples
+    PROFILE_INTERVAL_MS = float(os.environ.get('PROFILE_INTERVAL_MS') or 10)
+    # Directory where profiles are kept, shared by the worker processes
+    PROFILE_PATH = Path(os.environ.get('PROFILE_PATH') or STATE_PATH / 'profiles')
+    # Number of profiles kept before the oldest are dropped
+    PROFILE_KEEP = int(os.environ.get('PROFILE_KEEP') or 100)
+    # Bearer token for the admin endpoints and the profile header (admin endpoints are disabled without one)
+    ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN') or ''
+    # Enforce the request rate limits (disabled for load tests)
+    RATELIMIT_ENABLED = os.environ.get('RATELIMIT_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+    # Per-client limit on requests for specific files, which players send many of while seeking
+    STATIC_RATE_LIMIT = os.environ.get('STATIC_RATE_LIMIT') or '600 per minute'
+    # Require a CSRF token on form and API posts
+    WTF_CSRF_ENABLED = os.environ.get('WTF_CSRF_ENABLED', 'true').lower() in ('1', 'true', 'yes')
     
     @staticmethod
     def init_app(app):
@@ -18,6 +118,9 @@ class DevelopmentConfig(Config):
 class TestingConfig(Config):
     """Testing configuration."""
     TESTING = True
+    LIBRARY_WATCH = False
+    CATALOG_SCAN = False
+    ACCESS_LOG = False
     
 class ProductionConfig(Config):
     """Production configuration."""
@@ -1,20 +1,134 @@
-from flask import Blueprint, send_file, current_app, abort, request, jsonify
+from flask import Blueprint, current_app, abort, request, jsonify, Response, session, stream_with_context, url_for
 from pathlib import Path
+from typing import Optional, Tuple
+import json
+import math
 import os
+import time
+import uuid
 
-from randomfile.utils.file_utils import get_random_file, validate_path, PathValidationError
-from randomfile.utils.audio_utils import convert_ogg_to_mp3, supports_format, convert_audio_file
+from randomfile.utils.file_utils import get_random_file, get_random_files, record_play, find_start_offset, validate_path, PathValidationError
+from randomfile.utils.audio_utils import supports_format, convert_audio_file, is_playable
+from randomfile.utils.transcode_cache import get_transcode_cache
+from randomfile.utils.delivery import send_audio_file
+from randomfile.utils.jobs import get_job_store, start_conversion_job, FINISHED_STATES
+from randomfile.utils.sampling import STRATEGIES, SHUFFLE
 from randomfile import limiter
 
 # Create blueprint
 audio_bp = Blueprint('audio', __name__)
 
+# Response header giving the time in seconds at which the audio of a response started with t= begins
+START_TIME_HEADER = 'X-Randomfile-Start-Time'
+
+def serve_audio(file_path: Path, as_attachment: bool = False, max_age: Optional[int] = None):
+    """
+    Send an audio file as MP3, transcoding other supported formats on the fly.
+
+    Transcodes are streamed to the client while they are written to the
+    transcode cache, so later requests for the same file are served from disk
+    with full range and conditional request support.
+
+    Args:
+        file_path (Path): The audio file to send
+        as_attachment (bool): Send the file as a download
+        max_age (Optional[int]): Seconds clients may cache the response without revalidating
+
+    Returns:
+        Response: Audio file response
+    """
+    if file_path.suffix.lower() == '.mp3':
+        return send_audio_file(file_path, as_attachment=as_attachment, max_age=max_age)
+
+    cache = get_transcode_cache(current_app)
+    download_name = file_path.with_suffix('.mp3').name
+    cached = cache.lookup(file_path)
+    if cached:
+        return send_audio_file(cached, as_attachment=as_attachment, download_name=download_name, max_age=max_age)
+
+    # The length is unknown until ffmpeg finishes, so this first response cannot serve ranges
+    response = Response(stream_with_context(cache.stream(file_path)), mimetype="audio/mp3")
+    response.headers['Accept-Ranges'] = 'none'
+    if as_attachment:
+        response.headers['Content-Disposition'] = f'attachment; filename="{download_name}"'
+    return response
+
+def _is_static_request() -> bool:
+    """Check whether a request asks for a specific file rather than a random one."""
+    return request.args.get('static', 'false').lower() == 'true'
+
+def _start_time() -> Optional[float]:
+    """
+    Read the time playback should start at from the query string.
+
+    Returns:
+        Optional[float]: Seconds from the start of the audio, or None to send the whole file
+    """
+    value = request.args.get('t')
+    if value is None:
+        return None
+    try:
+        seconds = float(value)
+    except ValueError:
+        seconds = -1.0
+    if not math.isfinite(seconds) or seconds < 0:
+        abort(400, description="t must be a number of seconds")
+    return seconds
+
+def _sampling_options() -> Tuple[Optional[str], Optional[str]]:
+    """
+    Read the sampling strategy of a random pick from the query string.
+
+    The strategy parameter selects one of the sampling strategies and
+    no_repeat=true is shorthand for the shuffle strategy, which deals from a
+    shuffle bag kept for the browser session.
+
+    Returns:
+        Tuple[Optional[str], Optional[str]]: The strategy (None for the default) and the
+            listener id for shuffle bags
+    """
+    strategy = request.args.get('strategy') or None
+    if request.args.get('no_repeat', 'false').lower() == 'true':
+        strategy = SHUFFLE
+    if strategy is not None and strategy not in STRATEGIES:
+        abort(400, description=f"Unsupported strategy, use one of: {', '.join(STRATEGIES)}")
+
+    listener = None
+    if (strategy or current_app.config.get('RANDOM_STRATEGY')) == SHUFFLE:
+        listener = session.setdefault('listener_id', uuid.uuid4().hex)
+    return strategy, listener
+
+def _count_play(file_path: Path, response: Response) -> Response:
+    """
+    Count a play of the file a response sends, then return the response.
+
+    Only whole files and byte ranges from the start count, so neither the
+    later ranges a player fetches while it streams or seeks nor revalidations
+    answered with 304 add plays.
+    """
+    if response.status_code == 206:
+        if response.content_range is None or response.content_range.start != 0:
+            return response
+    elif response.status_code != 200:
+        return response
+    try:
+        record_play(file_path)
+    except Exception as e:
+        current_app.logger.error(f"Error recording a play of {file_path}: {str(e)}")
+    return response
+
 @audio_bp.route("/audio/<path:subpath>")
 @audio_bp.route("/audio")
-@limiter.limit("100 per day")
+@limiter.limit("100 per day", exempt_when=_is_static_request)
+@limiter.limit(lambda: current_app.config['STATIC_RATE_LIMIT'], exempt_when=lambda: not _is_static_request())
 def random_file(subpath=None):
     """
-    Returns a random .mp3 file from a directory including subdirectories.
+    Returns a random audio file from a directory including subdirectories.
+
+    Files in other supported formats are transcoded to MP3 on the fly. A
+    specific MP3 file can be started part way through with t=<seconds>:
+    the response then begins at the frame playing at that time, found in
+    the file's seek table.
 
     Args:
         subpath (str, optional): Subdirectory to search in. Defaults to None.
@@ -26,7 +140,7 @@ def random_file(subpath=None):
     path = Path(f"{base_path}/{subpath}" if subpath else base_path).resolve()
 
     # Check if a static parameter is provided (for direct file access)
-    static = request.args.get('static', 'false').lower() == 'true'
+    static = _is_static_request()
 
     if static and subpath:
         # Serve a specific file
@@ -40,31 +154,84 @@ def random_file(subpath=None):
         if not file_path.exists() or not file_path.is_file():
             return abort(404, description="File not found")
 
-        # Check if the file is an MP3
-        if file_path.suffix.lower() != '.mp3':
-            return abort(400, description="Only MP3 files are supported")
+        # Check if the file can be served as MP3
+        if not is_playable(file_path.suffix):
+            return abort(400, description="Unsupported audio format")
+
+        start = _start_time()
+        if start is not None:
+            if file_path.suffix.lower() != '.mp3':
+                return abort(400, description="Only MP3 files can be started part way through")
+            frame = find_start_offset(file_path, start)
+            if frame is None:
+                return abort(400, description="The file has no audio at that time")
+            offset, start = frame
+            response = send_audio_file(file_path, max_age=current_app.config.get('AUDIO_MAX_AGE'), offset=offset)
+            response.headers[START_TIME_HEADER] = f"{start:.6f}"
+            return _count_play(file_path, response)
 
-        return send_file(file_path, mimetype="audio/mp3")
+        return _count_play(file_path, serve_audio(file_path, max_age=current_app.config.get('AUDIO_MAX_AGE')))
 
     # Get a random file
+    strategy, listener = _sampling_options()
     try:
-        random_mp3 = get_random_file(path)
+        random_audio = get_random_file(path, strategy, listener)
+    except PathValidationError as e:
+        return abort(403, description=str(e))
+    except Exception as e:
+        current_app.logger.error(f"Error in random_file route: {str(e)}")
+        return abort(500, description="An unexpected error occurred")
 
-        if not random_mp3:
-            return abort(404, description="No MP3 files found in the specified directory")
+    if not random_audio:
+        return abort(404, description="No audio files found in the specified directory")
 
-        return send_file(random_mp3, mimetype="audio/mp3", as_attachment=True)
+    try:
+        return _count_play(random_audio, serve_audio(random_audio, as_attachment=True))
     except PathValidationError as e:
         return abort(403, description=str(e))
     except Exception as e:
         current_app.logger.error(f"Error in random_file route: {str(e)}")
         return abort(500, description="An unexpected error occurred")
 
+@audio_bp.route("/api/random/<path:subpath>")
+@audio_bp.route("/api/random")
+@limiter.limit("100 per day")
+def random_batch(subpath=None):
+    """
+    Returns several distinct random audio files from a directory as JSON.
+
+    Query parameters: count (number of files), strategy (how files are
+    sampled) and no_repeat (deal from the session's shuffle bag so files do
+    not repeat until all have been played).
+
+    Args:
+        subpath (str, optional): Subdirectory to pick from. Defaults to None.
+
+    Returns:
+        Response: JSON list of files with their metadata and playback URLs
+    """
+    base_path = current_app.config['BASE_PATH']
+    path = Path(f"{base_path}/{subpath}" if subpath else base_path).resolve()
+
+    count = max(1, min(request.args.get('count', 10, type=int), current_app.config['RANDOM_BATCH_MAX']))
+    strategy, listener = _sampling_options()
+
+    try:
+        files = get_random_files(path, count, strategy, listener)
+        for file in files:
+            file["url"] = url_for('audio.random_file', subpath=file["path"].replace(os.sep, '/'), static='true')
+        return jsonify({"files": files})
+    except PathValidationError as e:
+        return jsonify({"error": str(e)}), 403
+    except Exception as e:
+        current_app.logger.error(f"Error in random_batch route: {str(e)}")
+        return jsonify({"error": "An unexpected error occurred"}), 500
+
 @audio_bp.route("/convert", methods=['POST'])
 @limiter.limit("10 per hour")
 def convert_files():
     """
-    API endpoint to convert audio files to MP3.
+    API endpoint to start converting audio files to MP3 in the background.
 
     Expected JSON payload:
     {
@@ -73,7 +240,7 @@ def convert_files():
     }
 
     Returns:
-        JSON response with conversion results
+        JSON response with the id of the queued conversion job
     """
     data = request.get_json() or {}
     base_path = current_app.config['BASE_PATH']
@@ -88,18 +255,94 @@ def convert_files():
         return jsonify({"error": error}), 403
 
     try:
-        # Convert files
-        converted_files = convert_ogg_to_mp3(directory_path)
+        # Queue the conversion and return immediately
+        job_id = start_conversion_job(current_app._get_current_object(), directory_path)
 
-        return jsonify({
+        response = {
             "success": True,
-            "message": f"Converted {len(converted_files)} files",
-            "converted_files": converted_files
-        })
+            "message": "Conversion started",
+            "job_id": job_id,
+            "status_url": url_for('audio.conversion_status', job_id=job_id)
+        }
+        if _job_events_enabled():
+            response["events_url"] = url_for('audio.conversion_events', job_id=job_id)
+        return jsonify(response), 202
     except Exception as e:
         current_app.logger.error(f"Error in convert_files route: {str(e)}")
         return jsonify({"error": str(e)}), 500
 
+@audio_bp.route("/convert/<job_id>")
+@limiter.exempt
+def conversion_status(job_id):
+    """
+    Returns the status, progress counts and per-file errors of a conversion job.
+
+    Args:
+        job_id (str): The conversion job id
+
+    Returns:
+        JSON response with the job state
+    """
+    job = get_job_store(current_app).get(job_id)
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify(job)
+
+def _job_events_enabled() -> bool:
+    """
+    Check whether progress event streams are offered to this request.
+
+    A stream holds its worker for as long as it is open, which under sync
+    workers takes a whole process away from other requests, so streams are
+    only served when JOB_EVENTS is set and the server runs requests on
+    threads (gthread workers or the ASGI entry point). Otherwise clients
+    poll the job's status URL.
+    """
+    return current_app.config['JOB_EVENTS'] and request.environ.get('wsgi.multithread', False)
+
+@audio_bp.route("/convert/<job_id>/events")
+@limiter.exempt
+def conversion_events(job_id):
+    """
+    Streams the progress of a conversion job as server-sent events.
+
+    The stream closes when the job finishes or after JOB_EVENTS_MAX_SECONDS,
+    so long jobs do not pin a worker; EventSource clients reconnect on their own.
+    Only served by threaded servers with JOB_EVENTS set.
+
+    Args:
+        job_id (str): The conversion job id
+
+    Returns:
+        Response: A text/event-stream response
+    """
+    if not _job_events_enabled():
+        return jsonify({"error": "Progress streams are disabled, poll the job's status URL instead"}), 404
+    store = get_job_store(current_app)
+    if store.get(job_id) is None:
+        return jsonify({"error": "Job not found"}), 404
+
+    max_seconds = current_app.config.get('JOB_EVENTS_MAX_SECONDS', 25)
+
+    def generate():
+        deadline = time.monotonic() + max_seconds
+        last_update = None
+        yield "retry: 1000\n\n"
+        while time.monotonic() < deadline:
+            job = store.get(job_id)
+            if job is None:
+                return
+            if job['updated_at'] != last_update:
+                last_update = job['updated_at']
+                event = "done" if job['status'] in FINISHED_STATES else "progress"
+                yield f"event: {event}\ndata: {json.dumps(job)}\n\n"
+                if event == "done":
+                    return
+            time.sleep(0.5)
+
+    return Response(stream_with_context(generate()), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
 @audio_bp.errorhandler(400)
 def bad_request_error(e):
     """Custom error handler for 400 errors."""
@@ -1,12 +1,20 @@
-from flask import Blueprint, render_template, current_app, abort, request, redirect, url_for, flash
+from flask import (Blueprint, Response, render_template, current_app, abort, request, redirect, url_for, flash, jsonify,
+                   make_response, session)
 from pathlib import Path
 import os
 
 from randomfile.utils.file_utils import (
-    get_files_and_dirs, get_path_parts, PathValidationError,
+    get_path_parts, PathValidationError,
     add_file, delete_file, move_file, create_directory,
-    get_directory_tree
+    get_directory_tree, get_tree_level, list_directory_page, get_file_metadata,
+    search_files, start_upload, get_upload, upload_chunk, cancel_upload,
+    find_duplicates, collapse_duplicates, get_collapse_job, get_directory_version
 )
+from randomfile.utils.uploads import UploadError
+from randomfile.utils import metrics
+from randomfile.utils.profiler import folded, get_profiler, is_admin
+from randomfile.utils.page_cache import get_fragment_cache, page_etag
+from randomfile import limiter
 
 # Create blueprint
 main_bp = Blueprint('main', __name__)
@@ -16,7 +24,11 @@ main_bp = Blueprint('main', __name__)
 @main_bp.route("/browse/")
 def browse(subpath=None):
     """
-    Returns a list of all .mp3 files in a directory including subdirectories.
+    Returns a list of all audio files in a directory including subdirectories.
+
+    The directory tree and the file list are rendered once per version of
+    the library and reused, and browsers revalidating an unchanged page get
+    a 304 Not Modified.
 
     Args:
         subpath (str, optional): Subdirectory to browse. Defaults to None.
@@ -28,20 +40,44 @@ def browse(subpath=None):
     path = Path(f"{base_path}/{subpath}" if subpath else base_path).resolve()
 
     try:
-        # Get files and directories for the current path (for backward compatibility)
-        files = get_files_and_dirs(path)
-        path_parts = get_path_parts(path)
-
-        # Get the complete directory tree starting from the base path
-        directory_tree = get_directory_tree(Path(base_path))
+        version = get_directory_version(path)
+        # Pages showing flashed messages are never revalidated, or the messages would show again
+        revalidate = not session.get('_flashes')
+        if revalidate and request.if_none_match.contains_weak(page_etag(version)):
+            response = Response(status=304)
+            response.set_etag(page_etag(version), weak=True)
+            response.headers['Cache-Control'] = 'no-cache'
+            return response
 
-        return render_template(
+        path_parts = get_path_parts(path)
+        current_path = str(os.path.relpath(path, base_path)) if path != base_path else ""
+        fragments = get_fragment_cache(current_app)
+
+        # Render the first page of files; the rest is loaded from the listing API while scrolling
+        page_size = current_app.config['LISTING_PAGE_SIZE']
+        files_html = fragments.render('browse_files.html', (version, current_path, page_size), lambda: {
+            'files': list_directory_page(path, limit=page_size, entry_type='file'),
+            'path_parts': path_parts
+        })
+
+        # Get the directory tree, expanded only along the current path
+        tree_html = fragments.render('browse_tree.html', (version, current_path), lambda: {
+            'directory_tree': get_directory_tree(Path(base_path), expand_to=path),
+            'current_path': current_path
+        })
+
+        response = make_response(render_template(
             "browse.html",
-            files=files,
+            files_html=files_html,
+            tree_html=tree_html,
             path_parts=path_parts,
-            directory_tree=directory_tree,
-            current_path=str(os.path.relpath(path, base_path)) if path != base_path else ""
-        )
+            current_path=current_path
+        ))
+        if revalidate:
+            # Tagged after rendering, which may have added a CSRF token to the session
+            response.set_etag(page_etag(version), weak=True)
+            response.headers['Cache-Control'] = 'no-cache'
+        return response
     except PathValidationError as e:
         # Return a 403 Forbidden error with a custom error message
         return abort(403, description=str(e))
@@ -51,15 +87,223 @@ def browse(subpath=None):
         return abort(500, description="An unexpected error occurred")
 
 
+@main_bp.route("/api/tree/<path:subpath>")
+@main_bp.route("/api/tree/")
+def tree_level(subpath=None):
+    """
+    Returns one level of the directory tree as JSON, used to expand sidebar nodes on demand.
+
+    Args:
+        subpath (str, optional): Directory to list. Defaults to None.
+
+    Returns:
+        Response: JSON directory node with its immediate children
+    """
+    base_path = current_app.config['BASE_PATH']
+    path = Path(f"{base_path}/{subpath}" if subpath else base_path).resolve()
+
+    try:
+        return jsonify(get_tree_level(path))
+    except PathValidationError as e:
+        return jsonify({"error": str(e)}), 403
+    except Exception as e:
+        current_app.logger.error(f"Error in tree_level route: {str(e)}")
+        return jsonify({"error": "An unexpected error occurred"}), 500
+
+
+@main_bp.route("/api/list/<path:subpath>")
+@main_bp.route("/api/list/")
+def list_directory(subpath=None):
+    """
+    Returns one page of a directory listing as JSON.
+
+    Query parameters: sort (name, mtime or size), order (asc or desc), prefix,
+    type (directory or file), cursor (the previous page's next_cursor) and limit.
+
+    Args:
+        subpath (str, optional): Directory to list. Defaults to None.
+
+    Returns:
+        Response: JSON page of entries with the cursor of the next page
+    """
+    base_path = current_app.config['BASE_PATH']
+    path = Path(f"{base_path}/{subpath}" if subpath else base_path).resolve()
+
+    try:
+        return jsonify(list_directory_page(
+            path,
+            sort=request.args.get('sort', 'name'),
+            descending=request.args.get('order', 'asc').lower() == 'desc',
+            prefix=request.args.get('prefix', ''),
+            cursor=request.args.get('cursor') or None,
+            limit=request.args.get('limit', current_app.config['LISTING_PAGE_SIZE'], type=int),
+            entry_type=request.args.get('type') or None
+        ))
+    except PathValidationError as e:
+        return jsonify({"error": str(e)}), 403
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        current_app.logger.error(f"Error in list_directory route: {str(e)}")
+        return jsonify({"error": "An unexpected error occurred"}), 500
+
+
+@main_bp.route("/search")
+def search():
+    """
+    Returns the audio files whose path or tags contain every term of a query as JSON.
+
+    Query parameters: q (the search terms), path (only search below this
+    directory) and limit.
+
+    Returns:
+        Response: JSON list of matching files
+    """
+    query = request.args.get('q', '').strip()
+    if not query:
+        return jsonify({"error": "No query specified"}), 400
+
+    base_path = current_app.config['BASE_PATH']
+    subpath = request.args.get('path', '')
+    path = Path(f"{base_path}/{subpath}").resolve() if subpath else None
+
+    try:
+        results = search_files(query, path, request.args.get('limit', 50, type=int))
+        return jsonify({"query": query, "results": results})
+    except PathValidationError as e:
+        return jsonify({"error": str(e)}), 403
+    except Exception as e:
+        current_app.logger.error(f"Error in search route: {str(e)}")
+        return jsonify({"error": "An unexpected error occurred"}), 500
+
+
+@main_bp.route("/api/metadata/<path:subpath>")
+def file_metadata(subpath):
+    """
+    Returns the catalogued metadata of an audio file as JSON.
+
+    Args:
+        subpath (str): The audio file
+
+    Returns:
+        Response: JSON duration, bitrate, sample rate, channels, tags, size and mtime
+    """
+    base_path = current_app.config['BASE_PATH']
+    file_path = Path(f"{base_path}/{subpath}").resolve()
+
+    try:
+        metadata = get_file_metadata(file_path)
+        if metadata is None:
+            return jsonify({"error": "File has not been catalogued"}), 404
+        return jsonify(metadata)
+    except PathValidationError as e:
+        return jsonify({"error": str(e)}), 403
+    except Exception as e:
+        current_app.logger.error(f"Error in file_metadata route: {str(e)}")
+        return jsonify({"error": "An unexpected error occurred"}), 500
+
+
+@main_bp.route("/api/duplicates")
+def duplicates():
+    """
+    Returns groups of byte-identical audio files as JSON, those wasting the most space first.
+
+    Query parameters: path (only consider files below this directory), limit and offset.
+
+    Returns:
+        Response: JSON list of groups with their hash, size, paths and reclaimable bytes
+    """
+    base_path = current_app.config['BASE_PATH']
+    subpath = request.args.get('path', '')
+    path = Path(f"{base_path}/{subpath}").resolve() if subpath else None
+
+    try:
+        groups = find_duplicates(path, request.args.get('limit', 100, type=int),
+                                 request.args.get('offset', 0, type=int))
+        return jsonify({"groups": groups, "reclaimable": sum(group['reclaimable'] for group in groups)})
+    except PathValidationError as e:
+        return jsonify({"error": str(e)}), 403
+    except Exception as e:
+        current_app.logger.error(f"Error in duplicates route: {str(e)}")
+        return jsonify({"error": "An unexpected error occurred"}), 500
+
+
+@main_bp.route("/api/duplicates/collapse", methods=["POST"])
+def collapse_duplicates_route():
+    """
+    Starts replacing byte-identical audio files with hard links to a single copy.
+
+    Requires the ADMIN_TOKEN as a bearer token. Takes an optional JSON body
+    with path (only consider files below this directory) and sha256 (a list
+    of the groups to collapse). The files are linked in a background job.
+
+    Returns:
+        Response: JSON with the id and status URL of the collapse job
+    """
+    if not current_app.config.get('ADMIN_TOKEN'):
+        abort(404)
+    if not is_admin():
+        return jsonify({"error": "Unauthorized"}), 401
+
+    data = request.get_json(silent=True) or {}
+    base_path = current_app.config['BASE_PATH']
+    subpath = data.get('path') or ''
+    path = Path(f"{base_path}/{subpath}").resolve() if subpath else None
+    sha256s = data.get('sha256')
+    if sha256s is not None and not isinstance(sha256s, list):
+        return jsonify({"error": "sha256 must be a list"}), 400
+
+    try:
+        job_id = collapse_duplicates(path, sha256s)
+        return jsonify({
+            "success": True,
+            "job_id": job_id,
+            "status_url": url_for('main.collapse_status', job_id=job_id)
+        }), 202
+    except PathValidationError as e:
+        return jsonify({"error": str(e)}), 403
+    except Exception as e:
+        current_app.logger.error(f"Error in collapse_duplicates route: {str(e)}")
+        return jsonify({"error": "An unexpected error occurred"}), 500
+
+
+@main_bp.route("/api/duplicates/collapse/<job_id>")
+@limiter.exempt
+def collapse_status(job_id):
+    """
+    Returns the status of a duplicate collapse job. Requires the ADMIN_TOKEN as a bearer token.
+
+    Args:
+        job_id (str): The collapse job id
+
+    Returns:
+        Response: JSON job state, with the files linked and bytes reclaimed in its result once completed
+    """
+    if not current_app.config.get('ADMIN_TOKEN'):
+        abort(404)
+    if not is_admin():
+        return jsonify({"error": "Unauthorized"}), 401
+    job = get_collapse_job(job_id)
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify(job)
+
+
 @main_bp.route("/upload", methods=["POST"])
 def upload_file():
     # TODO: Look into this
     """
     Upload a file to the specified directory.
 
+    A JSON body of directory, filename, size and optionally sha256 starts a
+    resumable upload instead, whose chunks are then sent to /upload/<id>.
+
     Returns:
-        Redirect to the browse page
+        Redirect to the browse page, or the new upload as JSON
     """
+    if request.is_json:
+        return start_upload_route()
+
     if 'file' not in request.files:
         flash('No file part', 'error')
         return redirect(request.referrer or url_for('main.browse'))
@@ -83,6 +327,106 @@ def upload_file():
     return redirect(url_for('main.browse', subpath=subpath))
 
 
+def start_upload_route():
+    """
+    Start a resumable upload.
+
+    Returns:
+        Response: JSON upload id, offset and chunk size
+    """
+    data = request.get_json(silent=True) or {}
+    subpath = data.get('directory') or ''
+    base_path = current_app.config['BASE_PATH']
+    directory_path = Path(f"{base_path}/{subpath}").resolve() if subpath else Path(base_path)
+
+    try:
+        size = int(data.get('size'))
+    except (TypeError, ValueError):
+        return jsonify({"error": "File size not specified"}), 400
+
+    try:
+        upload = start_upload(directory_path, data.get('filename') or '', size, data.get('sha256') or None)
+        return jsonify(upload), 201, {'Upload-Offset': str(upload['offset'])}
+    except PathValidationError as e:
+        return jsonify({"error": str(e)}), 403
+    except UploadError as e:
+        return jsonify({"error": str(e)}), e.status
+    except Exception as e:
+        current_app.logger.error(f"Error in start_upload route: {str(e)}")
+        return jsonify({"error": "An unexpected error occurred"}), 500
+
+
+@main_bp.route("/upload/<upload_id>", methods=["GET"])
+def upload_status(upload_id):
+    """
+    Returns the progress of a resumable upload, so an interrupted upload can resume.
+
+    Args:
+        upload_id (str): The upload id
+
+    Returns:
+        Response: JSON upload with the offset the next chunk must start at
+    """
+    upload = get_upload(upload_id)
+    if upload is None:
+        return jsonify({"error": "Upload not found"}), 404
+    return jsonify(upload), 200, {'Upload-Offset': str(upload['offset']), 'Cache-Control': 'no-store'}
+
+
+@main_bp.route("/upload/<upload_id>", methods=["PUT"])
+def upload_chunk_route(upload_id):
+    """
+    Receives the next chunk of a resumable upload.
+
+    The Upload-Offset header gives the chunk's position, which must equal the
+    offset received so far, and the optional X-Chunk-SHA256 header its hash.
+    A rejected chunk leaves the offset unchanged and can simply be sent again.
+
+    Args:
+        upload_id (str): The upload id
+
+    Returns:
+        Response: JSON upload with the new offset, and the file's path and hash once complete
+    """
+    length = request.content_length
+    if length is None:
+        if request.headers.get('Transfer-Encoding'):
+            return jsonify({"error": "Content-Length required"}), 411
+        length = 0
+
+    try:
+        offset = int(request.headers.get('Upload-Offset', ''))
+    except ValueError:
+        return jsonify({"error": "Upload-Offset header required"}), 400
+
+    try:
+        upload = upload_chunk(upload_id, offset, request.stream, length, request.headers.get('X-Chunk-SHA256'))
+        return jsonify(upload), 201 if 'path' in upload else 200, {'Upload-Offset': str(upload['offset'])}
+    except UploadError as e:
+        current = get_upload(upload_id)
+        headers = {'Upload-Offset': str(current['offset'])} if current is not None else {}
+        return jsonify({"error": str(e)}), e.status, headers
+    except Exception as e:
+        current_app.logger.error(f"Error in upload_chunk route: {str(e)}")
+        return jsonify({"error": "An unexpected error occurred"}), 500
+
+
+@main_bp.route("/upload/<upload_id>", methods=["DELETE"])
+def cancel_upload_route(upload_id):
+    """
+    Abandons a resumable upload.
+
+    Args:
+        upload_id (str): The upload id
+
+    Returns:
+        Response: Empty response
+    """
+    if not cancel_upload(upload_id):
+        return jsonify({"error": "Upload not found"}), 404
+    return '', 204
+
+
 @main_bp.route("/delete", methods=["POST"])
 def delete_file_route():
     # TODO: Look into this
@@ -177,6 +521,68 @@ def create_directory_route():
     return redirect(url_for('main.browse', subpath=parent_path))
 
 
+@main_bp.route("/metrics")
+@limiter.exempt
+def metrics_route():
+    """
+    Exposes the metrics of all worker processes in the Prometheus text format.
+
+    Returns:
+        Response: The metrics as text/plain
+    """
+    if not current_app.config.get('METRICS_ENABLED'):
+        abort(404)
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4',
+                    headers={'Cache-Control': 'no-store'})
+
+
+@main_bp.route("/admin/profiles")
+@limiter.exempt
+def profiles():
+    """
+    Lists the request profiles kept, most recent first. Requires the ADMIN_TOKEN as a bearer token.
+
+    Returns:
+        Response: JSON list of profiles with their request, status, duration and number of samples
+    """
+    profiler = get_profiler(current_app)
+    if profiler is None or not current_app.config.get('ADMIN_TOKEN'):
+        abort(404)
+    if not is_admin():
+        return jsonify({"error": "Unauthorized"}), 401
+    return jsonify({"profiles": profiler.list()})
+
+
+@main_bp.route("/admin/profiles/<profile_id>")
+@limiter.exempt
+def profile(profile_id):
+    """
+    Downloads a request profile. Requires the ADMIN_TOKEN as a bearer token.
+
+    Query parameters: format (folded, the default, for flamegraph.pl and speedscope, or json).
+
+    Args:
+        profile_id (str): The profile's id
+
+    Returns:
+        Response: The folded stacks as text/plain, or the whole profile as JSON
+    """
+    profiler = get_profiler(current_app)
+    if profiler is None or not current_app.config.get('ADMIN_TOKEN'):
+        abort(404)
+    if not is_admin():
+        return jsonify({"error": "Unauthorized"}), 401
+    data = profiler.get(profile_id)
+    if data is None:
+        return jsonify({"error": "Profile not found"}), 404
+    if request.args.get('format') == 'json':
+        return jsonify(data)
+    return Response(folded(data), mimetype='text/plain', headers={
+        'Content-Disposition': f'attachment; filename="{profile_id}.folded"',
+        'Cache-Control': 'no-store'
+    })
+
+
 @main_bp.errorhandler(403)
 def forbidden_error(e):
     """Custom error handler for 403 errors."""
@@ -12,7 +12,7 @@ def configure_security(app: Flask) -> None:
     def add_security_headers(response):
         """Add security headers to all responses."""
         # Content Security Policy
-        response.headers['Content-Security-Policy-Report-Only '] = (
+        response.headers['Content-Security-Policy-Report-Only'] = (
             "default-src 'self'; "
             "script-src 'self' https://cdn.jsdelivr.net; "
             "style-src 'self' https://cdn.jsdelivr.net; "
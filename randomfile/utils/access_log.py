@@ -0,0 +1,278 @@
+import atexit
+import datetime
+import json
+import logging
+import os
+import queue
+import random
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from flask import Flask, g, request
+
+from randomfile.utils.metrics import BYTES_SENT_ENVIRON, STATUS_ENVIRON, on_response_sent
+
+try:
+    import fcntl
+except ImportError:
+    # Without locks two processes may rotate the log at once, losing a backup
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+def parse_sample_rates(spec: str) -> Dict[str, float]:
+    """
+    Parse per-route sample rates.
+
+    Args:
+        spec (str): Comma-separated ``name=rate`` pairs, where the name is an
+            endpoint (``audio.random_file``) or a blueprint (``audio``) and the
+            rate is the fraction of requests to log
+
+    Returns:
+        Dict[str, float]: Rate by endpoint or blueprint name
+
+    Raises:
+        ValueError: If a pair is malformed or a rate is outside [0, 1]
+    """
+    rates = {}
+    for pair in spec.split(','):
+        if not pair.strip():
+            continue
+        name, _, rate = pair.partition('=')
+        value = float(rate)
+        if not name.strip() or not 0.0 <= value <= 1.0:
+            raise ValueError(f"Invalid access log sample rate: {pair}")
+        rates[name.strip()] = value
+    return rates
+
+class AccessLog:
+    """
+    JSON lines access log written by a background thread.
+
+    Requests only put their record on a bounded queue; when the writer falls
+    behind, new records are dropped and counted rather than holding up
+    requests. The writer takes every record waiting at once, so a burst is
+    written with a single system call.
+
+    Every worker process appends to the same file. The file is rotated by
+    size under a lock, and the other processes notice the new file and
+    reopen it before their next write.
+    """
+
+    def __init__(self, path: Path, max_bytes: int = 0, backups: int = 5,
+                 sample_rates: Optional[Dict[str, float]] = None, queue_size: int = 10000, batch_size: int = 1000):
+        """
+        Args:
+            path (Path): The log file
+            max_bytes (int): Size at which the file is rotated, or 0 to never rotate
+            backups (int): Number of rotated files kept as ``<path>.1`` to ``<path>.<backups>``
+            sample_rates (Optional[Dict[str, float]]): Fraction of requests logged by endpoint or blueprint
+            queue_size (int): Records waiting for the writer before new ones are dropped
+            batch_size (int): Most records written at once
+        """
+        self.path = Path(path)
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.sample_rates = sample_rates or {}
+        self.batch_size = batch_size
+        self.dropped = 0
+        self._queue: queue.Queue = queue.Queue(queue_size)
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._pid: Optional[int] = None
+        self._fd: Optional[int] = None
+        self._inode = None
+
+    def sample_rate(self, endpoint: Optional[str]) -> float:
+        """
+        Get the fraction of requests to an endpoint that are logged.
+
+        Args:
+            endpoint (Optional[str]): The request's endpoint, or None if no route matched
+
+        Returns:
+            float: The rate of the endpoint, else of its blueprint, else 1
+        """
+        if not self.sample_rates or endpoint is None:
+            return 1.0
+        rate = self.sample_rates.get(endpoint)
+        if rate is None:
+            rate = self.sample_rates.get(endpoint.partition('.')[0], 1.0)
+        return rate
+
+    def log(self, record: Dict[str, Any]) -> None:
+        """
+        Queue a record for the writer without waiting for it.
+
+        Args:
+            record (Dict[str, Any]): JSON-serializable fields, with ``time`` in seconds since the epoch
+        """
+        if self._pid != os.getpid():
+            self._start_writer()
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def _start_writer(self) -> None:
+        """Start this process's writer; a forked process inherits the queue but not the thread."""
+        with self._lock:
+            pid = os.getpid()
+            if self._pid == pid:
+                return
+            if self._pid is not None:
+                # The inherited records were the parent's to write
+                self._queue = queue.Queue(self._queue.maxsize)
+                self._fd = None
+            self._thread = threading.Thread(target=self._run, args=(self._queue,), name="access-log", daemon=True)
+            self._thread.start()
+            self._pid = pid
+
+    def close(self, timeout: float = 5.0) -> None:
+        """Write the queued records and stop the writer."""
+        if self._pid != os.getpid() or self._thread is None:
+            return
+        try:
+            self._queue.put(None, timeout=timeout)
+        except queue.Full:
+            return
+        self._thread.join(timeout)
+
+    def _run(self, records: queue.Queue) -> None:
+        """Write batches of records until closed."""
+        stopping = False
+        while not stopping:
+            batch = [records.get()]
+            # Take whatever else is waiting so a burst is written at once
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(records.get_nowait())
+                except queue.Empty:
+                    break
+            if None in batch:
+                stopping = True
+                batch = [record for record in batch if record is not None]
+            if not batch:
+                continue
+            try:
+                self._write(self._encode(batch))
+            except (OSError, TypeError, ValueError):
+                logger.exception("Access log error, dropping %d records", len(batch))
+
+    @staticmethod
+    def _encode(batch: List[Dict[str, Any]]) -> bytes:
+        lines = []
+        for record in batch:
+            record['time'] = datetime.datetime.fromtimestamp(
+                record['time'], datetime.timezone.utc).isoformat(timespec='milliseconds')
+            lines.append(json.dumps(record, separators=(',', ':')))
+        lines.append('')
+        return '\n'.join(lines).encode()
+
+    def _write(self, data: bytes) -> None:
+        fd = self._open()
+        if self.max_bytes and os.fstat(fd).st_size + len(data) > self.max_bytes:
+            fd = self._rotate(len(data))
+        # O_APPEND keeps each process's batches whole when they write at the same time
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view):]
+
+    def _open(self) -> int:
+        """Get the open log file, reopening it if another process rotated it."""
+        if self._fd is not None:
+            try:
+                stat = os.stat(self.path)
+                if (stat.st_dev, stat.st_ino) == self._inode:
+                    return self._fd
+            except FileNotFoundError:
+                pass
+            os.close(self._fd)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        stat = os.fstat(self._fd)
+        self._inode = (stat.st_dev, stat.st_ino)
+        return self._fd
+
+    def _rotate(self, incoming: int) -> int:
+        """Move the log to its first backup, unless another process just did, and open a new one."""
+        with open(self.path.with_name(f"{self.path.name}.lock"), 'a') as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            fd = self._open()
+            size = os.fstat(fd).st_size
+            if size == 0 or size + incoming <= self.max_bytes:
+                return fd
+            for i in range(self.backups - 1, 0, -1):
+                backup = self.path.with_name(f"{self.path.name}.{i}")
+                if backup.exists():
+                    os.replace(backup, self.path.with_name(f"{self.path.name}.{i + 1}"))
+            if self.backups > 0:
+                os.replace(self.path, self.path.with_name(f"{self.path.name}.1"))
+            else:
+                os.unlink(self.path)
+            return self._open()
+
+def init_access_log(app: Flask) -> None:
+    """
+    Log a JSON line per request of an app to its ACCESS_LOG_PATH.
+
+    Each line has the route, status, latency until the response was sent,
+    bytes sent and the results of the cache lookups made for the request.
+    Successful requests are sampled at the rates in ACCESS_LOG_SAMPLE and
+    carry the rate they were sampled at; errors are always logged.
+
+    Args:
+        app (Flask): The Flask application
+    """
+    if not app.config.get('ACCESS_LOG'):
+        return
+    access_log = AccessLog(
+        app.config['ACCESS_LOG_PATH'],
+        app.config['ACCESS_LOG_MAX_BYTES'],
+        app.config['ACCESS_LOG_BACKUPS'],
+        parse_sample_rates(app.config['ACCESS_LOG_SAMPLE']),
+        app.config['ACCESS_LOG_QUEUE_SIZE']
+    )
+    app.extensions['randomfile_access_log'] = access_log
+    atexit.register(access_log.close)
+
+    @app.before_request
+    def start_access_log():
+        g.access_log_start = (time.time(), time.perf_counter())
+
+    @app.after_request
+    def log_request(response):
+        start = g.pop('access_log_start', None)
+        if start is None:
+            return response
+        status = response.status_code
+        rate = access_log.sample_rate(request.endpoint)
+        if status < 400 and rate < 1.0 and random.random() >= rate:
+            return response
+
+        record = {
+            'time': start[0],
+            'remote': request.remote_addr,
+            'method': request.method,
+            'path': request.path,
+            'query': request.query_string.decode('latin-1'),
+            'endpoint': request.endpoint,
+            'status': status,
+            'cache': g.get('cache_lookups') or {},
+            'user_agent': request.user_agent.string
+        }
+        if rate < 1.0:
+            record['sample_rate'] = rate
+        environ = request.environ
+
+        def finish() -> None:
+            record['status'] = environ.get(STATUS_ENVIRON, status)
+            record['duration_ms'] = round((time.perf_counter() - start[1]) * 1000, 3)
+            record['bytes'] = environ.get(BYTES_SENT_ENVIRON)
+            access_log.log(record)
+        on_response_sent(response, finish)
+        return response
@@ -1,8 +1,85 @@
+import json
 import os
+import subprocess
+import tempfile
 from pathlib import Path
 from pydub import AudioSegment
-from typing import List, Callable, Optional
-from flask import current_app
+from pydub.utils import get_prober_name
+from typing import Any, Dict, Iterator, List, Callable, Optional, Tuple
+from flask import current_app, has_app_context
+
+from randomfile.utils.conversion_engine import ConversionEngine, get_conversion_engine
+from randomfile.utils.metrics import FS_ENTRIES, FS_SCANS, FS_SCAN_SECONDS
+
+# List of supported formats for conversion to MP3
+SUPPORTED_FORMATS = ('.ogg', '.wav', '.flac', '.aac', '.m4a')
+
+# Formats that can be served, MP3 directly and the rest transcoded on the fly
+PLAYABLE_FORMATS = ('.mp3',) + SUPPORTED_FORMATS
+
+def get_engine() -> ConversionEngine:
+    """
+    Get the conversion engine, configured from the current app when there is one.
+
+    Returns:
+        ConversionEngine: The shared conversion engine
+    """
+    if has_app_context():
+        return get_conversion_engine(
+            current_app.config.get('CONVERSION_WORKERS'),
+            current_app.config.get('CONVERSION_TIMEOUT')
+        )
+    return get_conversion_engine()
+
+def find_audio_files(directory: Path, extensions: Tuple[str, ...]) -> List[str]:
+    """
+    Find all files with the given extensions in a directory including subdirectories.
+
+    Args:
+        directory (Path): The directory to scan
+        extensions (Tuple[str, ...]): Lowercase file extensions to look for (e.g. ('.ogg',))
+
+    Returns:
+        List[str]: Paths of the matching files
+    """
+    found = []
+    with FS_SCAN_SECONDS.time(scan='find_audio_files'):
+        for root, dirs, files in os.walk(directory):
+            FS_SCANS.inc(scan='find_audio_files')
+            FS_ENTRIES.inc(len(dirs) + len(files), scan='find_audio_files')
+            for file in files:
+                if file.lower().endswith(extensions):
+                    found.append(os.path.join(root, file))
+    return found
+
+def convert_audio_files(file_paths: List[str], output_format: str = 'mp3',
+                        progress_callback: Optional[Callable[[int, int], None]] = None,
+                        delete_originals: bool = False) -> Tuple[List[str], Dict[str, str]]:
+    """
+    Convert a batch of audio files in parallel on the conversion engine.
+
+    Args:
+        file_paths (List[str]): Paths of the audio files
+        output_format (str): Output format (default: 'mp3')
+        progress_callback (Optional[Callable[[int, int], None]]): A callback function to report progress
+            The callback receives (completed_files, total_files)
+        delete_originals (bool): Remove each source file after it is converted
+
+    Returns:
+        Tuple[List[str], Dict[str, str]]: The converted files and a mapping of
+            failed source file to error message
+    """
+    for file_path in file_paths:
+        file_extension = Path(file_path).suffix.lower()
+        if not supports_format(file_extension):
+            raise ValueError(f"Unsupported format: {file_extension}")
+
+    return get_engine().convert_batch(
+        [str(file_path) for file_path in file_paths],
+        output_format,
+        delete_originals=delete_originals,
+        progress_callback=progress_callback
+    )
 
 def convert_ogg_to_mp3(directory: Path, progress_callback: Optional[Callable[[int, int], None]] = None) -> List[str]:
     """
@@ -11,40 +88,22 @@ def convert_ogg_to_mp3(directory: Path, progress_callback: Optional[Callable[[in
     Args:
         directory (Path): The directory to scan for .ogg files
         progress_callback (Optional[Callable[[int, int], None]]): A callback function to report progress
-            The callback receives (current_file_index, total_files)
+            The callback receives (completed_files, total_files)
             
     Returns:
         List[str]: List of converted files
     """
     # Find all .ogg files
-    ogg_files = []
-    for root, _, files in os.walk(directory):
-        for file in files:
-            if file.lower().endswith('.ogg'):
-                ogg_files.append(os.path.join(root, file))
-    
-    converted_files = []
-    total_files = len(ogg_files)
+    ogg_files = find_audio_files(directory, ('.ogg',))
     
-    # Convert each file
-    for i, file_path in enumerate(ogg_files):
-        try:
-            # Report progress if callback provided
-            if progress_callback:
-                progress_callback(i + 1, total_files)
-                
-            # Convert the file
-            ogg = AudioSegment.from_ogg(file_path)
-            mp3_path = file_path.replace('.ogg', '.mp3')
-            ogg.export(mp3_path, format="mp3")
-            
-            # Remove the original file
-            os.remove(file_path)
-            
-            converted_files.append(mp3_path)
-        except Exception as e:
-            # Log the error but continue with other files
-            print(f"Error converting {file_path}: {str(e)}")
+    # Convert the files in parallel, removing each original once it is converted
+    converted_files, errors = convert_audio_files(
+        ogg_files, 'mp3', progress_callback=progress_callback, delete_originals=True
+    )
+
+    for file_path, error in errors.items():
+        # Log the error but keep the files that did convert
+        print(f"Error converting {file_path}: {error}")
     
     return converted_files
 
@@ -58,13 +117,124 @@ def supports_format(file_extension: str) -> bool:
     Returns:
         bool: True if the format is supported, False otherwise
     """
-    # List of supported formats for conversion to MP3
-    supported_formats = ['.ogg', '.wav', '.flac', '.aac', '.m4a']
-    return file_extension.lower() in supported_formats
+    return file_extension.lower() in SUPPORTED_FORMATS
+
+def is_playable(file_extension: str) -> bool:
+    """
+    Check if a file can be played, either directly or by transcoding it to MP3.
+
+    Args:
+        file_extension (str): The file extension to check (e.g., '.mp3', '.flac')
+
+    Returns:
+        bool: True if the file can be served as MP3, False otherwise
+    """
+    return file_extension.lower() in PLAYABLE_FORMATS
+
+# Bytes read from ffmpeg at a time; this bounds memory per conversion regardless of track length
+TRANSCODE_CHUNK_SIZE = 64 * 1024
+
+# ffmpeg muxer names for output formats whose extension differs
+_FFMPEG_MUXERS = {'m4a': 'ipod', 'aac': 'adts'}
+
+def stream_transcode(file_path: str, output_format: str = 'mp3',
+                     chunk_size: int = TRANSCODE_CHUNK_SIZE) -> Iterator[bytes]:
+    """
+    Transcode an audio file with ffmpeg and yield the output in chunks.
+
+    ffmpeg decodes and encodes incrementally, so only one chunk of output is
+    held in memory at a time. Closing the generator early stops ffmpeg.
+
+    Args:
+        file_path (str): Path to the audio file
+        output_format (str): Output format (default: 'mp3')
+        chunk_size (int): Maximum number of bytes per chunk
+
+    Yields:
+        bytes: The next chunk of encoded audio
+
+    Raises:
+        RuntimeError: If ffmpeg exits with an error
+    """
+    command = [
+        AudioSegment.converter, '-nostdin', '-v', 'error',
+        '-i', str(file_path), '-vn',
+        '-f', _FFMPEG_MUXERS.get(output_format, output_format), 'pipe:1'
+    ]
+    with tempfile.TemporaryFile() as stderr:
+        process = subprocess.Popen(command, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=stderr)
+        try:
+            while True:
+                chunk = process.stdout.read(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+
+            if process.wait() != 0:
+                stderr.seek(0)
+                message = stderr.read()[-1000:].decode(errors='replace').strip()
+                raise RuntimeError(f"ffmpeg failed: {message or process.returncode}")
+        finally:
+            # Stop ffmpeg if the consumer went away or a timeout interrupted us
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+            process.stdout.close()
+
+# Seconds to wait for ffprobe before giving up on a file
+PROBE_TIMEOUT = 30
+
+def probe_audio_file(file_path: str) -> Dict[str, Any]:
+    """
+    Read the duration, stream parameters and tags of an audio file with ffprobe.
+
+    Args:
+        file_path (str): Path to the audio file
+
+    Returns:
+        Dict[str, Any]: duration (seconds), bitrate (bits per second), sample_rate,
+            channels, title, artist and album; values the file does not provide are None
+
+    Raises:
+        RuntimeError: If ffprobe cannot read the file
+    """
+    command = [
+        get_prober_name(), '-v', 'error', '-of', 'json',
+        '-show_format', '-show_streams', '-select_streams', 'a:0', str(file_path)
+    ]
+    result = subprocess.run(command, stdin=subprocess.DEVNULL, capture_output=True, timeout=PROBE_TIMEOUT)
+    if result.returncode != 0:
+        message = result.stderr[-1000:].decode(errors='replace').strip()
+        raise RuntimeError(f"ffprobe failed: {message or result.returncode}")
+
+    info = json.loads(result.stdout or b'{}')
+    fmt = info.get('format', {})
+    stream = (info.get('streams') or [{}])[0]
+    # ID3 tags live on the container, Vorbis comments on the stream; keys vary in case
+    tags = {key.lower(): value for key, value in {**stream.get('tags', {}), **fmt.get('tags', {})}.items()}
+
+    def number(value: Any, kind: type) -> Optional[Any]:
+        try:
+            return kind(float(value)) if kind is int else kind(value)
+        except (TypeError, ValueError):
+            return None
+
+    return {
+        "duration": number(fmt.get('duration', stream.get('duration')), float),
+        "bitrate": number(stream.get('bit_rate', fmt.get('bit_rate')), int),
+        "sample_rate": number(stream.get('sample_rate'), int),
+        "channels": number(stream.get('channels'), int),
+        "title": tags.get('title'),
+        "artist": tags.get('artist'),
+        "album": tags.get('album')
+    }
 
 def convert_audio_file(file_path: str, output_format: str = 'mp3') -> str:
     """
     Convert a single audio file to the specified format.
+
+    The audio is streamed through ffmpeg into a temporary file next to the
+    output, which is renamed into place once the conversion succeeds.
     
     Args:
         file_path (str): Path to the audio file
@@ -79,23 +249,18 @@ def convert_audio_file(file_path: str, output_format: str = 'mp3') -> str:
     if not supports_format(file_extension):
         raise ValueError(f"Unsupported format: {file_extension}")
     
-    # Determine the appropriate AudioSegment method based on file extension
-    if file_extension == '.ogg':
-        audio = AudioSegment.from_ogg(file_path)
-    elif file_extension == '.wav':
-        audio = AudioSegment.from_wav(file_path)
-    elif file_extension == '.flac':
-        audio = AudioSegment.from_file(file_path, format="flac")
-    elif file_extension in ['.aac', '.m4a']:
-        audio = AudioSegment.from_file(file_path, format="aac")
-    else:
-        # This should not happen due to the supports_format check
-        raise ValueError(f"Unsupported format: {file_extension}")
-    
     # Create output path
-    output_path = str(file_path.with_suffix(f'.{output_format}'))
+    output_path = file_path.with_suffix(f'.{output_format}')
     
-    # Export to the desired format
-    audio.export(output_path, format=output_format)
+    # Stream the converted audio to a temporary file, then move it into place
+    fd, temp_path = tempfile.mkstemp(dir=output_path.parent, prefix='.', suffix=f'.{output_format}.part')
+    try:
+        with os.fdopen(fd, 'wb') as output:
+            for chunk in stream_transcode(str(file_path), output_format):
+                output.write(chunk)
+        os.replace(temp_path, output_path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
     
-    return output_path
\ No newline at end of file
+    return str(output_path)
@@ -0,0 +1,701 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+from flask import Flask
+
+from randomfile.utils.audio_utils import probe_audio_file
+from randomfile.utils.library_index import CREATED, DELETED, LibraryIndex
+from randomfile.utils.mp3_seek import SeekTable
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    duration REAL,
+    bitrate INTEGER,
+    sample_rate INTEGER,
+    channels INTEGER,
+    title TEXT,
+    artist TEXT,
+    album TEXT,
+    error TEXT,
+    scanned_at REAL NOT NULL
+)
+"""
+
+# How often each file has been played, kept apart from the rescanned metadata
+_PLAYS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS plays (
+    path TEXT PRIMARY KEY,
+    count INTEGER NOT NULL,
+    last_played REAL NOT NULL
+)
+"""
+
+# Content hashes of files that share their size with another file, for finding duplicates
+_HASHES_SCHEMA = (
+    """CREATE TABLE IF NOT EXISTS hashes (
+        path TEXT PRIMARY KEY,
+        size INTEGER NOT NULL,
+        mtime_ns INTEGER NOT NULL,
+        sha256 TEXT NOT NULL
+    )""",
+    "CREATE INDEX IF NOT EXISTS hashes_sha256 ON hashes (sha256)",
+    "CREATE INDEX IF NOT EXISTS hashes_size ON hashes (size)",
+    "CREATE INDEX IF NOT EXISTS files_size ON files (size)"
+)
+
+# Seek tables of MP3 files, built when playback first starts part way through a file
+_SEEK_SCHEMA = """
+CREATE TABLE IF NOT EXISTS seek_tables (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    sample_rate INTEGER NOT NULL,
+    frame_samples INTEGER NOT NULL,
+    frames INTEGER NOT NULL,
+    step INTEGER NOT NULL,
+    offsets BLOB NOT NULL
+)
+"""
+
+# Text of a row's tags as indexed for search
+_TAGS_SQL = "coalesce({0}title, '') || ' ' || coalesce({0}artist, '') || ' ' || coalesce({0}album, '')"
+
+# Trigram index over paths and tags, kept in step with the files table by triggers
+_SEARCH_SCHEMA = (
+    "CREATE VIRTUAL TABLE search USING fts5(path, tags, tokenize='trigram')",
+    f"""CREATE TRIGGER files_search_insert AFTER INSERT ON files BEGIN
+        INSERT INTO search (rowid, path, tags) VALUES (new.rowid, new.path, {_TAGS_SQL.format('new.')});
+    END""",
+    """CREATE TRIGGER files_search_delete AFTER DELETE ON files BEGIN
+        DELETE FROM search WHERE rowid = old.rowid;
+    END""",
+    f"""CREATE TRIGGER files_search_update AFTER UPDATE OF path, title, artist, album ON files BEGIN
+        DELETE FROM search WHERE rowid = old.rowid;
+        INSERT INTO search (rowid, path, tags) VALUES (new.rowid, new.path, {_TAGS_SQL.format('new.')});
+    END""",
+    f"INSERT INTO search (rowid, path, tags) SELECT rowid, path, {_TAGS_SQL.format('')} FROM files"
+)
+
+# Shortest term the trigram index can match
+_MIN_TRIGRAM_TERM = 3
+
+# Columns returned for a file, in table order
+METADATA_FIELDS = ('path', 'size', 'mtime_ns', 'duration', 'bitrate', 'sample_rate', 'channels',
+                   'title', 'artist', 'album', 'error', 'scanned_at')
+
+# SQLite limits the number of parameters in one statement
+_BATCH_SIZE = 500
+
+class Catalog:
+    """
+    SQLite catalog of audio file metadata.
+
+    Files are keyed by their path relative to the library root, with '/' as
+    the separator. The size and mtime recorded with each entry tell the
+    scanner whether the file has to be probed again; files that are known
+    but not probed yet have a size of -1, and files waiting to be probed
+    again an mtime of -1. Paths and tags are indexed for
+    substring search with SQLite's FTS5 trigram tokenizer where the SQLite
+    library provides it. Content hashes are kept alongside, for the files
+    that may have duplicates, and so are the seek tables of MP3 files.
+    """
+
+    def __init__(self, db_path: Path):
+        """
+        Args:
+            db_path (Path): Location of the SQLite database
+        """
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        with closing(self._connect()) as conn, conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(_SCHEMA)
+            conn.execute(_PLAYS_SCHEMA)
+            for statement in _HASHES_SCHEMA:
+                conn.execute(statement)
+            conn.execute(_SEEK_SCHEMA)
+            self.has_search_index = self._create_search_index(conn)
+
+    @staticmethod
+    def _create_search_index(conn: sqlite3.Connection) -> bool:
+        """
+        Create the search index unless it exists, filling it from the files table.
+
+        Returns:
+            bool: False if this SQLite build lacks FTS5 trigram support
+        """
+        if conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'search'").fetchone():
+            return True
+        try:
+            for statement in _SEARCH_SCHEMA:
+                conn.execute(statement)
+        except sqlite3.OperationalError:
+            # Searches fall back to scanning the paths
+            conn.rollback()
+            return False
+        return True
+
+    def _connect(self) -> sqlite3.Connection:
+        """Open a connection to the catalog database."""
+        conn = sqlite3.connect(str(self.db_path), timeout=30)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def get(self, rel_path: str) -> Optional[Dict[str, Any]]:
+        """
+        Get the metadata of a file.
+
+        Args:
+            rel_path (str): File path relative to the library root
+
+        Returns:
+            Optional[Dict[str, Any]]: The metadata, or None if the file has not been scanned
+        """
+        with closing(self._connect()) as conn:
+            row = conn.execute("SELECT * FROM files WHERE path = ? AND size >= 0", (rel_path,)).fetchone()
+        return dict(row) if row is not None else None
+
+    def get_many(self, rel_paths: Iterable[str]) -> Dict[str, Dict[str, Any]]:
+        """
+        Get the metadata of several files.
+
+        Args:
+            rel_paths (Iterable[str]): File paths relative to the library root
+
+        Returns:
+            Dict[str, Dict[str, Any]]: Metadata by path for the files that have been scanned
+        """
+        rel_paths = list(rel_paths)
+        found = {}
+        with closing(self._connect()) as conn:
+            for i in range(0, len(rel_paths), _BATCH_SIZE):
+                batch = rel_paths[i:i + _BATCH_SIZE]
+                placeholders = ", ".join("?" * len(batch))
+                for row in conn.execute(f"SELECT * FROM files WHERE path IN ({placeholders}) AND size >= 0", batch):
+                    found[row['path']] = dict(row)
+        return found
+
+    def fingerprints(self) -> Dict[str, Tuple[int, int]]:
+        """
+        Get the size and mtime recorded for every file.
+
+        Returns:
+            Dict[str, Tuple[int, int]]: (size, mtime_ns) by path
+        """
+        with closing(self._connect()) as conn:
+            return {row[0]: (row[1], row[2]) for row in conn.execute("SELECT path, size, mtime_ns FROM files")}
+
+    def upsert(self, records: Iterable[Dict[str, Any]]) -> None:
+        """
+        Insert or replace file metadata.
+
+        Args:
+            records (Iterable[Dict[str, Any]]): Metadata with a value for every field in METADATA_FIELDS
+        """
+        columns = ", ".join(METADATA_FIELDS)
+        placeholders = ", ".join("?" * len(METADATA_FIELDS))
+        # An upsert rather than INSERT OR REPLACE, so the search triggers see an update
+        updates = ", ".join(f"{field} = excluded.{field}" for field in METADATA_FIELDS if field != 'path')
+        with closing(self._connect()) as conn, conn:
+            conn.executemany(
+                f"INSERT INTO files ({columns}) VALUES ({placeholders}) ON CONFLICT (path) DO UPDATE SET {updates}",
+                [tuple(record[field] for field in METADATA_FIELDS) for record in records]
+            )
+
+    def add_pending(self, rel_paths: Iterable[str]) -> None:
+        """
+        Record files that have to be probed, making new ones searchable right away.
+
+        Files already in the catalog keep their metadata until they are probed again.
+
+        Args:
+            rel_paths (Iterable[str]): File paths relative to the library root
+        """
+        now = time.time()
+        with closing(self._connect()) as conn, conn:
+            conn.executemany(
+                "INSERT INTO files (path, size, mtime_ns, scanned_at) VALUES (?, -1, -1, ?) "
+                "ON CONFLICT (path) DO UPDATE SET mtime_ns = -1",
+                [(rel_path, now) for rel_path in rel_paths]
+            )
+
+    def pending(self) -> List[str]:
+        """
+        Get the files waiting to be probed.
+
+        Returns:
+            List[str]: File paths relative to the library root
+        """
+        with closing(self._connect()) as conn:
+            return [row[0] for row in conn.execute("SELECT path FROM files WHERE mtime_ns = -1")]
+
+    def record_changes(self, index: LibraryIndex, changes: Iterable[Tuple[str, str]]) -> None:
+        """
+        Record changes already applied to the library index, so the scanner probes just the files involved.
+
+        Args:
+            index (LibraryIndex): The updated library index
+            changes (Iterable[Tuple[str, str]]): (CREATED or DELETED, relative path) pairs
+        """
+        changes = list(changes)
+        self.remove_trees(rel_path for operation, rel_path in changes if operation == DELETED)
+        created = []
+        for operation, rel_path in changes:
+            if operation != CREATED:
+                continue
+            if index.directory(rel_path) is not None:
+                created.extend(index.files(rel_path))
+            elif rel_path.lower().endswith(index.extensions):
+                created.append(rel_path)
+        self.add_pending(created)
+
+    def remove(self, rel_paths: Iterable[str]) -> None:
+        """
+        Forget files that no longer exist.
+
+        Args:
+            rel_paths (Iterable[str]): File paths relative to the library root
+        """
+        rel_paths = list(rel_paths)
+        with closing(self._connect()) as conn, conn:
+            for i in range(0, len(rel_paths), _BATCH_SIZE):
+                batch = rel_paths[i:i + _BATCH_SIZE]
+                placeholders = ", ".join("?" * len(batch))
+                for table in ('files', 'hashes', 'seek_tables'):
+                    conn.execute(f"DELETE FROM {table} WHERE path IN ({placeholders})", batch)
+
+    def remove_trees(self, rel_paths: Iterable[str]) -> None:
+        """
+        Forget files and directories that no longer exist, including everything below them.
+
+        Args:
+            rel_paths (Iterable[str]): File or directory paths relative to the library root
+        """
+        with closing(self._connect()) as conn, conn:
+            for rel_path in rel_paths:
+                # '0' sorts right after '/', so the range covers exactly the paths below rel_path
+                for table in ('files', 'hashes', 'seek_tables'):
+                    conn.execute(
+                        f"DELETE FROM {table} WHERE path = ? OR (path >= ? AND path < ?)",
+                        (rel_path, f"{rel_path}/", f"{rel_path}0")
+                    )
+
+    def record_play(self, rel_path: str) -> None:
+        """
+        Count a play of a file.
+
+        Args:
+            rel_path (str): File path relative to the library root
+        """
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                "INSERT INTO plays (path, count, last_played) VALUES (?, 1, ?) "
+                "ON CONFLICT (path) DO UPDATE SET count = count + 1, last_played = excluded.last_played",
+                (rel_path, time.time())
+            )
+
+    def play_counts(self) -> Dict[str, int]:
+        """
+        Get how often each file has been played.
+
+        Returns:
+            Dict[str, int]: Play count by path for files played at least once
+        """
+        with closing(self._connect()) as conn:
+            return dict(conn.execute("SELECT path, count FROM plays"))
+
+    def durations(self) -> Dict[str, float]:
+        """
+        Get the duration of every probed file.
+
+        Returns:
+            Dict[str, float]: Duration in seconds by path
+        """
+        with closing(self._connect()) as conn:
+            return dict(conn.execute("SELECT path, duration FROM files WHERE duration IS NOT NULL"))
+
+    def hashes(self, rel_paths: Optional[Iterable[str]] = None) -> Dict[str, Tuple[int, int, str]]:
+        """
+        Get recorded content hashes.
+
+        Args:
+            rel_paths (Optional[Iterable[str]]): Only get the hashes of these files (default: all)
+
+        Returns:
+            Dict[str, Tuple[int, int, str]]: (size, mtime_ns, sha256) by path
+        """
+        sql = "SELECT path, size, mtime_ns, sha256 FROM hashes"
+        with closing(self._connect()) as conn:
+            if rel_paths is None:
+                return {row[0]: (row[1], row[2], row[3]) for row in conn.execute(sql)}
+            rel_paths = list(rel_paths)
+            found = {}
+            for i in range(0, len(rel_paths), _BATCH_SIZE):
+                batch = rel_paths[i:i + _BATCH_SIZE]
+                for row in conn.execute(f"{sql} WHERE path IN ({', '.join('?' * len(batch))})", batch):
+                    found[row[0]] = (row[1], row[2], row[3])
+            return found
+
+    def set_hashes(self, records: Iterable[Tuple[str, int, int, str]]) -> None:
+        """
+        Record content hashes.
+
+        Args:
+            records (Iterable[Tuple[str, int, int, str]]): (path, size, mtime_ns, sha256) of each file
+        """
+        with closing(self._connect()) as conn, conn:
+            conn.executemany("INSERT OR REPLACE INTO hashes (path, size, mtime_ns, sha256) VALUES (?, ?, ?, ?)",
+                             list(records))
+
+    def remove_hashes(self, rel_paths: Iterable[str]) -> None:
+        """
+        Forget the content hashes of files.
+
+        Args:
+            rel_paths (Iterable[str]): File paths relative to the library root
+        """
+        rel_paths = list(rel_paths)
+        with closing(self._connect()) as conn, conn:
+            for i in range(0, len(rel_paths), _BATCH_SIZE):
+                batch = rel_paths[i:i + _BATCH_SIZE]
+                conn.execute(f"DELETE FROM hashes WHERE path IN ({', '.join('?' * len(batch))})", batch)
+
+    def seek_table(self, rel_path: str, size: int, mtime_ns: int) -> Optional[SeekTable]:
+        """
+        Get the seek table of an MP3 file.
+
+        Args:
+            rel_path (str): File path relative to the library root
+            size (int): The file's current size
+            mtime_ns (int): The file's current mtime
+
+        Returns:
+            Optional[SeekTable]: The seek table, or None if there is none for this version of the file
+        """
+        with closing(self._connect()) as conn:
+            row = conn.execute(
+                "SELECT sample_rate, frame_samples, frames, step, offsets FROM seek_tables "
+                "WHERE path = ? AND size = ? AND mtime_ns = ?", (rel_path, size, mtime_ns)
+            ).fetchone()
+        if row is None:
+            return None
+        offsets = array('Q')
+        offsets.frombytes(row['offsets'])
+        return SeekTable(row['sample_rate'], row['frame_samples'], row['frames'], row['step'], offsets)
+
+    def set_seek_table(self, rel_path: str, size: int, mtime_ns: int, table: SeekTable) -> None:
+        """
+        Record the seek table of an MP3 file.
+
+        Args:
+            rel_path (str): File path relative to the library root
+            size (int): The size of the file that was scanned
+            mtime_ns (int): The mtime of the file that was scanned
+            table (SeekTable): The seek table
+        """
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO seek_tables (path, size, mtime_ns, sample_rate, frame_samples, frames, step, "
+                "offsets) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (rel_path, size, mtime_ns, table.sample_rate, table.frame_samples, table.frames, table.step,
+                 table.offsets.tobytes())
+            )
+
+    def files_with_size(self, size: int) -> List[str]:
+        """
+        Get the files known to have a given size.
+
+        Args:
+            size (int): Size in bytes
+
+        Returns:
+            List[str]: File paths relative to the library root
+        """
+        with closing(self._connect()) as conn:
+            return [row[0] for row in conn.execute(
+                "SELECT path FROM files WHERE size = ? UNION SELECT path FROM hashes WHERE size = ?", (size, size)
+            )]
+
+    def duplicate_groups(self, rel_dir: str = '', limit: int = 100, offset: int = 0) -> List[Dict[str, Any]]:
+        """
+        Get groups of files with identical content, those wasting the most space first.
+
+        Args:
+            rel_dir (str): Only consider files below this directory ('' for the whole library)
+            limit (int): Maximum number of groups
+            offset (int): Number of groups to skip
+
+        Returns:
+            List[Dict[str, Any]]: sha256, size and sorted paths of each group
+        """
+        condition, params = "", []
+        if rel_dir:
+            condition = "WHERE path >= ? AND path < ?"
+            params = [f"{rel_dir}/", f"{rel_dir}0"]
+        sql = (f"SELECT sha256, size, group_concat(path, char(0)) AS paths FROM hashes {condition} "
+               "GROUP BY sha256 HAVING count(*) > 1 ORDER BY size * (count(*) - 1) DESC, sha256 LIMIT ? OFFSET ?")
+        with closing(self._connect()) as conn:
+            return [
+                {'sha256': row['sha256'], 'size': row['size'], 'paths': sorted(row['paths'].split('\0'))}
+                for row in conn.execute(sql, (*params, limit, offset))
+            ]
+
+    def copy_counts(self) -> Dict[str, int]:
+        """
+        Get how many copies of its content each duplicated file has.
+
+        Returns:
+            Dict[str, int]: Number of files with the same content by path, for files that have duplicates
+        """
+        with closing(self._connect()) as conn:
+            return dict(conn.execute(
+                "SELECT h.path, d.copies FROM hashes h JOIN "
+                "(SELECT sha256, count(*) AS copies FROM hashes GROUP BY sha256 HAVING copies > 1) d USING (sha256)"
+            ))
+
+    def search(self, query: str, rel_dir: str = '', limit: int = 50) -> List[Dict[str, Any]]:
+        """
+        Find files whose path or tags contain every term of a query, ignoring case.
+
+        Args:
+            query (str): Whitespace-separated search terms
+            rel_dir (str): Only search below this directory ('' for the whole library)
+            limit (int): Maximum number of results
+
+        Returns:
+            List[Dict[str, Any]]: Path, duration and tags of the matching files
+        """
+        terms = query.split()
+        if not terms:
+            return []
+
+        # Terms long enough for the trigram index narrow the candidates, the rest filter them
+        indexed = [term for term in terms if len(term) >= _MIN_TRIGRAM_TERM] if self.has_search_index else []
+        conditions = []
+        params: List[Any] = []
+        if indexed:
+            conditions.append("search MATCH ?")
+            params.append(" AND ".join('"' + term.replace('"', '""') + '"' for term in indexed))
+        for term in terms:
+            if term not in indexed:
+                escaped = term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+                conditions.append(
+                    "(f.path LIKE ? ESCAPE '\\' OR f.title LIKE ? ESCAPE '\\' "
+                    "OR f.artist LIKE ? ESCAPE '\\' OR f.album LIKE ? ESCAPE '\\')"
+                )
+                params.extend([f"%{escaped}%"] * 4)
+        if rel_dir:
+            conditions.append("f.path >= ? AND f.path < ?")
+            params.extend([f"{rel_dir}/", f"{rel_dir}0"])
+
+        source = "search JOIN files f ON f.rowid = search.rowid" if indexed else "files f"
+        sql = (f"SELECT f.path, f.duration, f.title, f.artist, f.album FROM {source} "
+               f"WHERE {' AND '.join(conditions)} LIMIT ?")
+        with closing(self._connect()) as conn:
+            return [dict(row) for row in conn.execute(sql, (*params, limit))]
+
+class CatalogScanner:
+    """
+    Keeps the catalog in step with the library index.
+
+    Files changed through the app or seen by the library watcher are
+    recorded as pending in the catalog, and the scanner probes just those
+    soon after. Every ``interval`` seconds a full pass stats every indexed
+    file and probes those that are new or whose size or mtime changed,
+    catching whatever was missed, such as files rewritten in place while
+    only polling. Files are probed several at a time, and only one process
+    per host scans.
+    """
+
+    # Seconds between checks of the index generation
+    CHECK_INTERVAL = 2.0
+
+    def __init__(self, catalog: Catalog, index: LibraryIndex, interval: float = 300, workers: int = 4,
+                 on_pass: Optional[Callable[[Optional[List[str]]], Any]] = None):
+        """
+        Args:
+            catalog (Catalog): The catalog to fill
+            index (LibraryIndex): The library index listing the files to scan
+            interval (float): Maximum seconds between passes
+            workers (int): Number of files probed at the same time
+            on_pass (Optional[Callable[[Optional[List[str]]], Any]]): Further work run after each pass that
+                changed the catalog, e.g. hashing for deduplication; it receives the files probed, or None
+                after a full pass
+        """
+        self.catalog = catalog
+        self.index = index
+        self.interval = interval
+        self.workers = workers
+        self.on_pass = on_pass
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        """Start scanning in a background thread."""
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="catalog-scanner", daemon=True)
+            self._thread.start()
+
+    def stop(self) -> None:
+        """Stop scanning."""
+        self._stop.set()
+
+    def _run(self) -> None:
+        """Wait to become the host's scanner, then scan until stopped."""
+        with open(f"{self.catalog.db_path}.scan", 'w') as lock_file:
+            while fcntl and not self._stop.is_set():
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except OSError:
+                    self._stop.wait(self.CHECK_INTERVAL)
+
+            last_pass = None
+            while not self._stop.is_set():
+                try:
+                    if last_pass is None or time.monotonic() - last_pass >= self.interval:
+                        last_pass = time.monotonic()
+                        self.index.ensure_fresh()
+                        self.scan()
+                        if self.on_pass is not None:
+                            self.on_pass(None)
+                    else:
+                        probed = self.scan_pending()
+                        if probed and self.on_pass is not None:
+                            self.on_pass(probed)
+                except Exception:
+                    logger.exception("Error scanning the catalog")
+                self._stop.wait(self.CHECK_INTERVAL)
+
+    def _probe(self, rel_path: str, stat: os.stat_result) -> Dict[str, Any]:
+        """Build the catalog record of one file."""
+        record = {field: None for field in METADATA_FIELDS}
+        try:
+            record.update(probe_audio_file(str(self.index.base_path / rel_path)))
+        except Exception as e:
+            # Recorded so the file is not probed again until it changes
+            record['error'] = str(e)
+        record.update(path=rel_path, size=stat.st_size, mtime_ns=stat.st_mtime_ns, scanned_at=time.time())
+        return record
+
+    def scan(self) -> Tuple[int, int]:
+        """
+        Bring the catalog up to date with the files in the index.
+
+        Returns:
+            Tuple[int, int]: Number of files (probed, removed)
+        """
+        known = self.catalog.fingerprints()
+        seen = set()
+        changed: List[Tuple[str, os.stat_result]] = []
+        for rel_path in self.index.files():
+            seen.add(rel_path)
+            try:
+                stat = os.stat(self.index.base_path / rel_path)
+            except OSError:
+                continue
+            if known.get(rel_path) != (stat.st_size, stat.st_mtime_ns):
+                changed.append((rel_path, stat))
+
+        removed = [rel_path for rel_path in known if rel_path not in seen]
+        if removed:
+            self.catalog.remove(removed)
+        # New files become searchable before they are probed
+        self.catalog.add_pending(rel_path for rel_path, _ in changed if rel_path not in known)
+
+        self._probe_all(changed)
+        return len(changed), len(removed)
+
+    def _probe_all(self, items: List[Tuple[str, os.stat_result]]) -> None:
+        """Probe files several at a time and record their metadata."""
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="catalog-probe") as pool:
+            for i in range(0, len(items), _BATCH_SIZE):
+                if self._stop.is_set():
+                    break
+                batch = items[i:i + _BATCH_SIZE]
+                self.catalog.upsert(pool.map(lambda item: self._probe(*item), batch))
+
+    def scan_pending(self) -> List[str]:
+        """
+        Probe the files recorded as pending, without looking at the rest of the library.
+
+        Returns:
+            List[str]: The files probed
+        """
+        changed: List[Tuple[str, os.stat_result]] = []
+        removed = []
+        for rel_path in self.catalog.pending():
+            try:
+                stat = os.stat(self.index.base_path / rel_path)
+            except FileNotFoundError:
+                removed.append(rel_path)
+                continue
+            except OSError:
+                continue
+            changed.append((rel_path, stat))
+
+        if removed:
+            self.catalog.remove(removed)
+        self._probe_all(changed)
+        return [rel_path for rel_path, _ in changed]
+
+def get_catalog(app: Flask) -> Catalog:
+    """
+    Get the metadata catalog for an application, creating it on first use.
+
+    Args:
+        app (Flask): The Flask application
+
+    Returns:
+        Catalog: The catalog
+    """
+    catalog = app.extensions.get('randomfile_catalog')
+    if catalog is None:
+        catalog = Catalog(app.config['CATALOG_DB_PATH'])
+        app.extensions['randomfile_catalog'] = catalog
+    return catalog
+
+# One scanner per catalog database in this process
+_scanners: Dict[Path, CatalogScanner] = {}
+
+def start_scanner(catalog: Catalog, index: LibraryIndex, interval: float = 300, workers: int = 4,
+                  on_pass: Optional[Callable[[Optional[List[str]]], Any]] = None) -> CatalogScanner:
+    """
+    Start filling a catalog from a library index, unless this process already does.
+
+    Args:
+        catalog (Catalog): The catalog to fill
+        index (LibraryIndex): The library index listing the files to scan
+        interval (float): Maximum seconds between passes
+        workers (int): Number of files probed at the same time
+        on_pass (Optional[Callable[[Optional[List[str]]], Any]]): Further work run after each pass,
+            given the files probed or None after a full pass
+
+    Returns:
+        CatalogScanner: The scanner
+    """
+    scanner = _scanners.get(catalog.db_path)
+    if scanner is None:
+        scanner = CatalogScanner(catalog, index, interval, workers, on_pass)
+        _scanners[catalog.db_path] = scanner
+    scanner.start()
+    return scanner
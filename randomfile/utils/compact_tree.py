@@ -0,0 +1,193 @@
+import os
+import threading
+from array import array
+from typing import Any, Dict, List, Optional, Tuple
+
+def _display_key(name: bytes) -> Tuple[str, bytes]:
+    """Sort key putting names in display order: case-insensitively, ties broken by their bytes."""
+    return name.decode('utf-8', 'surrogateescape').lower(), name
+
+class CompactTree:
+    """
+    Directory tree over a library index snapshot.
+
+    The snapshot already stores the tree as flat arrays: directories in
+    depth-first order with the ranges of their subdirectories and files,
+    and every name once in its memory-mapped string table, shared by all
+    processes. This adds what browsing needs on top of it: each directory's
+    parent, and its children in display order, sorted on first use.
+    Nothing else is copied onto the heap.
+
+    Nodes are read through TreeNode views, and the nested dictionaries of
+    the tree API are only built for the part of the tree a request asks for.
+    """
+
+    def __init__(self, snapshot: Any):
+        """
+        Args:
+            snapshot: The library index snapshot
+        """
+        self.snapshot = snapshot
+        self._parents: Optional[array] = None
+        # Directory -> (subdirectories, files) in display order
+        self._children: Dict[int, Tuple[array, array]] = {}
+        self._lock = threading.Lock()
+
+    def dir_name(self, d: int) -> bytes:
+        """Get the name of a directory, b'' for the root."""
+        snapshot = self.snapshot
+        key = snapshot.strings[snapshot.dir_offsets[d]:snapshot.dir_offsets[d + 1]].tobytes()
+        return key[key.rfind(b'\0') + 1:]
+
+    def file_name(self, i: int) -> bytes:
+        """Get the name of a file."""
+        snapshot = self.snapshot
+        path = snapshot.strings[snapshot.file_offsets[i]:snapshot.file_offsets[i + 1]].tobytes()
+        return path[path.rfind(b'/') + 1:]
+
+    def parent(self, d: int) -> int:
+        """Get the parent of a directory, -1 for the root."""
+        parents = self._parents
+        if parents is None:
+            with self._lock:
+                if self._parents is None:
+                    parents = array('i', [-1]) * self.snapshot.n_dirs
+                    for p in range(self.snapshot.n_dirs):
+                        for child in self.snapshot.child_dirs(p):
+                            parents[child] = p
+                    self._parents = parents
+                parents = self._parents
+        return parents[d]
+
+    def file_parent(self, i: int) -> int:
+        """Get the directory holding a file."""
+        snapshot = self.snapshot
+        # Directories are in depth-first order, so the last one starting at or before the file holds it
+        lo, hi = 0, snapshot.n_dirs
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if snapshot.dir_starts[mid] <= i:
+                lo = mid + 1
+            else:
+                hi = mid
+        d = lo - 1
+        while not snapshot.dir_starts[d] <= i < snapshot.dir_files_end[d]:
+            d = self.parent(d)
+        return d
+
+    def children(self, d: int) -> Tuple[array, array]:
+        """Get the subdirectories and files of a directory in display order."""
+        children = self._children.get(d)
+        if children is None:
+            snapshot = self.snapshot
+            subdirs = sorted(snapshot.child_dirs(d), key=lambda child: _display_key(self.dir_name(child)))
+            files = sorted(range(snapshot.dir_starts[d], snapshot.dir_files_end[d]),
+                           key=lambda i: _display_key(self.file_name(i)))
+            children = self._children[d] = (array('I', subdirs), array('I', files))
+        return children
+
+    def directory(self, d: int) -> 'TreeNode':
+        """
+        Get the view of a directory.
+
+        Args:
+            d (int): The directory's number in the snapshot
+
+        Returns:
+            TreeNode: The directory
+        """
+        return TreeNode(self, d, True)
+
+class TreeNode:
+    """View of a directory or file in a CompactTree."""
+    __slots__ = ('tree', 'id', 'is_dir')
+
+    def __init__(self, tree: CompactTree, node_id: int, is_dir: bool):
+        self.tree = tree
+        self.id = node_id
+        self.is_dir = is_dir
+
+    @property
+    def name(self) -> str:
+        """The node's name, '' for the root."""
+        name = self.tree.dir_name(self.id) if self.is_dir else self.tree.file_name(self.id)
+        return name.decode('utf-8', 'surrogateescape')
+
+    @property
+    def parent(self) -> Optional['TreeNode']:
+        """The directory holding the node, None for the root."""
+        parent = self.tree.parent(self.id) if self.is_dir else self.tree.file_parent(self.id)
+        return TreeNode(self.tree, parent, True) if parent >= 0 else None
+
+    def parts(self) -> List[str]:
+        """Get the names of the directories leading to the node and the node's own, the root excluded."""
+        parts = []
+        node: Optional[TreeNode] = self
+        while node is not None and not (node.is_dir and node.id == 0):
+            parts.append(node.name)
+            node = node.parent
+        parts.reverse()
+        return parts
+
+    @property
+    def path(self) -> str:
+        """The node's path relative to the library root, '' for the root."""
+        return '/'.join(self.parts())
+
+    def subdirs(self) -> List['TreeNode']:
+        """Get the immediate subdirectories in display order."""
+        if not self.is_dir:
+            return []
+        return [TreeNode(self.tree, d, True) for d in self.tree.children(self.id)[0]]
+
+    def files(self) -> List['TreeNode']:
+        """Get the directory's own files in display order."""
+        if not self.is_dir:
+            return []
+        return [TreeNode(self.tree, i, False) for i in self.tree.children(self.id)[1]]
+
+    @property
+    def has_children(self) -> bool:
+        """Whether the directory holds any subdirectory or file."""
+        snapshot = self.tree.snapshot
+        d = self.id
+        return self.is_dir and (d + 1 < snapshot.dir_subdirs[d] or snapshot.dir_starts[d] < snapshot.dir_files_end[d])
+
+    def to_dict(self, expand: Optional[str] = None, rel_path: Optional[str] = None) -> Dict[str, Any]:
+        """
+        Build the tree API's representation of the node.
+
+        Only directories on the way to ``expand`` get their children loaded;
+        every other directory is returned collapsed. Passing None as
+        ``expand`` loads the whole subtree.
+
+        Args:
+            expand (Optional[str]): Relative path to expand towards, or None for everything
+            rel_path (Optional[str]): The node's relative path, if already known
+
+        Returns:
+            Dict[str, Any]: The node with its name, path, type and, for
+                directories, whether it has and has loaded its children
+        """
+        if rel_path is None:
+            rel_path = self.path
+        name = rel_path.rpartition('/')[2]
+        if not self.is_dir:
+            return {"name": name, "path": rel_path.replace('/', os.sep), "type": "file"}
+
+        node = {
+            "name": name or "Root",
+            "path": rel_path.replace('/', os.sep) or ".",
+            "type": "directory",
+            "has_children": self.has_children,
+            "loaded": False,
+            "children": []
+        }
+        if expand is not None and rel_path and expand != rel_path and not expand.startswith(rel_path + '/'):
+            return node
+
+        node["loaded"] = True
+        prefix = f"{rel_path}/" if rel_path else ""
+        node["children"] = [child.to_dict(expand, prefix + child.name) for child in self.subdirs()] + \
+            [child.to_dict(expand, prefix + child.name) for child in self.files()]
+        return node
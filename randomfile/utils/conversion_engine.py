@@ -0,0 +1,204 @@
+import multiprocessing
+import os
+import signal
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from typing import Callable, Dict, List, Optional, Tuple
+
+from randomfile.utils.metrics import CONVERSIONS, CONVERSION_SECONDS
+
+class ConversionTimeoutError(Exception):
+    """Exception raised when a single file takes longer than the per-file timeout."""
+    pass
+
+def _raise_timeout(signum, frame):
+    raise ConversionTimeoutError("Conversion timed out")
+
+def _convert_in_worker(file_path: str, output_format: str, delete_original: bool,
+                       timeout: Optional[float]) -> Tuple[str, float]:
+    """
+    Convert one file inside a pool process.
+
+    Args:
+        file_path (str): Path to the audio file
+        output_format (str): Output format
+        delete_original (bool): Remove the source file after a successful conversion
+        timeout (Optional[float]): Seconds allowed for this file, or None for no limit
+
+    Returns:
+        Tuple[str, float]: Path to the converted file and the seconds converting it took
+    """
+    from randomfile.utils.audio_utils import convert_audio_file
+
+    # Pool processes run tasks on their main thread, so an alarm can interrupt a stuck file
+    use_alarm = bool(timeout) and hasattr(signal, 'SIGALRM')
+    if use_alarm:
+        signal.signal(signal.SIGALRM, _raise_timeout)
+        signal.setitimer(signal.ITIMER_REAL, timeout)
+    start = time.perf_counter()
+    try:
+        output_path = convert_audio_file(file_path, output_format)
+    finally:
+        if use_alarm:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+    seconds = time.perf_counter() - start
+
+    if delete_original:
+        os.remove(file_path)
+    return output_path, seconds
+
+class ConversionEngine:
+    """
+    Converts batches of audio files on a pool of worker processes.
+
+    The pool is created on first use, so it is never inherited by processes
+    forked after the engine was constructed (e.g. gunicorn workers). If a
+    worker process dies, the pool is replaced and the files it took down
+    with it are converted again: those no process had started yet in one
+    batch, and those that might have crashed it split in half, one half
+    after the other, until the crashing file runs alone and only it fails.
+    """
+
+    def __init__(self, max_workers: Optional[int] = None, timeout: Optional[float] = None):
+        """
+        Args:
+            max_workers (Optional[int]): Number of worker processes (default: CPU count)
+            timeout (Optional[float]): Seconds allowed per file, or None for no limit
+        """
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.timeout = timeout
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._pid: Optional[int] = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        """Get the process pool, creating it in the current process if needed."""
+        with self._lock:
+            if self._executor is None or self._pid != os.getpid():
+                # Spawned workers do not inherit the web worker's threads and locks
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.max_workers,
+                    mp_context=multiprocessing.get_context('spawn')
+                )
+                self._pid = os.getpid()
+            return self._executor
+
+    def _discard(self, executor: ProcessPoolExecutor) -> None:
+        """Drop a broken process pool so the next batch creates a new one."""
+        with self._lock:
+            if self._executor is executor:
+                self._executor = None
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    def convert_batch(self, file_paths: List[str], output_format: str = 'mp3',
+                      delete_originals: bool = False,
+                      progress_callback: Optional[Callable[[int, int], None]] = None
+                      ) -> Tuple[List[str], Dict[str, str]]:
+        """
+        Convert a batch of files in parallel.
+
+        Args:
+            file_paths (List[str]): Paths of the files to convert
+            output_format (str): Output format (default: 'mp3')
+            delete_originals (bool): Remove each source file after it is converted
+            progress_callback (Optional[Callable[[int, int], None]]): A callback function to report progress
+                The callback receives (completed_files, total_files) as each file finishes
+
+        Returns:
+            Tuple[List[str], Dict[str, str]]: The converted files and a mapping of
+                failed source file to error message
+        """
+        converted_files = []
+        errors = {}
+        total_files = len(file_paths)
+        completed = 0
+        # Groups of files still to convert, each run as one batch
+        groups = [[str(file_path) for file_path in file_paths]]
+
+        while groups:
+            batch = groups.pop()
+            executor = self._get_executor()
+            futures = {}
+            unsubmitted = []
+            for file_path in batch:
+                try:
+                    future = executor.submit(_convert_in_worker, file_path, output_format, delete_originals, self.timeout)
+                except BrokenProcessPool:
+                    # The pool broke before this file started, so it is not to blame
+                    unsubmitted.append(file_path)
+                else:
+                    futures[future] = file_path
+
+            broken = False
+            unfinished = []
+            for future in as_completed(futures):
+                file_path = futures[future]
+                try:
+                    output_path, seconds = future.result()
+                except BrokenProcessPool:
+                    broken = True
+                    if len(batch) > 1:
+                        unfinished.append(file_path)
+                        continue
+                    errors[file_path] = "The conversion process exited unexpectedly"
+                    CONVERSIONS.inc(kind='batch', outcome='failed')
+                except Exception as e:
+                    errors[file_path] = str(e) or type(e).__name__
+                    CONVERSIONS.inc(kind='batch', outcome='failed')
+                else:
+                    converted_files.append(output_path)
+                    # Pool processes do not record metrics, so their timings are recorded here
+                    CONVERSIONS.inc(kind='batch', outcome='converted')
+                    CONVERSION_SECONDS.observe(seconds, kind='batch')
+
+                completed += 1
+                if progress_callback:
+                    progress_callback(completed, total_files)
+
+            if broken or unsubmitted:
+                self._discard(executor)
+            if unsubmitted:
+                groups.append(unsubmitted)
+            if unfinished:
+                # The pool hands files to its processes in submission order, keeping at most
+                # max_workers + 1 queued besides the running ones, so later files never started
+                position = {file_path: i for i, file_path in enumerate(batch)}
+                unfinished.sort(key=position.__getitem__)
+                window = 2 * self.max_workers + 1
+                suspects = unfinished[:window]
+                # Only one half holds the file that crashed the pool; the other finishes in parallel.
+                # The files no process started are converted first, as the groups are taken from the end
+                middle = len(suspects) // 2
+                groups.extend(group for group in (suspects[middle:], suspects[:middle], unfinished[window:]) if group)
+
+        return converted_files, errors
+
+    def shutdown(self) -> None:
+        """Stop the worker processes."""
+        with self._lock:
+            if self._executor is not None and self._pid == os.getpid():
+                self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+# One engine per process, configured from the first app that uses it
+_engine: Optional[ConversionEngine] = None
+_engine_lock = threading.Lock()
+
+def get_conversion_engine(max_workers: Optional[int] = None, timeout: Optional[float] = None) -> ConversionEngine:
+    """
+    Get the shared conversion engine, creating it on first use.
+
+    Args:
+        max_workers (Optional[int]): Number of worker processes (default: CPU count)
+        timeout (Optional[float]): Seconds allowed per file, or None for no limit
+
+    Returns:
+        ConversionEngine: The conversion engine
+    """
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            _engine = ConversionEngine(max_workers, timeout)
+        return _engine
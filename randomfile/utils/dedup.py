@@ -0,0 +1,272 @@
+import hashlib
+import os
+import uuid
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from randomfile.utils.catalog import Catalog
+from randomfile.utils.library_index import LibraryIndex
+
+# Bytes read from a file at a time while hashing
+_READ_SIZE = 1024 * 1024
+
+# Files hashed and recorded together
+_BATCH_SIZE = 500
+
+# Most files of the same size hashed to check a single upload for duplicates
+_MAX_UPLOAD_CANDIDATES = 16
+
+def hash_file(path: Path) -> str:
+    """
+    Compute the SHA-256 of a file.
+
+    Args:
+        path (Path): The file to hash
+
+    Returns:
+        str: The hash in hex
+    """
+    file_hash = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for data in iter(lambda: f.read(_READ_SIZE), b''):
+            file_hash.update(data)
+    return file_hash.hexdigest()
+
+class Deduplicator:
+    """
+    Finds files with identical content and collapses them into hard links.
+
+    Files are first grouped by size, which costs only a stat, and only files
+    that share their size with another file are hashed, several at a time.
+    Hashes are kept in the catalog with the size and mtime they were computed
+    for, so later passes hash only files that are new or changed, and files
+    that are already hard links of each other are hashed once.
+    """
+
+    def __init__(self, catalog: Catalog, index: LibraryIndex, workers: int = 4):
+        """
+        Args:
+            catalog (Catalog): The catalog holding the hashes
+            index (LibraryIndex): The library index listing the files
+            workers (int): Number of files hashed at the same time
+        """
+        self.catalog = catalog
+        self.index = index
+        self.workers = workers
+
+    def scan(self, rel_paths: Optional[Iterable[str]] = None) -> Tuple[int, int]:
+        """
+        Hash every file that may have a duplicate and is not hashed yet.
+
+        Sizes are taken from the catalog, which the catalog scanner has just
+        brought up to date, so only the files sharing their size with
+        another file are stat'ed again.
+
+        Args:
+            rel_paths (Optional[Iterable[str]]): Only look at files of the same sizes as these,
+                e.g. those just probed (default: the whole library)
+
+        Returns:
+            Tuple[int, int]: Number of files (hashed, with a recorded hash)
+        """
+        if rel_paths is None:
+            by_size: Dict[int, List[str]] = defaultdict(list)
+            for rel_path, (size, _) in self.catalog.fingerprints().items():
+                # Empty files are all identical and there is nothing to reclaim
+                if size > 0:
+                    by_size[size].append(rel_path)
+            groups = by_size.values()
+        else:
+            sizes = {record['size'] for record in self.catalog.get_many(rel_paths).values() if record['size'] > 0}
+            groups = [self.catalog.files_with_size(size) for size in sizes]
+        candidates = {rel_path for files in groups if len(files) > 1 for rel_path in files}
+        known = self.catalog.hashes(None if rel_paths is None else candidates)
+
+        # Files that share an inode have the same content, so one of them is hashed for all
+        pending: Dict[Tuple[int, int], List[Tuple[str, os.stat_result]]] = defaultdict(list)
+        for rel_path in candidates:
+            try:
+                stat = os.stat(self.index.base_path / rel_path)
+            except OSError:
+                continue
+            recorded = known.get(rel_path)
+            if recorded is None or recorded[:2] != (stat.st_size, stat.st_mtime_ns):
+                pending[(stat.st_dev, stat.st_ino)].append((rel_path, stat))
+
+        if rel_paths is None:
+            stale = [rel_path for rel_path in known if rel_path not in candidates]
+            if stale:
+                self.catalog.remove_hashes(stale)
+
+        def hash_inode(files: List[Tuple[str, os.stat_result]]) -> List[Tuple[str, int, int, str]]:
+            try:
+                digest = hash_file(self.index.base_path / files[0][0])
+            except OSError:
+                return []
+            return [(rel_path, stat.st_size, stat.st_mtime_ns, digest) for rel_path, stat in files]
+
+        groups = list(pending.values())
+        hashed = 0
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="dedup-hash") as pool:
+            for i in range(0, len(groups), _BATCH_SIZE):
+                records = [record for result in pool.map(hash_inode, groups[i:i + _BATCH_SIZE]) for record in result]
+                self.catalog.set_hashes(records)
+                hashed += len(records)
+
+        return hashed, len(candidates)
+
+    def duplicates(self, rel_dir: str = '', limit: int = 100, offset: int = 0) -> List[Dict[str, Any]]:
+        """
+        List groups of files with identical content, those wasting the most space first.
+
+        Args:
+            rel_dir (str): Only consider files below this directory ('' for the whole library)
+            limit (int): Maximum number of groups
+            offset (int): Number of groups to skip
+
+        Returns:
+            List[Dict[str, Any]]: sha256, size and paths of each group, and how many
+                bytes collapsing it into hard links would reclaim
+        """
+        groups = self.catalog.duplicate_groups(rel_dir, limit, offset)
+        for group in groups:
+            inodes = set()
+            for rel_path in group['paths']:
+                try:
+                    stat = os.stat(self.index.base_path / rel_path)
+                except OSError:
+                    continue
+                inodes.add((stat.st_dev, stat.st_ino))
+            group['reclaimable'] = group['size'] * max(0, len(inodes) - 1)
+        return groups
+
+    def collapse(self, sha256s: Optional[Iterable[str]] = None, rel_dir: str = '') -> Dict[str, Any]:
+        """
+        Replace duplicates with hard links to one copy, the first path of each group.
+
+        A file is only replaced if it has not changed since it was hashed and
+        lives on the same filesystem as the copy that is kept. Each file is
+        swapped for its link with an atomic rename.
+
+        Args:
+            sha256s (Optional[Iterable[str]]): Only collapse these groups (default: all)
+            rel_dir (str): Only consider files below this directory ('' for the whole library)
+
+        Returns:
+            Dict[str, Any]: Number of files linked, bytes reclaimed and errors by path
+        """
+        wanted = set(sha256s) if sha256s is not None else None
+        known = self.catalog.hashes()
+        linked = 0
+        reclaimed = 0
+        errors: Dict[str, str] = {}
+        records: List[Tuple[str, int, int, str]] = []
+
+        def unchanged(rel_path: str, stat: os.stat_result) -> bool:
+            recorded = known.get(rel_path)
+            return recorded is not None and recorded[:2] == (stat.st_size, stat.st_mtime_ns)
+
+        offset = 0
+        while True:
+            groups = self.catalog.duplicate_groups(rel_dir, _BATCH_SIZE, offset)
+            offset += len(groups)
+            for group in groups:
+                if wanted is not None and group['sha256'] not in wanted:
+                    continue
+                keep, *others = group['paths']
+                keep_path = self.index.base_path / keep
+                try:
+                    keep_stat = os.stat(keep_path)
+                except OSError as e:
+                    errors[keep] = str(e)
+                    continue
+                if not unchanged(keep, keep_stat):
+                    errors[keep] = "File changed since it was hashed"
+                    continue
+
+                for rel_path in others:
+                    path = self.index.base_path / rel_path
+                    try:
+                        stat = os.stat(path)
+                        if (stat.st_dev, stat.st_ino) == (keep_stat.st_dev, keep_stat.st_ino):
+                            continue
+                        if not unchanged(rel_path, stat):
+                            errors[rel_path] = "File changed since it was hashed"
+                            continue
+                        if stat.st_dev != keep_stat.st_dev:
+                            errors[rel_path] = "File is on another filesystem"
+                            continue
+                        link_path = path.parent / f".{uuid.uuid4().hex}.dedup.link"
+                        os.link(keep_path, link_path)
+                        try:
+                            os.replace(link_path, path)
+                        except OSError:
+                            link_path.unlink()
+                            raise
+                    except OSError as e:
+                        errors[rel_path] = str(e)
+                        continue
+                    linked += 1
+                    reclaimed += stat.st_size
+                    records.append((rel_path, keep_stat.st_size, keep_stat.st_mtime_ns, group['sha256']))
+            if len(groups) < _BATCH_SIZE:
+                break
+
+        # The links now carry the kept copy's mtime, so record that to avoid hashing them again
+        self.catalog.set_hashes(records)
+        return {'linked': linked, 'reclaimed': reclaimed, 'errors': errors}
+
+    def find_duplicate(self, size: int, sha256: str, exclude: Optional[str] = None) -> Optional[str]:
+        """
+        Find a file in the library with the given content.
+
+        Files of the same size whose hash is not recorded yet are hashed now,
+        up to a limit.
+
+        Args:
+            size (int): Size of the content in bytes
+            sha256 (str): SHA-256 of the content in hex
+            exclude (Optional[str]): A path to ignore, e.g. the file being checked
+
+        Returns:
+            Optional[str]: Path of an identical file relative to the library root, or None
+        """
+        if not size:
+            return None
+        candidates = [rel_path for rel_path in self.catalog.files_with_size(size) if rel_path != exclude]
+        known = self.catalog.hashes(candidates)
+        records = []
+        try:
+            # Files whose hash is recorded are compared first, since that costs nothing
+            candidates.sort(key=lambda rel_path: rel_path not in known)
+            for rel_path in candidates[:_MAX_UPLOAD_CANDIDATES]:
+                try:
+                    stat = os.stat(self.index.base_path / rel_path)
+                    recorded = known.get(rel_path)
+                    if recorded is not None and recorded[:2] == (stat.st_size, stat.st_mtime_ns):
+                        digest = recorded[2]
+                    elif stat.st_size == size:
+                        digest = hash_file(self.index.base_path / rel_path)
+                        records.append((rel_path, stat.st_size, stat.st_mtime_ns, digest))
+                    else:
+                        continue
+                except OSError:
+                    continue
+                if digest == sha256:
+                    return rel_path
+            return None
+        finally:
+            self.catalog.set_hashes(records)
+
+    def record(self, rel_path: str, sha256: str) -> None:
+        """
+        Record the hash of a file whose content is already known, e.g. a new upload.
+
+        Args:
+            rel_path (str): File path relative to the library root
+            sha256 (str): SHA-256 of the file in hex
+        """
+        stat = os.stat(self.index.base_path / rel_path)
+        self.catalog.set_hashes([(rel_path, stat.st_size, stat.st_mtime_ns, sha256)])
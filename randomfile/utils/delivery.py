@@ -0,0 +1,208 @@
+import io
+import os
+from pathlib import Path
+from typing import BinaryIO, Optional
+from urllib.parse import quote
+
+from flask import Response, current_app, request, send_file
+from werkzeug.wsgi import wrap_file
+
+# Supported values of the AUDIO_OFFLOAD setting
+OFFLOAD_X_ACCEL = 'x-accel'
+OFFLOAD_X_SENDFILE = 'x-sendfile'
+
+# Set in the WSGI environ by the ASGI adapter, which sends files itself without blocking
+ASGI_SENDFILE = 'randomfile.asgi_sendfile'
+
+# Header naming the file for the ASGI adapter to send, removed before the response leaves the process
+ASGI_SENDFILE_HEADER = 'X-Randomfile-Sendfile'
+
+# Header giving the offset in that file the response body starts at, removed along with it
+ASGI_SENDFILE_OFFSET_HEADER = 'X-Randomfile-Sendfile-Offset'
+
+def file_etag(stat: os.stat_result) -> str:
+    """
+    Build a strong validator for a file.
+
+    The inode, size and nanosecond mtime change whenever the file is replaced
+    or rewritten, so two responses with the same ETag carry identical bytes.
+
+    Args:
+        stat (os.stat_result): The file's stat result
+
+    Returns:
+        str: The unquoted ETag value
+    """
+    return f"{stat.st_ino:x}-{stat.st_size:x}-{stat.st_mtime_ns:x}"
+
+def _accel_uri(file_path: Path) -> Optional[str]:
+    """
+    Map a file to the internal proxy location configured for its directory.
+
+    Args:
+        file_path (Path): The file to send
+
+    Returns:
+        Optional[str]: The X-Accel-Redirect URI, or None if no location covers the file
+    """
+    for root, location in current_app.config.get('AUDIO_ACCEL_LOCATIONS', {}).items():
+        try:
+            rel_path = file_path.relative_to(root)
+        except ValueError:
+            continue
+        return location.rstrip('/') + '/' + quote(rel_path.as_posix())
+    return None
+
+class _FileFrom(io.RawIOBase):
+    """The part of an open file from an offset on, as a file of its own for answering byte ranges."""
+
+    def __init__(self, file: BinaryIO, offset: int):
+        super().__init__()
+        self.file = file
+        self.offset = offset
+        file.seek(offset)
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        return self.file.readinto(buffer)
+
+    def seek(self, pos: int, whence: int = os.SEEK_SET) -> int:
+        if whence == os.SEEK_SET:
+            pos += self.offset
+        return self.file.seek(pos, whence) - self.offset
+
+    def tell(self) -> int:
+        return self.file.tell() - self.offset
+
+    def close(self) -> None:
+        self.file.close()
+        super().close()
+
+def _offload_response(file_path: Path, offset: int = 0) -> Optional[Response]:
+    """
+    Build a header-only response asking the reverse proxy, or the ASGI adapter, to send a file.
+
+    Args:
+        file_path (Path): The file to send
+        offset (int): Byte offset the response body starts at
+
+    Returns:
+        Optional[Response]: The response, or None if offloading is disabled or not
+            configured for this file
+    """
+    offload = current_app.config.get('AUDIO_OFFLOAD')
+
+    if offset and offload in (OFFLOAD_X_ACCEL, OFFLOAD_X_SENDFILE):
+        # The proxies only send whole files and ranges the client asked for
+        offload = None
+
+    if offload == OFFLOAD_X_ACCEL:
+        uri = _accel_uri(file_path)
+        if uri is None:
+            return None
+        response = Response(mimetype="audio/mp3")
+        response.headers['X-Accel-Redirect'] = uri
+        return response
+
+    if offload == OFFLOAD_X_SENDFILE:
+        response = Response(mimetype="audio/mp3")
+        response.headers['X-Sendfile'] = str(file_path)
+        return response
+
+    if request.environ.get(ASGI_SENDFILE):
+        response = Response(mimetype="audio/mp3")
+        response.headers[ASGI_SENDFILE_HEADER] = str(file_path)
+        if offset:
+            response.headers[ASGI_SENDFILE_OFFSET_HEADER] = str(offset)
+        return response
+
+    return None
+
+def send_audio_file(file_path: Path, as_attachment: bool = False, download_name: Optional[str] = None,
+                    max_age: Optional[int] = None, offset: int = 0) -> Response:
+    """
+    Send an audio file with strong validators and byte-range support.
+
+    With AUDIO_OFFLOAD set, only headers are returned and the reverse proxy
+    streams the file itself (X-Accel-Redirect for nginx, X-Sendfile for
+    Apache/lighttpd), serving byte ranges without copying the bytes through
+    Python. Under the ASGI adapter the file is likewise left to the adapter,
+    which streams it on its event loop instead of holding a thread.
+
+    With an offset the body is the file from that byte on, a resource of
+    its own with its own validators and byte ranges. Servers with a
+    sendfile() file wrapper still send it without copying, as does the
+    ASGI adapter; the reverse proxies cannot start part way through a
+    file, so it is never offloaded to them.
+
+    Args:
+        file_path (Path): The file to send
+        as_attachment (bool): Send the file as a download
+        download_name (Optional[str]): File name presented to the client (default: the file's name)
+        max_age (Optional[int]): Seconds clients may cache the response without revalidating
+        offset (int): Byte offset the body starts at
+
+    Returns:
+        Response: The audio response
+    """
+    stat = file_path.stat()
+    etag = file_etag(stat) + (f"-{offset:x}" if offset else "")
+
+    response = _offload_response(file_path, offset)
+    if response is not None:
+        response.set_etag(etag)
+        response.last_modified = stat.st_mtime
+        response.headers['Accept-Ranges'] = 'bytes'
+        if as_attachment:
+            response.headers.set('Content-Disposition', 'attachment', filename=download_name or file_path.name)
+        if max_age:
+            response.cache_control.public = True
+            response.cache_control.max_age = max_age
+        # Answer revalidations here; the proxy or adapter only handles the byte ranges
+        response = response.make_conditional(request)
+        if response.status_code != 200:
+            # A 304 or 412 has no body, so nothing is left for the proxy or adapter to send
+            for header in ('X-Accel-Redirect', 'X-Sendfile', ASGI_SENDFILE_HEADER, ASGI_SENDFILE_OFFSET_HEADER):
+                response.headers.pop(header, None)
+        return response
+
+    if offset:
+        file = open(file_path, 'rb')
+        if request.range is not None:
+            # Werkzeug seeks to the start of a range, which counts from the offset
+            file = _FileFrom(file, offset)
+        else:
+            # The server's file wrapper sends from the current position, with sendfile() where it can
+            file.seek(offset)
+        try:
+            response = current_app.response_class(
+                wrap_file(request.environ, file), mimetype="audio/mp3", direct_passthrough=True)
+            response.content_length = max(0, stat.st_size - offset)
+            response.set_etag(etag)
+            response.last_modified = stat.st_mtime
+            if as_attachment:
+                response.headers.set('Content-Disposition', 'attachment', filename=download_name or file_path.name)
+            if max_age:
+                response.cache_control.public = True
+                response.cache_control.max_age = max_age
+            return response.make_conditional(request, accept_ranges=True, complete_length=response.content_length)
+        except BaseException:
+            file.close()
+            raise
+
+    # Werkzeug answers If-None-Match, If-Modified-Since, Range and If-Range for us
+    return send_file(
+        file_path,
+        mimetype="audio/mp3",
+        as_attachment=as_attachment,
+        download_name=download_name,
+        conditional=True,
+        etag=etag,
+        last_modified=stat.st_mtime,
+        max_age=max_age
+    )
@@ -1,9 +1,25 @@
+import base64
+import json
 import os
 import shutil
+import threading
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from itertools import chain
 from pathlib import Path
 from flask import current_app
-import random
-from typing import Dict, List, Tuple, Optional, Union, Any
+from werkzeug.utils import secure_filename
+from typing import Callable, Dict, List, Tuple, Optional, Union, Any
+
+from randomfile.utils.audio_utils import PLAYABLE_FORMATS
+from randomfile.utils.catalog import get_catalog
+from randomfile.utils.sampling import Sampler, get_shuffle_bags
+from randomfile.utils.library_index import LibraryIndex, get_library_index, CREATED, DELETED
+from randomfile.utils.uploads import UploadError, get_upload_store, link_file, publish, receive_stream
+from randomfile.utils.dedup import Deduplicator
+from randomfile.utils.jobs import COLLAPSE, get_job_store, start_collapse_job
+from randomfile.utils.mp3_seek import build_seek_table, find_frame
+from randomfile.utils.metrics import FS_ENTRIES, FS_SCANS, FS_SCAN_SECONDS, cache_lookup
 
 class PathValidationError(Exception):
     """Exception raised for path validation errors."""
@@ -42,6 +58,60 @@ def validate_path(path: Path) -> Tuple[bool, Optional[str]]:
 
     return True, None
 
+def get_index() -> LibraryIndex:
+    """
+    Get the library index for the configured base path.
+
+    Returns:
+        LibraryIndex: The shared library index
+    """
+    return get_library_index(
+        current_app.config['BASE_PATH'],
+        refresh_interval=current_app.config.get('LIBRARY_INDEX_REFRESH', 0),
+        extensions=PLAYABLE_FORMATS,
+        snapshot_path=current_app.config.get('LIBRARY_INDEX_PATH')
+    )
+
+def get_sampler() -> Sampler:
+    """
+    Get the random file sampler for the current app.
+
+    Returns:
+        Sampler: The sampler drawing from the shared library index
+    """
+    sampler = current_app.extensions.get('randomfile_sampler')
+    if sampler is None:
+        sampler = Sampler(get_index(), get_catalog(current_app), get_shuffle_bags(current_app))
+        current_app.extensions['randomfile_sampler'] = sampler
+    return sampler
+
+def get_deduplicator() -> Deduplicator:
+    """
+    Get the duplicate finder for the current app.
+
+    Returns:
+        Deduplicator: The deduplicator hashing the shared library index
+    """
+    deduplicator = current_app.extensions.get('randomfile_dedup')
+    if deduplicator is None:
+        deduplicator = Deduplicator(get_catalog(current_app), get_index(), current_app.config['DEDUP_HASH_WORKERS'])
+        current_app.extensions['randomfile_dedup'] = deduplicator
+    return deduplicator
+
+def update_index(*changes: Tuple[str, Path]) -> None:
+    """
+    Record changes made through the app in the library index and catalog without a rescan.
+
+    Args:
+        *changes (Tuple[str, Path]): (CREATED or DELETED, absolute path) pairs
+    """
+    rel_changes = [(operation, index_path(path)) for operation, path in changes]
+    index = get_index()
+    index.apply_changes(rel_changes)
+
+    # Keep search results in step; the catalog scanner probes the new files later
+    get_catalog(current_app).record_changes(index, rel_changes)
+
 def get_files_and_dirs(path: Path) -> Dict[str, List[str]]:
     """
     Get all files and directories in a path.
@@ -58,13 +128,13 @@ def get_files_and_dirs(path: Path) -> Dict[str, List[str]]:
     if not is_valid:
         raise PathValidationError(error)
 
-    result = {"dirs": [], "files": []}
-
-    for item in path.iterdir():
-        if item.is_dir():
-            result["dirs"].append(str(os.path.relpath(item, base_path)))
-        elif item.is_file() and item.suffix.lower() == '.mp3':
-            result["files"].append(str(os.path.relpath(item, base_path)))
+    # List the directory from the library index's compact tree instead of the disk
+    node = get_index().tree_node(os.path.relpath(path, base_path))
+    prefix = node.path.replace('/', os.sep) + os.sep if node is not None and node.id else ""
+    result = {
+        "dirs": [prefix + subdir.name for subdir in node.subdirs()] if node else [],
+        "files": [prefix + file.name for file in node.files()] if node else []
+    }
 
     # Sort the lists for a better user experience
     result["dirs"].sort()
@@ -72,32 +142,436 @@ def get_files_and_dirs(path: Path) -> Dict[str, List[str]]:
 
     return result
 
-def get_random_file(path: Path) -> Optional[Path]:
+# Sort orders supported by the listing API
+LISTING_SORTS = ('name', 'mtime', 'size')
+LISTING_MAX_PAGE_SIZE = 1000
+
+class _DirectoryListing:
+    """A directory's scandir entries and the sorted views built from them."""
+    __slots__ = ('mtime_ns', 'entries', 'views')
+
+    def __init__(self, mtime_ns: int, entries: List[Tuple[str, bool, int, int]]):
+        self.mtime_ns = mtime_ns
+        # (name, is_dir, size, mtime_ns) for every subdirectory and playable file
+        self.entries = entries
+        # Sort order -> (sort keys, entries) in ascending order
+        self.views: Dict[str, Tuple[List[Tuple[int, Any, str]], List[Tuple[str, bool, int, int]]]] = {}
+
+    def view(self, sort: str) -> Tuple[List[Tuple[int, Any, str]], List[Tuple[str, bool, int, int]]]:
+        """
+        Get the entries sorted by a field, directories first.
+
+        Args:
+            sort (str): One of LISTING_SORTS
+
+        Returns:
+            Tuple[List[Tuple[int, Any, str]], List[Tuple[str, bool, int, int]]]: The sort
+                keys and the entries in the same order
+        """
+        view = self.views.get(sort)
+        if view is None:
+            field = {'name': lambda e: e[0].casefold(), 'mtime': lambda e: e[3], 'size': lambda e: e[2]}[sort]
+            keyed = sorted(((0 if e[1] else 1, field(e), e[0]), e) for e in self.entries)
+            view = ([key for key, _ in keyed], [entry for _, entry in keyed])
+            self.views[sort] = view
+        return view
+
+# Directory listings keyed by absolute path, reused while the directory's mtime is unchanged
+_listing_cache: "OrderedDict[str, _DirectoryListing]" = OrderedDict()
+_listing_cache_lock = threading.Lock()
+_LISTING_CACHE_SIZE = 32
+
+def _scan_directory(path: Path) -> _DirectoryListing:
+    """
+    List a directory with a single scandir pass, or reuse the cached listing.
+
+    Adding, removing or renaming entries changes the directory's mtime and
+    invalidates the listing; files rewritten in place keep their old size and
+    mtime until the directory changes.
+
+    Args:
+        path (Path): The directory to list
+
+    Returns:
+        _DirectoryListing: The directory's entries
+    """
+    key = str(path)
+    mtime_ns = os.stat(key).st_mtime_ns
+
+    with _listing_cache_lock:
+        listing = _listing_cache.get(key)
+        hit = listing is not None and listing.mtime_ns == mtime_ns
+        if hit:
+            _listing_cache.move_to_end(key)
+    cache_lookup('listing', hit)
+    if hit:
+        return listing
+
+    entries = []
+    visited = 0
+    with FS_SCAN_SECONDS.time(scan='listing'), os.scandir(key) as it:
+        for entry in it:
+            visited += 1
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    stat = entry.stat(follow_symlinks=False)
+                    entries.append((entry.name, True, 0, stat.st_mtime_ns))
+                elif entry.name.lower().endswith(PLAYABLE_FORMATS) and entry.is_file():
+                    stat = entry.stat()
+                    entries.append((entry.name, False, stat.st_size, stat.st_mtime_ns))
+            except OSError:
+                continue
+    FS_SCANS.inc(scan='listing')
+    FS_ENTRIES.inc(visited, scan='listing')
+
+    listing = _DirectoryListing(mtime_ns, entries)
+    with _listing_cache_lock:
+        _listing_cache[key] = listing
+        while len(_listing_cache) > _LISTING_CACHE_SIZE:
+            _listing_cache.popitem(last=False)
+    return listing
+
+def _encode_cursor(key: Tuple[int, Any, str]) -> str:
+    """Encode the sort key of the last entry on a page as an opaque cursor."""
+    return base64.urlsafe_b64encode(json.dumps(key).encode()).decode().rstrip('=')
+
+def _decode_cursor(cursor: str, sort: str) -> Tuple[int, Any, str]:
+    """
+    Decode a cursor produced by _encode_cursor.
+
+    Raises:
+        ValueError: If the cursor is malformed or belongs to another sort order
+    """
+    try:
+        group, value, name = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except (TypeError, ValueError) as e:
+        raise ValueError("Invalid cursor") from e
+    expected = str if sort == 'name' else int
+    if group not in (0, 1) or not isinstance(value, expected) or not isinstance(name, str):
+        raise ValueError("Invalid cursor")
+    return group, value, name
+
+def list_directory_page(path: Path, sort: str = 'name', descending: bool = False, prefix: str = '',
+                        cursor: Optional[str] = None, limit: int = 100,
+                        entry_type: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Get one page of a directory listing.
+
+    Directories come before files in either sort direction. Pages are
+    addressed by a cursor holding the sort key of the previous page's last
+    entry, so entries added or removed between requests do not shift the
+    remaining pages.
+
+    Args:
+        path (Path): The directory to list
+        sort (str): Field to sort by, one of LISTING_SORTS
+        descending (bool): Sort in descending order
+        prefix (str): Only include entries whose name starts with this (case-insensitive)
+        cursor (Optional[str]): The next_cursor of the previous page, or None for the first page
+        limit (int): Maximum number of entries to return
+        entry_type (Optional[str]): Only include 'directory' or 'file' entries
+
+    Returns:
+        Dict[str, Any]: The entries of the page and the cursor of the next page
+            (None on the last page)
+
+    Raises:
+        PathValidationError: If the path is not a valid directory
+        ValueError: If an argument is invalid
+    """
+    is_valid, error = validate_path(path)
+
+    if not is_valid:
+        raise PathValidationError(error)
+    if sort not in LISTING_SORTS:
+        raise ValueError(f"Unsupported sort: {sort}")
+    if entry_type not in (None, 'directory', 'file'):
+        raise ValueError(f"Unsupported type: {entry_type}")
+    limit = max(1, min(limit, LISTING_MAX_PAGE_SIZE))
+
+    keys, entries = _scan_directory(path).view(sort)
+
+    # Narrow the range to one entry type
+    lo, hi = 0, len(keys)
+    files_start = bisect_left(keys, (1,))
+    if entry_type == 'directory':
+        hi = files_start
+    elif entry_type == 'file':
+        lo = files_start
+    files_start = min(max(files_start, lo), hi)
+    after = _decode_cursor(cursor, sort) if cursor else None
+
+    if not descending:
+        positions = range(lo if after is None else bisect_right(keys, after, lo, hi), hi)
+    else:
+        # Directories still come first, each group in descending order
+        dirs = range(files_start - 1, lo - 1, -1)
+        files = range(hi - 1, files_start - 1, -1)
+        if after is not None:
+            end = bisect_left(keys, after, lo, hi)
+            if after[0] == 0:
+                dirs = range(min(end, files_start) - 1, lo - 1, -1)
+            else:
+                dirs = range(0)
+                files = range(max(end, files_start) - 1, files_start - 1, -1)
+        positions = chain(dirs, files)
+
+    prefix = prefix.casefold()
+    rel_dir = index_path(path)
+    page = []
+    next_cursor = None
+    for i in positions:
+        name, is_dir, size, mtime_ns = entries[i]
+        if prefix and not name.casefold().startswith(prefix):
+            continue
+        if len(page) == limit:
+            next_cursor = _encode_cursor(keys[page[-1][0]])
+            break
+        page.append((i, name, is_dir, size, mtime_ns))
+
+    # Add what the catalog knows about the files without opening them
+    metadata = get_catalog(current_app).get_many(
+        f"{rel_dir}/{name}" if rel_dir else name for _, name, is_dir, _, _ in page if not is_dir
+    )
+
+    result = []
+    for _, name, is_dir, size, mtime_ns in page:
+        rel_path = f"{rel_dir}/{name}" if rel_dir else name
+        entry = {
+            "name": name,
+            "path": rel_path.replace('/', os.sep),
+            "type": "directory" if is_dir else "file",
+            "size": None if is_dir else size,
+            "mtime": mtime_ns / 1e9
+        }
+        if not is_dir:
+            info = metadata.get(rel_path, {})
+            entry.update({field: info.get(field) for field in ('duration', 'title', 'artist', 'album')})
+        result.append(entry)
+
+    return {
+        "path": rel_dir.replace('/', os.sep),
+        "entries": result,
+        "next_cursor": next_cursor
+    }
+
+def index_path(path: Path) -> str:
+    """
+    Get the key of a path in the library index and catalog.
+
+    Args:
+        path (Path): An absolute path inside the base path
+
+    Returns:
+        str: The path relative to the base path with '/' separators ('' for the base path)
+    """
+    rel_path = os.path.relpath(path, current_app.config['BASE_PATH'])
+    return "" if rel_path == "." else rel_path.replace(os.sep, '/')
+
+def search_files(query: str, path: Optional[Path] = None, limit: int = 50) -> List[Dict[str, Any]]:
+    """
+    Search the library for files whose path or tags contain every term of a query.
+
+    Args:
+        query (str): Whitespace-separated search terms, matched case-insensitively anywhere
+            in the path, title, artist or album
+        path (Optional[Path]): Only search below this directory (default: the whole library)
+        limit (int): Maximum number of results
+
+    Returns:
+        List[Dict[str, Any]]: The matching files with their duration and tags
+
+    Raises:
+        PathValidationError: If the path is not a valid directory
+    """
+    rel_dir = ""
+    if path is not None:
+        is_valid, error = validate_path(path)
+        if not is_valid:
+            raise PathValidationError(error)
+        rel_dir = index_path(path)
+
+    results = get_catalog(current_app).search(query, rel_dir, max(1, min(limit, LISTING_MAX_PAGE_SIZE)))
+    for result in results:
+        result["name"] = os.path.basename(result["path"])
+        result["path"] = result["path"].replace('/', os.sep)
+    return results
+
+def _duplicate_scope(path: Optional[Path]) -> str:
+    """Validate the directory a duplicate query is limited to and get its index key."""
+    if path is None:
+        return ""
+    is_valid, error = validate_path(path)
+    if not is_valid:
+        raise PathValidationError(error)
+    return index_path(path)
+
+def find_duplicates(path: Optional[Path] = None, limit: int = 100, offset: int = 0) -> List[Dict[str, Any]]:
+    """
+    List groups of byte-identical files, those wasting the most space first.
+
+    Only files hashed by the background scan (or uploaded through the app)
+    are considered.
+
+    Args:
+        path (Optional[Path]): Only consider files below this directory (default: the whole library)
+        limit (int): Maximum number of groups
+        offset (int): Number of groups to skip
+
+    Returns:
+        List[Dict[str, Any]]: sha256, size, paths and reclaimable bytes of each group
+
+    Raises:
+        PathValidationError: If the path is not a valid directory
     """
-    Get a random MP3 file from a directory including subdirectories.
+    rel_dir = _duplicate_scope(path)
+    groups = get_deduplicator().duplicates(rel_dir, max(1, min(limit, LISTING_MAX_PAGE_SIZE)), max(0, offset))
+    for group in groups:
+        group["paths"] = [rel_path.replace('/', os.sep) for rel_path in group["paths"]]
+    return groups
+
+def collapse_duplicates(path: Optional[Path] = None, sha256s: Optional[List[str]] = None) -> str:
+    """
+    Start replacing byte-identical files with hard links to a single copy, in a background job.
+
+    Args:
+        path (Optional[Path]): Only consider files below this directory (default: the whole library)
+        sha256s (Optional[List[str]]): Only collapse the groups with these hashes (default: all)
+
+    Returns:
+        str: The id of the job, whose result holds the number of files linked and
+            bytes reclaimed, and whose errors are keyed by path
+
+    Raises:
+        PathValidationError: If the path is not a valid directory
+    """
+    return start_collapse_job(current_app._get_current_object(), _duplicate_scope(path), sha256s)
+
+def get_collapse_job(job_id: str) -> Optional[Dict[str, Any]]:
+    """
+    Get the state of a duplicate collapse job.
+
+    Args:
+        job_id (str): The job id
+
+    Returns:
+        Optional[Dict[str, Any]]: The job, or None if there is no collapse job with that id
+    """
+    job = get_job_store(current_app).get(job_id)
+    return job if job is not None and job['kind'] == COLLAPSE else None
+
+def get_file_metadata(file_path: Path) -> Optional[Dict[str, Any]]:
+    """
+    Get the catalogued metadata of an audio file.
+
+    Args:
+        file_path (Path): The audio file
+
+    Returns:
+        Optional[Dict[str, Any]]: The metadata, or None if the file has not been scanned yet
+
+    Raises:
+        PathValidationError: If the file is outside the base path
+    """
+    is_valid, error = validate_path(file_path.parent)
+
+    if not is_valid:
+        raise PathValidationError(error)
+
+    info = get_catalog(current_app).get(index_path(file_path))
+    if info is not None:
+        info["path"] = info["path"].replace('/', os.sep)
+    return info
+
+def get_random_file(path: Path, strategy: Optional[str] = None, session: Optional[str] = None) -> Optional[Path]:
+    """
+    Get a random audio file from a directory including subdirectories.
 
     Args:
         path (Path): The path to search in
+        strategy (Optional[str]): Sampling strategy (default: the RANDOM_STRATEGY setting)
+        session (Optional[str]): Listener id, required by the shuffle strategy
 
     Returns:
-        Optional[Path]: Path to a random MP3 file or None if no files are found
+        Optional[Path]: Path to a random audio file or None if no files are found
     """
     is_valid, error = validate_path(path)
 
     if not is_valid:
         raise PathValidationError(error)
 
-    files = []
+    # Draw from the library index instead of walking the directory tree
+    picked = get_sampler().draw(
+        index_path(path), 1, strategy or current_app.config.get('RANDOM_STRATEGY', 'file'), session
+    )
+    return current_app.config['BASE_PATH'] / picked[0] if picked else None
+
+def get_random_files(path: Path, count: int, strategy: Optional[str] = None,
+                     session: Optional[str] = None) -> List[Dict[str, Any]]:
+    """
+    Pick several distinct random audio files from a directory including subdirectories.
+
+    Args:
+        path (Path): The path to search in
+        count (int): Number of files to pick; fewer are returned if the directory has fewer
+        strategy (Optional[str]): Sampling strategy (default: the RANDOM_STRATEGY setting)
+        session (Optional[str]): Listener id, required by the shuffle strategy
+
+    Returns:
+        List[Dict[str, Any]]: The picked files with their duration and tags
+    """
+    is_valid, error = validate_path(path)
+
+    if not is_valid:
+        raise PathValidationError(error)
+
+    picked = get_sampler().draw(
+        index_path(path), count, strategy or current_app.config.get('RANDOM_STRATEGY', 'file'), session
+    )
+
+    metadata = get_catalog(current_app).get_many(picked)
+    results = []
+    for rel_path in picked:
+        info = metadata.get(rel_path, {})
+        results.append({
+            "name": os.path.basename(rel_path),
+            "path": rel_path.replace('/', os.sep),
+            **{field: info.get(field) for field in ('duration', 'title', 'artist', 'album')}
+        })
+    return results
+
+def record_play(file_path: Path) -> None:
+    """
+    Count a play of an audio file, for the play-count sampling strategy.
+
+    Args:
+        file_path (Path): The audio file
+    """
+    get_catalog(current_app).record_play(index_path(file_path))
+
+def find_start_offset(file_path: Path, seconds: float) -> Optional[Tuple[int, float]]:
+    """
+    Find where playback of an MP3 file starting at a time has to begin.
 
-    for root, _, filenames in os.walk(path):
-        for filename in filenames:
-            if filename.lower().endswith('.mp3'):
-                files.append(Path(os.path.join(root, filename)))
+    The file's seek table is kept in the catalog; it is built by scanning
+    the file the first time and again after the file changes.
 
-    if not files:
-        return None
+    Args:
+        file_path (Path): The MP3 file
+        seconds (float): Time from the start of the audio
 
-    return random.choice(files)
+    Returns:
+        Optional[Tuple[int, float]]: Byte offset of the frame playing at that time
+            and the time the frame starts at, or None if the file has no audio then
+    """
+    rel_path = index_path(file_path)
+    stat = file_path.stat()
+    catalog = get_catalog(current_app)
+    table = catalog.seek_table(rel_path, stat.st_size, stat.st_mtime_ns)
+    if table is None:
+        table = build_seek_table(file_path)
+        catalog.set_seek_table(rel_path, stat.st_size, stat.st_mtime_ns, table)
+    return find_frame(file_path, table, seconds)
 
 def get_path_parts(path: Path) -> List[str]:
     """
@@ -115,6 +589,11 @@ def get_path_parts(path: Path) -> List[str]:
     if rel_path == '.':
         return []
 
+    # The names stored in the index, falling back to the path for directories it does not know yet
+    node = get_index().tree_node(rel_path)
+    if node is not None:
+        return node.parts()
+
     return rel_path.split(os.sep)
 
 def add_file(directory_path: Path, file) -> Tuple[bool, Optional[str]]:
@@ -133,14 +612,159 @@ def add_file(directory_path: Path, file) -> Tuple[bool, Optional[str]]:
     if not is_valid:
         return False, error
 
+    filename = secure_filename(file.filename or '')
+    if not filename:
+        return False, "Invalid file name"
+
     try:
-        # Save the file
-        file_path = directory_path / file.filename
-        file.save(file_path)
+        # Stream through a temporary file so a failed upload never leaves a partial file behind
+        part_path, size, sha256 = receive_stream(file.stream, directory_path, current_app.config['UPLOAD_MAX_BYTES'])
+        try:
+            _publish_upload(directory_path / filename, size, sha256,
+                            lambda source: publish(part_path, directory_path / filename, source))
+        finally:
+            part_path.unlink(missing_ok=True)
         return True, None
     except Exception as e:
         return False, str(e)
 
+def _publish_upload(destination: Path, size: int, sha256: str,
+                    move: Callable[[Optional[Path]], bool]) -> Dict[str, Any]:
+    """
+    Move a received file into the library, linking it to an identical file there if there is one.
+
+    Args:
+        destination (Path): Where the file belongs
+        size (int): Size of the file in bytes
+        sha256 (str): SHA-256 of the file
+        move (Callable[[Optional[Path]], bool]): Moves the file into place, or links it to
+            the given identical file, returning True if it did the latter
+
+    Returns:
+        Dict[str, Any]: The file's path and hash, and the file it duplicates if it was linked
+    """
+    deduplicator = get_deduplicator()
+    duplicate = None
+    if current_app.config['DEDUP_LINK_UPLOADS']:
+        duplicate = deduplicator.find_duplicate(size, sha256)
+    linked = move(current_app.config['BASE_PATH'] / duplicate if duplicate is not None else None)
+    update_index((CREATED, destination))
+
+    rel_path = index_path(destination)
+    deduplicator.record(rel_path, sha256)
+    return {'path': rel_path, 'sha256': sha256, 'duplicate_of': duplicate if linked else None}
+
+def _upload_status(upload: Dict[str, Any]) -> Dict[str, Any]:
+    """Describe an upload for API responses."""
+    return {
+        'id': upload['id'],
+        'directory': index_path(Path(upload['directory'])),
+        'filename': upload['filename'],
+        'size': upload['size'],
+        'offset': upload['received'],
+        'chunk_size': get_upload_store(current_app).chunk_size
+    }
+
+def start_upload(directory_path: Path, filename: str, size: int, sha256: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Start a resumable upload to a directory.
+
+    Args:
+        directory_path (Path): The directory to save the file to
+        filename (str): Name of the file
+        size (int): Size of the file in bytes
+        sha256 (Optional[str]): Expected SHA-256 of the whole file, checked once it is complete
+
+    Returns:
+        Dict[str, Any]: The upload's id, offset and the chunk size to use. If the sha256 matches
+            a file in the library, the new file is linked to it right away and the upload is
+            returned complete, like the last chunk of upload_chunk
+
+    Raises:
+        PathValidationError: If the directory is invalid
+        UploadError: If the file name, size or checksum is invalid, or the file exists
+    """
+    is_valid, error = validate_path(directory_path)
+    if not is_valid:
+        raise PathValidationError(error)
+    if not directory_path.is_dir():
+        raise PathValidationError("Directory not found")
+
+    filename = secure_filename(filename or '')
+    if not filename:
+        raise UploadError("Invalid file name")
+    if sha256 is not None and (len(sha256) != 64 or any(c not in '0123456789abcdefABCDEF' for c in sha256)):
+        raise UploadError("sha256 must be 64 hex digits")
+
+    if sha256 is not None and size and current_app.config['DEDUP_LINK_UPLOADS']:
+        # Content already in the library does not need to be sent at all
+        sha256 = sha256.lower()
+        duplicate = get_deduplicator().find_duplicate(size, sha256)
+        destination = directory_path / filename
+        if duplicate is not None and link_file(current_app.config['BASE_PATH'] / duplicate, destination):
+            update_index((CREATED, destination))
+            get_deduplicator().record(index_path(destination), sha256)
+            return {
+                'id': None, 'directory': index_path(directory_path), 'filename': filename, 'size': size,
+                'offset': size, 'chunk_size': get_upload_store(current_app).chunk_size,
+                'path': index_path(destination), 'sha256': sha256, 'duplicate_of': duplicate
+            }
+
+    return _upload_status(get_upload_store(current_app).create(directory_path, filename, size, sha256))
+
+def get_upload(upload_id: str) -> Optional[Dict[str, Any]]:
+    """
+    Get the progress of a resumable upload.
+
+    Args:
+        upload_id (str): The upload id
+
+    Returns:
+        Optional[Dict[str, Any]]: The upload, or None if it does not exist
+    """
+    upload = get_upload_store(current_app).get(upload_id)
+    return _upload_status(upload) if upload is not None else None
+
+def upload_chunk(upload_id: str, offset: int, stream, length: int,
+                 checksum: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Write the next chunk of a resumable upload, saving the file once it is complete.
+
+    Args:
+        upload_id (str): The upload id
+        offset (int): Position of the chunk in the file
+        stream: The chunk's data
+        length (int): Size of the chunk in bytes
+        checksum (Optional[str]): Expected SHA-256 of the chunk
+
+    Returns:
+        Dict[str, Any]: The upload's new offset, plus 'path', 'sha256' and 'duplicate_of' (the
+            identical file it was linked to, if any) once it is complete
+
+    Raises:
+        UploadError: If the chunk is rejected
+    """
+    store = get_upload_store(current_app)
+    upload = store.write_chunk(upload_id, offset, stream, length, checksum)
+    status = _upload_status(upload)
+    if upload.get('complete'):
+        destination = Path(upload['directory']) / upload['filename']
+        status.update(_publish_upload(destination, upload['size'], upload['sha256'],
+                                      lambda source: store.finish(upload, source)))
+    return status
+
+def cancel_upload(upload_id: str) -> bool:
+    """
+    Abandon a resumable upload and delete what was received.
+
+    Args:
+        upload_id (str): The upload id
+
+    Returns:
+        bool: False if the upload does not exist
+    """
+    return get_upload_store(current_app).cancel(upload_id)
+
 def delete_file(file_path: Path) -> Tuple[bool, Optional[str]]:
     """
     Delete a file.
@@ -175,6 +799,7 @@ def delete_file(file_path: Path) -> Tuple[bool, Optional[str]]:
     try:
         # Delete the file
         file_path.unlink()
+        update_index((DELETED, file_path))
         return True, None
     except Exception as e:
         return False, str(e)
@@ -234,6 +859,7 @@ def move_file(file_path: Path, destination_dir: Path) -> Tuple[bool, Optional[st
         # Move the file
         destination_file = destination_dir / file_path.name
         shutil.move(str(file_path), str(destination_file))
+        update_index((DELETED, file_path), (CREATED, destination_file))
         return True, None
     except Exception as e:
         return False, str(e)
@@ -258,18 +884,32 @@ def create_directory(parent_dir: Path, dir_name: str) -> Tuple[bool, Optional[st
         # Create the directory
         new_dir = parent_dir / dir_name
         new_dir.mkdir(exist_ok=False)
+        update_index((CREATED, new_dir))
         return True, None
     except FileExistsError:
         return False, "Directory already exists"
     except Exception as e:
         return False, str(e)
 
-def get_directory_tree(path: Path) -> Dict[str, Any]:
+# Trees built for the tree API keyed by (index generation, root, expanded path); complete
+# trees are rebuilt from the compact tree each time instead of being kept
+_tree_cache: "OrderedDict[Tuple[int, str, Optional[str]], Dict[str, Any]]" = OrderedDict()
+_tree_cache_lock = threading.Lock()
+_TREE_CACHE_SIZE = 64
+
+def get_directory_tree(path: Path, expand_to: Optional[Path] = None) -> Dict[str, Any]:
     """
-    Get the complete directory structure recursively.
+    Get the directory structure from the library index.
+
+    Trees are built from the index's compact tree, and trees expanded along
+    a path are cached until the index notices a change on disk. By default
+    the complete structure is returned; with ``expand_to`` only the
+    directories leading to that path are expanded and the rest are marked
+    as not loaded.
 
     Args:
-        path (Path): The root path to scan
+        path (Path): The root path of the tree
+        expand_to (Optional[Path]): Path to expand towards (default: expand everything)
 
     Returns:
         Dict[str, Any]: A nested dictionary representing the directory structure
@@ -280,24 +920,79 @@ def get_directory_tree(path: Path) -> Dict[str, Any]:
     if not is_valid:
         raise PathValidationError(error)
 
-    result = {"name": os.path.basename(path) or "Root", "path": str(os.path.relpath(path, base_path)), "type": "directory", "children": []}
-
-    # Get all items in the directory
-    for item in path.iterdir():
-        if item.is_dir():
-            # Recursively get the structure for subdirectories
-            child_dir = get_directory_tree(item)
-            result["children"].append(child_dir)
-        elif item.is_file() and item.suffix.lower() == '.mp3':
-            # Add files to the children list
-            rel_path = str(os.path.relpath(item, base_path))
-            result["children"].append({
-                "name": item.name,
-                "path": rel_path,
-                "type": "file"
-            })
-
-    # Sort children by type (directories first) and then by name
-    result["children"].sort(key=lambda x: (0 if x["type"] == "directory" else 1, x["name"].lower()))
+    index = get_index()
+    index.ensure_fresh()
+
+    rel_dir = index.normalize(os.path.relpath(path, base_path))
+    expand = index.normalize(os.path.relpath(expand_to, base_path)) if expand_to is not None else None
+    key = (index.generation, rel_dir, expand)
+
+    if expand is not None:
+        with _tree_cache_lock:
+            tree = _tree_cache.get(key)
+            if tree is not None:
+                _tree_cache.move_to_end(key)
+        cache_lookup('tree', tree is not None)
+        if tree is not None:
+            return tree
+
+    node = index.tree_node(rel_dir)
+    if node is not None:
+        tree = node.to_dict(expand, rel_dir)
+    else:
+        # A directory the index does not know yet
+        tree = {
+            "name": os.path.basename(rel_dir) or "Root",
+            "path": rel_dir.replace('/', os.sep) or ".",
+            "type": "directory",
+            "has_children": False,
+            "loaded": expand is None or not rel_dir or expand == rel_dir or expand.startswith(rel_dir + '/'),
+            "children": []
+        }
+
+    if expand is not None:
+        with _tree_cache_lock:
+            _tree_cache[key] = tree
+            while len(_tree_cache) > _TREE_CACHE_SIZE:
+                _tree_cache.popitem(last=False)
+
+    return tree
+
+def get_directory_version(path: Path) -> str:
+    """
+    Get a version of a directory that changes whenever its browse page would.
+
+    The version combines the library index generation, which changes with
+    any directory in the library, and the directory's own mtime, which
+    changes before the index has caught up with a change.
 
-    return result
+    Args:
+        path (Path): The directory
+
+    Returns:
+        str: An opaque version string
+
+    Raises:
+        PathValidationError: If the path is not a valid directory
+    """
+    is_valid, error = validate_path(path)
+
+    if not is_valid:
+        raise PathValidationError(error)
+
+    index = get_index()
+    index.ensure_fresh()
+    return f"{index.generation}-{os.stat(path).st_mtime_ns}"
+
+def get_tree_level(path: Path) -> Dict[str, Any]:
+    """
+    Get a single level of the directory tree.
+
+    Args:
+        path (Path): The directory to list
+
+    Returns:
+        Dict[str, Any]: The directory node with its immediate children, each
+            subdirectory collapsed
+    """
+    return get_directory_tree(path, expand_to=path)
@@ -0,0 +1,268 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import closing
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from flask import Flask
+
+# Job states
+QUEUED = 'queued'
+RUNNING = 'running'
+COMPLETED = 'completed'
+FAILED = 'failed'
+FINISHED_STATES = (COMPLETED, FAILED)
+
+# Job kinds
+CONVERT = 'convert'
+COLLAPSE = 'collapse'
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    directory TEXT NOT NULL,
+    status TEXT NOT NULL,
+    total INTEGER NOT NULL DEFAULT 0,
+    completed INTEGER NOT NULL DEFAULT 0,
+    converted_files TEXT NOT NULL DEFAULT '[]',
+    errors TEXT NOT NULL DEFAULT '{}',
+    message TEXT,
+    pid INTEGER,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    kind TEXT NOT NULL DEFAULT 'convert',
+    result TEXT
+)
+"""
+
+# Columns added since the first version of the table, with their definitions
+_ADDED_COLUMNS = {
+    'kind': "TEXT NOT NULL DEFAULT 'convert'",
+    'result': "TEXT"
+}
+
+class JobStore:
+    """
+    SQLite-backed store for background jobs: directory conversions and duplicate collapses.
+
+    Every gunicorn worker opens the same database, so a job started by one
+    worker can be polled through any other.
+    """
+
+    def __init__(self, db_path: Path):
+        """
+        Args:
+            db_path (Path): Location of the SQLite database
+        """
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        with closing(self._connect()) as conn, conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(_SCHEMA)
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(jobs)")}
+            for column, definition in _ADDED_COLUMNS.items():
+                if column not in columns:
+                    conn.execute(f"ALTER TABLE jobs ADD COLUMN {column} {definition}")
+
+    def _connect(self) -> sqlite3.Connection:
+        """Open a connection to the job database."""
+        conn = sqlite3.connect(str(self.db_path), timeout=30)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def _update(self, job_id: str, **fields: Any) -> None:
+        """Update columns of a job and bump its timestamp."""
+        fields['updated_at'] = time.time()
+        assignments = ", ".join(f"{column} = ?" for column in fields)
+        with closing(self._connect()) as conn, conn:
+            conn.execute(f"UPDATE jobs SET {assignments} WHERE id = ?", (*fields.values(), job_id))
+
+    def create(self, directory: str, kind: str = CONVERT) -> str:
+        """
+        Create a queued job.
+
+        Args:
+            directory (str): Directory the job works on, relative to the base path
+            kind (str): CONVERT or COLLAPSE
+
+        Returns:
+            str: The new job id
+        """
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                "INSERT INTO jobs (id, directory, status, pid, created_at, updated_at, kind) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (job_id, directory, QUEUED, os.getpid(), now, now, kind)
+            )
+        return job_id
+
+    def start(self, job_id: str, total: int) -> None:
+        """Mark a job as running with the number of files to convert."""
+        self._update(job_id, status=RUNNING, total=total)
+
+    def update_progress(self, job_id: str, completed: int, total: int) -> None:
+        """Record how many files of a job have been processed."""
+        self._update(job_id, completed=completed, total=total)
+
+    def finish(self, job_id: str, converted_files: List[str], errors: Dict[str, str]) -> None:
+        """Mark a job as completed with its results."""
+        self._update(
+            job_id,
+            status=COMPLETED,
+            converted_files=json.dumps(converted_files),
+            errors=json.dumps(errors),
+            message=f"Converted {len(converted_files)} files"
+        )
+
+    def finish_collapse(self, job_id: str, linked: int, reclaimed: int, errors: Dict[str, str]) -> None:
+        """Mark a collapse job as completed with its results."""
+        self._update(
+            job_id,
+            status=COMPLETED,
+            errors=json.dumps(errors),
+            result=json.dumps({'linked': linked, 'reclaimed': reclaimed}),
+            message=f"Linked {linked} files"
+        )
+
+    def fail(self, job_id: str, message: str) -> None:
+        """Mark a job as failed."""
+        self._update(job_id, status=FAILED, message=message)
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """
+        Get the state of a job.
+
+        Jobs whose worker process has died are reported as failed.
+
+        Args:
+            job_id (str): The job id
+
+        Returns:
+            Optional[Dict[str, Any]]: The job, or None if it does not exist
+        """
+        with closing(self._connect()) as conn:
+            row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+
+        job = dict(row)
+        if job['status'] not in FINISHED_STATES and not _process_alive(job['pid']):
+            self.fail(job_id, "Job was interrupted")
+            return self.get(job_id)
+
+        job['converted_files'] = json.loads(job['converted_files'])
+        job['errors'] = json.loads(job['errors'])
+        job['result'] = json.loads(job['result']) if job['result'] else None
+        del job['pid']
+        return job
+
+def _process_alive(pid: Optional[int]) -> bool:
+    """Check whether a process on this host is still running."""
+    if not pid:
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def get_job_store(app: Flask) -> JobStore:
+    """
+    Get the job store for an application, creating it on first use.
+
+    Args:
+        app (Flask): The Flask application
+
+    Returns:
+        JobStore: The job store
+    """
+    store = app.extensions.get('randomfile_jobs')
+    if store is None:
+        store = JobStore(app.config['JOB_DB_PATH'])
+        app.extensions['randomfile_jobs'] = store
+    return store
+
+def start_conversion_job(app: Flask, directory_path: Path) -> str:
+    """
+    Queue a conversion of all .ogg files in a directory and run it in the background.
+
+    Args:
+        app (Flask): The Flask application
+        directory_path (Path): The directory to convert
+
+    Returns:
+        str: The job id
+    """
+    store = get_job_store(app)
+    job_id = store.create(os.path.relpath(directory_path, app.config['BASE_PATH']))
+
+    def run() -> None:
+        from randomfile.utils.audio_utils import convert_audio_files, find_audio_files
+        from randomfile.utils.file_utils import update_index
+        from randomfile.utils.library_index import CREATED, DELETED
+
+        with app.app_context():
+            try:
+                ogg_files = find_audio_files(directory_path, ('.ogg',))
+                store.start(job_id, len(ogg_files))
+                converted_files, errors = convert_audio_files(
+                    ogg_files, 'mp3',
+                    progress_callback=lambda completed, total: store.update_progress(job_id, completed, total),
+                    delete_originals=True
+                )
+                converted_sources = set(ogg_files) - set(errors)
+                update_index(
+                    *((DELETED, Path(path)) for path in converted_sources),
+                    *((CREATED, Path(path)) for path in converted_files)
+                )
+
+                base_path = app.config['BASE_PATH']
+                store.finish(
+                    job_id,
+                    [os.path.relpath(path, base_path) for path in converted_files],
+                    {os.path.relpath(path, base_path): error for path, error in errors.items()}
+                )
+            except Exception as e:
+                app.logger.error(f"Error in conversion job {job_id}: {str(e)}")
+                store.fail(job_id, str(e))
+
+    threading.Thread(target=run, name=f"convert-{job_id}", daemon=True).start()
+    return job_id
+
+def start_collapse_job(app: Flask, rel_dir: str, sha256s: Optional[List[str]] = None) -> str:
+    """
+    Queue collapsing duplicates into hard links and run it in the background.
+
+    Args:
+        app (Flask): The Flask application
+        rel_dir (str): Only consider files below this directory, relative to the base path ('' for all)
+        sha256s (Optional[List[str]]): Only collapse the groups with these hashes (default: all)
+
+    Returns:
+        str: The job id
+    """
+    store = get_job_store(app)
+    job_id = store.create(rel_dir, COLLAPSE)
+
+    def run() -> None:
+        from randomfile.utils.file_utils import get_deduplicator
+
+        with app.app_context():
+            try:
+                store.start(job_id, 0)
+                result = get_deduplicator().collapse(sha256s, rel_dir)
+                store.finish_collapse(job_id, result['linked'], result['reclaimed'], result['errors'])
+            except Exception as e:
+                app.logger.error(f"Error in collapse job {job_id}: {str(e)}")
+                store.fail(job_id, str(e))
+
+    threading.Thread(target=run, name=f"collapse-{job_id}", daemon=True).start()
+    return job_id
@@ -0,0 +1,942 @@
+import hashlib
+import mmap
+import os
+import random
+import struct
+import threading
+import time
+from array import array
+from pathlib import Path
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, Iterator, List, NamedTuple, Optional, Set, Tuple
+
+from randomfile.utils.compact_tree import CompactTree, TreeNode
+from randomfile.utils.metrics import FS_ENTRIES, FS_SCANS, FS_SCAN_SECONDS
+
+try:
+    import fcntl
+except ImportError:
+    # No cross-process locking on Windows; concurrent rebuilds just do extra work
+    fcntl = None
+
+# Snapshot layout, integers in native byte order since a snapshot never leaves its host:
+#   header: magic, library fingerprint, generation, file count, directory count, string table size
+#   file_offsets   uint64[files + 1]  offsets of the relative file paths in the string table
+#   dir_offsets    uint64[dirs + 1]   offsets of the directory keys in the string table
+#   dir_mtimes     int64[dirs]        directory mtimes when they were scanned
+#   dir_starts     uint32[dirs]       first file in each directory's subtree
+#   dir_files_end  uint32[dirs]       end of each directory's own files
+#   dir_ends       uint32[dirs]       end of each directory's subtree of files
+#   dir_subdirs    uint32[dirs]       end of each directory's subtree of directories
+#   strings        UTF-8 file paths followed by directory keys
+#
+# Directories are stored depth-first with children in name order. Their keys use
+# NUL instead of '/' as the separator, which makes plain byte order match that
+# depth-first order, so a directory can be found by binary search.
+_MAGIC = b'RFINDEX1'
+_HEADER = struct.Struct('=8s16sQQQQ')
+_HEADER_SIZE = 64
+
+# Kinds of change accepted by LibraryIndex.apply_changes
+CREATED = 'created'
+DELETED = 'deleted'
+
+# Seconds between checks for a snapshot published by another process
+SNAPSHOT_CHECK_INTERVAL = 1.0
+
+# Most changes applied by splicing them into the snapshot; larger batches, such as the
+# watcher's, are applied by laying out the library again
+SPLICE_MAX_CHANGES = 16
+
+class DirectoryEntry(NamedTuple):
+    """A directory in the library index."""
+    start: int              # First file in this directory's subtree
+    files_end: int          # End of this directory's own files
+    end: int                # End of this directory's subtree
+    subdirs: Tuple[str, ...]  # Names of the immediate subdirectories
+    mtime_ns: int           # Directory mtime when it was scanned
+
+class _MutableDir:
+    """A directory while the index is being built or changed."""
+    __slots__ = ('files', 'subdirs', 'mtime_ns')
+
+    def __init__(self, files: Set[str], subdirs: Set[str], mtime_ns: int):
+        self.files = files
+        self.subdirs = subdirs
+        self.mtime_ns = mtime_ns
+
+class Snapshot:
+    """Read-only view of a memory-mapped index snapshot."""
+
+    def __init__(self, buffer: mmap.mmap):
+        magic, self.fingerprint, self.generation, n_files, n_dirs, strings_size = _HEADER.unpack_from(buffer)
+        if magic != _MAGIC:
+            raise ValueError("Not a library index snapshot")
+
+        self.n_files = n_files
+        self.n_dirs = n_dirs
+        self.buffer = buffer
+        view = memoryview(buffer)
+        offset = _HEADER_SIZE
+
+        def column(fmt: str, count: int) -> memoryview:
+            nonlocal offset
+            size = struct.calcsize(fmt) * count
+            values = view[offset:offset + size].cast(fmt)
+            offset += size
+            return values
+
+        self.file_offsets = column('Q', n_files + 1)
+        self.dir_offsets = column('Q', n_dirs + 1)
+        self.dir_mtimes = column('q', n_dirs)
+        self.dir_starts = column('I', n_dirs)
+        self.dir_files_end = column('I', n_dirs)
+        self.dir_ends = column('I', n_dirs)
+        self.dir_subdirs = column('I', n_dirs)
+        self.strings = view[offset:offset + strings_size]
+        self._tree: Optional[CompactTree] = None
+        self._tree_lock = threading.Lock()
+
+    def file(self, i: int) -> str:
+        """Get the relative path of a file."""
+        return str(self.strings[self.file_offsets[i]:self.file_offsets[i + 1]], 'utf-8', 'surrogateescape')
+
+    def file_bytes(self, i: int) -> bytes:
+        """Get the encoded relative path of a file."""
+        return self.strings[self.file_offsets[i]:self.file_offsets[i + 1]].tobytes()
+
+    def dir_key(self, d: int) -> bytes:
+        """Get the NUL-separated key of a directory."""
+        return self.strings[self.dir_offsets[d]:self.dir_offsets[d + 1]].tobytes()
+
+    def dir_path(self, d: int) -> str:
+        """Get the relative path of a directory."""
+        return self.dir_key(d).decode('utf-8', 'surrogateescape').replace('\0', '/')
+
+    def bisect_dir(self, key: bytes) -> int:
+        """Get the position of the first directory whose key is not below a key."""
+        lo, hi = 0, self.n_dirs
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.dir_key(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def find_dir(self, rel_dir: str) -> Optional[int]:
+        """Find a directory by its relative path using binary search."""
+        key = _dir_key(rel_dir)
+        d = self.bisect_dir(key)
+        if d < self.n_dirs and self.dir_key(d) == key:
+            return d
+        return None
+
+    def bisect_file(self, d: int, path: bytes) -> int:
+        """Get the position of the first of a directory's own files whose encoded path is not below a path."""
+        lo, hi = self.dir_starts[d], self.dir_files_end[d]
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.file_bytes(mid) < path:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def find_file(self, d: int, rel_path: str) -> Optional[int]:
+        """Find a file among a directory's own files using binary search."""
+        path = rel_path.encode('utf-8', 'surrogateescape')
+        i = self.bisect_file(d, path)
+        if i < self.dir_files_end[d] and self.file_bytes(i) == path:
+            return i
+        return None
+
+    def ancestors(self, rel_dir: str) -> List[int]:
+        """Get the positions of an indexed directory and of every directory above it."""
+        parts = rel_dir.split('/') if rel_dir else []
+        return [self.find_dir('/'.join(parts[:i])) for i in range(len(parts) + 1)]
+
+    def to_tree(self) -> Dict[str, _MutableDir]:
+        """Unpack the snapshot into a mutable directory tree."""
+        tree = {}
+        for d in range(self.n_dirs):
+            tree[self.dir_path(d)] = _MutableDir(
+                {self.file(i).rsplit('/', 1)[-1] for i in range(self.dir_starts[d], self.dir_files_end[d])},
+                {self.dir_path(child).rsplit('/', 1)[-1] for child in self.child_dirs(d)},
+                self.dir_mtimes[d]
+            )
+        return tree
+
+    def compact_tree(self) -> CompactTree:
+        """Get the snapshot's directory tree, laying it out on first use."""
+        if self._tree is None:
+            with self._tree_lock:
+                if self._tree is None:
+                    self._tree = CompactTree(self)
+        return self._tree
+
+    def child_dirs(self, d: int) -> List[int]:
+        """Get the immediate subdirectories of a directory."""
+        children = []
+        child = d + 1
+        while child < self.dir_subdirs[d]:
+            children.append(child)
+            child = self.dir_subdirs[child]
+        return children
+
+def _dir_key(rel_dir: str) -> bytes:
+    """Get the key of a directory in a snapshot."""
+    return rel_dir.replace('/', '\0').encode('utf-8', 'surrogateescape')
+
+def _flatten(tree: Dict[str, _MutableDir], root: str = "") -> Tuple[List[str], List[Tuple[str, int, int, int, int, int]]]:
+    """
+    Lay out a directory tree in snapshot order.
+
+    Args:
+        tree (Dict[str, _MutableDir]): Directories keyed by relative path ('' for the root)
+        root (str): Directory whose subtree is laid out ('' for the whole tree)
+
+    Returns:
+        Tuple[List[str], List[Tuple[str, int, int, int, int, int]]]: The relative file
+            paths and, per directory in index order, (relative path, start, files end,
+            end, subdirectory end, mtime)
+    """
+    files: List[str] = []
+    dirs: List[Tuple[str, int, int, int, int, int]] = []
+
+    def visit(rel_dir: str) -> None:
+        node = tree[rel_dir]
+        position = len(dirs)
+        dirs.append(None)
+        start = len(files)
+        prefix = f"{rel_dir}/" if rel_dir else ""
+        # Byte order of the names keeps directory keys in depth-first order
+        files.extend(prefix + name for name in sorted(node.files, key=os.fsencode))
+        files_end = len(files)
+        for name in sorted(node.subdirs, key=os.fsencode):
+            visit(prefix + name)
+        dirs[position] = (rel_dir, start, files_end, len(files), len(dirs), node.mtime_ns)
+
+    visit(root)
+    return files, dirs
+
+def _write_snapshot(path: Path, fingerprint: bytes, generation: int, files: List[str],
+                    dirs: List[Tuple[str, int, int, int, int, int]]) -> None:
+    """
+    Write a snapshot file atomically.
+
+    Args:
+        path (Path): Where to write the snapshot
+        fingerprint (bytes): Identifies the library root and indexed extensions
+        generation (int): Generation number of the snapshot
+        files (List[str]): Relative file paths in index order
+        dirs (List[Tuple[str, int, int, int, int, int]]): Per directory, in index order:
+            (relative path, start, files end, end, subdirectory end, mtime)
+    """
+    file_bytes = [f.encode('utf-8', 'surrogateescape') for f in files]
+    dir_bytes = [_dir_key(d[0]) for d in dirs]
+
+    def offsets(items: List[bytes], start: int) -> List[int]:
+        result = [start]
+        for item in items:
+            start += len(item)
+            result.append(start)
+        return result
+
+    file_offsets = offsets(file_bytes, 0)
+    dir_offsets = offsets(dir_bytes, file_offsets[-1])
+    strings = b''.join(file_bytes) + b''.join(dir_bytes)
+
+    temp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    with open(temp_path, 'wb') as f:
+        f.write(_HEADER.pack(_MAGIC, fingerprint, generation, len(files), len(dirs), len(strings)).ljust(_HEADER_SIZE, b'\0'))
+        array('Q', file_offsets).tofile(f)
+        array('Q', dir_offsets).tofile(f)
+        array('q', (d[5] for d in dirs)).tofile(f)
+        for column in (1, 2, 3, 4):
+            array('I', (d[column] for d in dirs)).tofile(f)
+        f.write(strings)
+    os.replace(temp_path, path)
+
+def _shifted(fmt: str, values: memoryview, delta: int) -> array:
+    """Copy a snapshot column, adding a constant to every value."""
+    if not delta:
+        return array(fmt, values.tobytes())
+    return array(fmt, map(delta.__add__, values))
+
+def _splice(snapshot: Snapshot, file_lo: int, file_hi: int, new_files: List[bytes], dir_lo: int, dir_hi: int,
+            new_dirs: List[Tuple[bytes, int, int, int, int, int]], ancestors: Iterable[int]) -> bytearray:
+    """
+    Replace a range of files and a range of directories of a snapshot.
+
+    Everything outside the ranges is copied as it is, apart from shifting
+    positions past the ranges, so the cost is a copy of the snapshot rather
+    than laying out the whole library again.
+
+    Args:
+        snapshot (Snapshot): The snapshot to change
+        file_lo (int): First file replaced
+        file_hi (int): End of the files replaced
+        new_files (List[bytes]): Encoded relative paths of the files put in their place
+        dir_lo (int): First directory replaced
+        dir_hi (int): End of the directories replaced
+        new_dirs (List[Tuple[bytes, int, int, int, int, int]]): Per directory put in their
+            place: (key, start, files end, end, subdirectory end, mtime), positioned in the
+            new snapshot
+        ancestors (Iterable[int]): Directories before dir_lo whose subtrees contain the ranges
+
+    Returns:
+        bytearray: The new snapshot, with the generation of the old one
+    """
+    file_offsets, dir_offsets, strings = snapshot.file_offsets, snapshot.dir_offsets, snapshot.strings
+    files_delta = len(new_files) - (file_hi - file_lo)
+    dirs_delta = len(new_dirs) - (dir_hi - dir_lo)
+    file_bytes_delta = sum(map(len, new_files)) - (file_offsets[file_hi] - file_offsets[file_lo])
+    dir_bytes_delta = sum(len(d[0]) for d in new_dirs) - (dir_offsets[dir_hi] - dir_offsets[dir_lo])
+
+    new_file_offsets = array('Q', file_offsets[:file_lo + 1].tobytes())
+    offset = file_offsets[file_lo]
+    for path in new_files:
+        offset += len(path)
+        new_file_offsets.append(offset)
+    new_file_offsets.extend(_shifted('Q', file_offsets[file_hi + 1:], file_bytes_delta))
+
+    new_dir_offsets = _shifted('Q', dir_offsets[:dir_lo + 1], file_bytes_delta)
+    offset = new_dir_offsets[-1]
+    for d in new_dirs:
+        offset += len(d[0])
+        new_dir_offsets.append(offset)
+    new_dir_offsets.extend(_shifted('Q', dir_offsets[dir_hi + 1:], file_bytes_delta + dir_bytes_delta))
+
+    # Directories before the ranges keep their positions, except the ends of the ones containing them
+    columns = []
+    for field, values, delta in ((5, snapshot.dir_mtimes, 0), (1, snapshot.dir_starts, files_delta),
+                                 (2, snapshot.dir_files_end, files_delta), (3, snapshot.dir_ends, files_delta),
+                                 (4, snapshot.dir_subdirs, dirs_delta)):
+        column = array(values.format, values[:dir_lo].tobytes())
+        if field in (3, 4):
+            for d in ancestors:
+                column[d] += delta
+        column.extend(d[field] for d in new_dirs)
+        column.extend(_shifted(values.format, values[dir_hi:], delta))
+        columns.append(column)
+
+    n_files = snapshot.n_files + files_delta
+    n_dirs = snapshot.n_dirs + dirs_delta
+    strings_size = len(strings) + file_bytes_delta + dir_bytes_delta
+    data = bytearray(_HEADER.pack(_MAGIC, snapshot.fingerprint, snapshot.generation, n_files, n_dirs, strings_size)
+                     .ljust(_HEADER_SIZE, b'\0'))
+    for column in (new_file_offsets, new_dir_offsets, *columns):
+        data += column
+    data += strings[:file_offsets[file_lo]]
+    for path in new_files:
+        data += path
+    data += strings[file_offsets[file_hi]:dir_offsets[dir_lo]]
+    for d in new_dirs:
+        data += d[0]
+    data += strings[dir_offsets[dir_hi]:]
+    return data
+
+class LibraryIndex:
+    """
+    Index of the audio files below a base path, shared between processes.
+
+    Files are stored in a single list ordered depth-first (a directory's own
+    files first, then each subdirectory in name order), so every directory
+    maps to one contiguous range of entries. Picking a random file below any
+    directory is then a lookup plus a random offset into that range.
+
+    The index lives in a snapshot file that every process maps read-only, so
+    it is built once per host and shared through the page cache. Whichever
+    process notices a change rebuilds the snapshot under a file lock and the
+    others pick up the new file within SNAPSHOT_CHECK_INTERVAL seconds.
+    """
+
+    def __init__(self, base_path: Path, extensions: Tuple[str, ...] = ('.mp3',), refresh_interval: float = 0,
+                 snapshot_path: Optional[Path] = None):
+        """
+        Args:
+            base_path (Path): The library root
+            extensions (Tuple[str, ...]): Lowercase file extensions to index
+            refresh_interval (float): Seconds between checks for changes on disk
+                (0 disables time-based checks)
+            snapshot_path (Optional[Path]): Location of the shared snapshot file
+                (default: next to the library)
+        """
+        self.base_path = Path(base_path)
+        self.extensions = tuple(extensions)
+        self.refresh_interval = refresh_interval
+        self.snapshot_path = Path(snapshot_path or self.base_path.parent / f".{self.base_path.name}.idx")
+        self.fingerprint = hashlib.blake2b(
+            f"{self.base_path}\0{','.join(self.extensions)}".encode(), digest_size=16
+        ).digest()
+
+        self._lock = threading.Lock()
+        self._snapshot: Optional[Snapshot] = None
+        self._snapshot_id: Optional[Tuple[int, int, int]] = None
+        self._synced_at = 0.0
+        self._checked_at: Optional[float] = None
+        self._stale = False
+
+    @property
+    def generation(self) -> int:
+        """Generation number of the current snapshot, the same in every process."""
+        self.ensure_fresh()
+        return self._snapshot.generation
+
+    @property
+    def snapshot(self) -> Snapshot:
+        """The current snapshot, loaded or rebuilt first if it is out of date."""
+        self.ensure_fresh()
+        return self._snapshot
+
+    def _scan_tree(self, rel_dir: str = "", tree: Optional[Dict[str, _MutableDir]] = None) -> Dict[str, _MutableDir]:
+        """
+        Walk a directory of the library and record it and everything below it.
+
+        Args:
+            rel_dir (str): Directory to walk, relative to the base path ('' for the whole library)
+            tree (Optional[Dict[str, _MutableDir]]): Tree to add the directories to
+
+        Returns:
+            Dict[str, _MutableDir]: The tree
+        """
+        tree = {} if tree is None else tree
+        visited = [0, 0]
+
+        def visit(directory: str, rel_dir: str) -> None:
+            node = _MutableDir(set(), set(), 0)
+            tree[rel_dir] = node
+            try:
+                node.mtime_ns = os.stat(directory).st_mtime_ns
+                with os.scandir(directory) as it:
+                    entries = list(it)
+            except OSError:
+                entries = []
+            visited[0] += 1
+            visited[1] += len(entries)
+
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        node.subdirs.add(entry.name)
+                        visit(entry.path, f"{rel_dir}/{entry.name}" if rel_dir else entry.name)
+                    elif entry.name.lower().endswith(self.extensions) and entry.is_file():
+                        node.files.add(entry.name)
+                except OSError:
+                    continue
+
+        with FS_SCAN_SECONDS.time(scan='index'):
+            visit(str(self.base_path / rel_dir), rel_dir)
+        FS_SCANS.inc(visited[0], scan='index')
+        FS_ENTRIES.inc(visited[1], scan='index')
+        return tree
+
+    def _load(self) -> bool:
+        """
+        Map the snapshot file if it exists and belongs to this library.
+
+        Returns:
+            bool: True if a snapshot was loaded
+        """
+        try:
+            with open(self.snapshot_path, 'rb') as f:
+                stat = os.fstat(f.fileno())
+                buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            snapshot = Snapshot(buffer)
+        except (OSError, ValueError, struct.error):
+            return False
+        if snapshot.fingerprint != self.fingerprint:
+            return False
+
+        # The previous mapping is released once no reader holds a reference to it
+        self._snapshot = snapshot
+        self._snapshot_id = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        self._synced_at = time.monotonic()
+        return True
+
+    def _disk_snapshot_id(self) -> Optional[Tuple[int, int, int]]:
+        """Identify the snapshot file currently on disk."""
+        try:
+            stat = os.stat(self.snapshot_path)
+        except OSError:
+            return None
+        return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+    @contextmanager
+    def _exclusive(self) -> Iterator[None]:
+        """Hold the cross-process lock that serializes snapshot writers."""
+        self.snapshot_path.parent.mkdir(parents=True, exist_ok=True)
+        with open(f"{self.snapshot_path}.lock", 'w') as lock_file:
+            if fcntl:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            yield
+
+    def _publish(self, tree: Dict[str, _MutableDir]) -> None:
+        """Write a tree as the next snapshot generation and load it. The caller must hold the lock."""
+        generation = self._snapshot.generation if self._snapshot is not None else 0
+        files, dirs = _flatten(tree)
+        _write_snapshot(self.snapshot_path, self.fingerprint, generation + 1, files, dirs)
+        self._load()
+
+    def _rebuild(self, force: bool) -> None:
+        """
+        Rebuild the snapshot under the cross-process lock and load it.
+
+        Args:
+            force (bool): Rebuild even if another process published a new snapshot
+                since this one was loaded
+        """
+        with self._exclusive():
+            # Another process may have rebuilt it while we waited for the lock
+            if not force and self._disk_snapshot_id() != self._snapshot_id and self._load():
+                return
+
+            if self._snapshot is None:
+                self._load()
+            self._publish(self._scan_tree())
+        self._checked_at = time.monotonic()
+
+    def apply_changes(self, changes: Iterable[Tuple[str, str]], refreshed_dirs: Iterable[str] = ()) -> bool:
+        """
+        Update the index for individual changes without rescanning the library.
+
+        Created directories are walked so their contents are indexed; everything
+        else only touches the affected entries. Changes that are already
+        reflected in the index are ignored. A few changes are spliced into the
+        current snapshot; batches of more than SPLICE_MAX_CHANGES are applied
+        to the unpacked tree, which is laid out again in one go.
+
+        Args:
+            changes (Iterable[Tuple[str, str]]): (CREATED or DELETED, relative path) pairs in
+                the order they happened; a move is a deletion followed by a creation
+            refreshed_dirs (Iterable[str]): Directories whose recorded mtime should be
+                refreshed even though none of their indexed entries changed
+
+        Returns:
+            bool: True if a new snapshot was published
+        """
+        changes = list(changes)
+        with self._lock, self._exclusive():
+            # Apply the changes on top of the latest snapshot from any process
+            if self._disk_snapshot_id() != self._snapshot_id or self._snapshot is None:
+                if not self._load():
+                    self._publish(self._scan_tree())
+                    return True
+
+            touched = {self.normalize(rel_dir) for rel_dir in refreshed_dirs}
+            if len(changes) > SPLICE_MAX_CHANGES:
+                return self._apply_to_tree(changes, touched)
+            return self._splice_changes(changes, touched)
+
+    def _splice_changes(self, changes: List[Tuple[str, str]], touched: Set[str]) -> bool:
+        """Apply changes to the current snapshot range by range. The caller must hold the lock."""
+        snapshot = self._snapshot
+        changed = False
+
+        for operation, rel_path in changes:
+            rel_path = self.normalize(rel_path)
+            if not rel_path:
+                continue
+            parent, _, name = rel_path.rpartition('/')
+            touched.add(parent)
+
+            d = snapshot.find_dir(rel_path)
+            if d is not None:
+                # Drop the directory and its subtree; a re-created one is walked again below
+                snapshot = Snapshot(_splice(snapshot, snapshot.dir_starts[d], snapshot.dir_ends[d], [],
+                                             d, snapshot.dir_subdirs[d], [], snapshot.ancestors(parent)))
+                changed = True
+            elif operation == DELETED:
+                p = snapshot.find_dir(parent)
+                i = snapshot.find_file(p, rel_path) if p is not None else None
+                if i is not None:
+                    snapshot = self._replace_own_files(snapshot, parent, p, i, i + 1, [])
+                    changed = True
+
+            if operation != CREATED:
+                continue
+
+            full_path = self.base_path / rel_path
+            is_dir = full_path.is_dir() and not full_path.is_symlink()
+            is_file = not is_dir and rel_path.lower().endswith(self.extensions) and full_path.is_file()
+            if not (is_dir or is_file):
+                continue
+
+            p = snapshot.find_dir(parent)
+            if p is None:
+                # Walk the topmost missing ancestor if the parent is not indexed yet
+                missing = parent
+                while snapshot.find_dir(missing.rpartition('/')[0]) is None:
+                    missing = missing.rpartition('/')[0]
+                snapshot = self._insert_subtree(snapshot, missing)
+                touched.add(missing.rpartition('/')[0])
+                changed = True
+            elif is_dir:
+                snapshot = self._insert_subtree(snapshot, rel_path)
+                changed = True
+            elif snapshot.find_file(p, rel_path) is None:
+                path = rel_path.encode('utf-8', 'surrogateescape')
+                i = snapshot.bisect_file(p, path)
+                snapshot = self._replace_own_files(snapshot, parent, p, i, i, [path])
+                changed = True
+
+        mtimes = {}
+        for rel_dir in touched:
+            d = snapshot.find_dir(rel_dir)
+            if d is None:
+                continue
+            try:
+                mtime_ns = os.stat(self.base_path / rel_dir).st_mtime_ns
+            except OSError:
+                continue
+            if mtime_ns != snapshot.dir_mtimes[d]:
+                mtimes[d] = mtime_ns
+        if not changed and not mtimes:
+            return False
+
+        # Spliced snapshots are already copies; patch the generation and mtimes in place
+        data = snapshot.buffer if isinstance(snapshot.buffer, bytearray) else bytearray(snapshot.buffer)
+        _HEADER.pack_into(data, 0, _MAGIC, self.fingerprint, self._snapshot.generation + 1, snapshot.n_files,
+                          snapshot.n_dirs, len(snapshot.strings))
+        mtimes_offset = _HEADER_SIZE + 8 * (snapshot.n_files + 1) + 8 * (snapshot.n_dirs + 1)
+        for d, mtime_ns in mtimes.items():
+            struct.pack_into('=q', data, mtimes_offset + 8 * d, mtime_ns)
+
+        temp_path = self.snapshot_path.with_name(f"{self.snapshot_path.name}.{os.getpid()}.tmp")
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, self.snapshot_path)
+        self._load()
+        return True
+
+    @staticmethod
+    def _replace_own_files(snapshot: Snapshot, rel_dir: str, d: int, lo: int, hi: int,
+                           new_files: List[bytes]) -> Snapshot:
+        """Replace a range of a directory's own files."""
+        delta = len(new_files) - (hi - lo)
+        entry = (snapshot.dir_key(d), snapshot.dir_starts[d], snapshot.dir_files_end[d] + delta,
+                 snapshot.dir_ends[d] + delta, snapshot.dir_subdirs[d], snapshot.dir_mtimes[d])
+        ancestors = snapshot.ancestors(rel_dir.rpartition('/')[0]) if rel_dir else []
+        return Snapshot(_splice(snapshot, lo, hi, new_files, d, d + 1, [entry], ancestors))
+
+    def _insert_subtree(self, snapshot: Snapshot, rel_dir: str) -> Snapshot:
+        """Walk a directory missing from a snapshot and insert it with its subtree."""
+        files, dirs = _flatten(self._scan_tree(rel_dir), rel_dir)
+        # Keys sort depth-first, so the subtree goes where its key sorts and its files before the next directory's
+        position = snapshot.bisect_dir(_dir_key(rel_dir))
+        file_position = snapshot.dir_starts[position] if position < snapshot.n_dirs else snapshot.n_files
+        new_dirs = [
+            (_dir_key(path), file_position + start, file_position + files_end, file_position + end,
+             position + subdirs, mtime_ns)
+            for path, start, files_end, end, subdirs, mtime_ns in dirs
+        ]
+        new_files = [path.encode('utf-8', 'surrogateescape') for path in files]
+        return Snapshot(_splice(snapshot, file_position, file_position, new_files, position, position, new_dirs,
+                                 snapshot.ancestors(rel_dir.rpartition('/')[0])))
+
+    def _apply_to_tree(self, changes: List[Tuple[str, str]], touched: Set[str]) -> bool:
+        """Apply changes to the unpacked tree of the current snapshot. The caller must hold the lock."""
+        tree = self._snapshot.to_tree()
+        changed = False
+
+        for operation, rel_path in changes:
+            rel_path = self.normalize(rel_path)
+            if not rel_path:
+                continue
+            parent, _, name = rel_path.rpartition('/')
+            touched.add(parent)
+
+            if rel_path in tree:
+                # Drop the directory and its subtree; a re-created one is walked again below
+                for key in [key for key in tree if key == rel_path or key.startswith(rel_path + '/')]:
+                    del tree[key]
+                if parent in tree:
+                    tree[parent].subdirs.discard(name)
+                changed = True
+            elif operation == DELETED and parent in tree and name in tree[parent].files:
+                tree[parent].files.discard(name)
+                changed = True
+
+            if operation != CREATED:
+                continue
+
+            full_path = self.base_path / rel_path
+            is_dir = full_path.is_dir() and not full_path.is_symlink()
+            is_file = not is_dir and rel_path.lower().endswith(self.extensions) and full_path.is_file()
+            if not (is_dir or is_file):
+                continue
+
+            # Walk the topmost missing ancestor if the parent is not indexed yet
+            if parent not in tree:
+                missing = parent
+                while missing.rpartition('/')[0] not in tree:
+                    missing = missing.rpartition('/')[0]
+                self._scan_tree(missing, tree)
+                ancestor, _, missing_name = missing.rpartition('/')
+                tree[ancestor].subdirs.add(missing_name)
+                touched.add(ancestor)
+                changed = True
+                continue
+
+            if is_dir:
+                self._scan_tree(rel_path, tree)
+                tree[parent].subdirs.add(name)
+                changed = True
+            elif name not in tree[parent].files:
+                tree[parent].files.add(name)
+                changed = True
+
+        for rel_dir in touched:
+            node = tree.get(rel_dir)
+            if node is None:
+                continue
+            try:
+                mtime_ns = os.stat(self.base_path / rel_dir).st_mtime_ns
+            except OSError:
+                continue
+            if mtime_ns != node.mtime_ns:
+                node.mtime_ns = mtime_ns
+                changed = True
+
+        if changed:
+            self._publish(tree)
+        return changed
+
+    def has_changed(self) -> bool:
+        """
+        Detect changes on disk by comparing directory mtimes with the snapshot.
+
+        Adding, removing or renaming an entry updates the mtime of its parent
+        directory, so one stat per directory is enough to notice any change.
+
+        Returns:
+            bool: True if any indexed directory changed or disappeared
+        """
+        snapshot = self._snapshot
+        for d in range(snapshot.n_dirs):
+            try:
+                if os.stat(self.base_path / snapshot.dir_path(d)).st_mtime_ns != snapshot.dir_mtimes[d]:
+                    return True
+            except OSError:
+                return True
+        return False
+
+    def build(self) -> None:
+        """Rebuild the index from disk."""
+        with self._lock:
+            self._stale = False
+            self._rebuild(force=True)
+
+    def invalidate(self) -> None:
+        """Mark the index as out of date so the next lookup rebuilds it."""
+        self._stale = True
+
+    def _check_due(self) -> bool:
+        """Check whether the refresh interval has passed since the last check."""
+        return (
+            self.refresh_interval > 0 and self._checked_at is not None
+            and time.monotonic() - self._checked_at > self.refresh_interval
+        )
+
+    def ensure_fresh(self) -> None:
+        """Load, reload or rebuild the snapshot if it is out of date."""
+        if (not self._stale and self._snapshot is not None and not self._check_due()
+                and time.monotonic() - self._synced_at < SNAPSHOT_CHECK_INTERVAL):
+            return
+
+        with self._lock:
+            if self._stale:
+                # Clear the flag first so an invalidation during the rebuild is not lost
+                self._stale = False
+                self._rebuild(force=True)
+                return
+
+            if self._snapshot is None:
+                if not self._load():
+                    self._rebuild(force=False)
+                if self._checked_at is None:
+                    self._checked_at = time.monotonic()
+                return
+
+            if time.monotonic() - self._synced_at >= SNAPSHOT_CHECK_INTERVAL:
+                if self._disk_snapshot_id() != self._snapshot_id:
+                    self._load()
+                self._synced_at = time.monotonic()
+
+            if self._check_due():
+                if self.has_changed():
+                    self._rebuild(force=False)
+                else:
+                    self._checked_at = time.monotonic()
+
+    @staticmethod
+    def normalize(rel_dir: str) -> str:
+        """Normalize a relative directory path to the form used as an index key."""
+        rel_dir = rel_dir.replace(os.sep, '/').strip('/')
+        return '' if rel_dir == '.' else rel_dir
+
+    def _find(self, rel_dir: str) -> Tuple[Snapshot, Optional[int]]:
+        """Get the current snapshot and the position of a directory in it."""
+        self.ensure_fresh()
+        snapshot = self._snapshot
+        return snapshot, snapshot.find_dir(self.normalize(rel_dir))
+
+    def directory(self, rel_dir: str = '') -> Optional[DirectoryEntry]:
+        """
+        Look up a directory in the index.
+
+        Args:
+            rel_dir (str): Directory path relative to the base path
+
+        Returns:
+            Optional[DirectoryEntry]: The directory entry or None if it is unknown
+        """
+        snapshot, d = self._find(rel_dir)
+        if d is None:
+            return None
+        return DirectoryEntry(
+            snapshot.dir_starts[d], snapshot.dir_files_end[d], snapshot.dir_ends[d],
+            tuple(snapshot.dir_path(child).rsplit('/', 1)[-1] for child in snapshot.child_dirs(d)),
+            snapshot.dir_mtimes[d]
+        )
+
+    def tree_node(self, rel_dir: str = '') -> Optional[TreeNode]:
+        """
+        Look up a directory in the compact tree of the current snapshot.
+
+        Args:
+            rel_dir (str): Directory path relative to the base path
+
+        Returns:
+            Optional[TreeNode]: The directory's view, or None if it is unknown
+        """
+        snapshot, d = self._find(rel_dir)
+        if d is None:
+            return None
+        return snapshot.compact_tree().directory(d)
+
+    def file_range(self, rel_dir: str = '') -> Tuple[int, int]:
+        """
+        Get the range of indexed files below a directory.
+
+        Args:
+            rel_dir (str): Directory path relative to the base path
+
+        Returns:
+            Tuple[int, int]: The (start, end) range, empty if the directory is unknown
+        """
+        snapshot, d = self._find(rel_dir)
+        return (snapshot.dir_starts[d], snapshot.dir_ends[d]) if d is not None else (0, 0)
+
+    def count(self, rel_dir: str = '') -> int:
+        """
+        Count the indexed files below a directory.
+
+        Args:
+            rel_dir (str): Directory path relative to the base path
+
+        Returns:
+            int: Number of files in the directory and its subdirectories
+        """
+        start, end = self.file_range(rel_dir)
+        return end - start
+
+    def list_directory(self, rel_dir: str = '') -> Optional[Tuple[List[str], List[str]]]:
+        """
+        List the immediate subdirectories and files of a directory.
+
+        Args:
+            rel_dir (str): Directory path relative to the base path
+
+        Returns:
+            Optional[Tuple[List[str], List[str]]]: Relative paths of the (subdirectories, files),
+                or None if the directory is unknown
+        """
+        snapshot, d = self._find(rel_dir)
+        if d is None:
+            return None
+        subdirs = [snapshot.dir_path(child) for child in snapshot.child_dirs(d)]
+        files = [snapshot.file(i) for i in range(snapshot.dir_starts[d], snapshot.dir_files_end[d])]
+        return subdirs, files
+
+    def files(self, rel_dir: str = '') -> Iterator[str]:
+        """
+        Iterate over the indexed files below a directory in depth-first order.
+
+        The iteration reads from one snapshot even if the index changes meanwhile.
+
+        Args:
+            rel_dir (str): Directory path relative to the base path
+
+        Yields:
+            str: Relative path of the next file
+        """
+        snapshot, d = self._find(rel_dir)
+        if d is None:
+            return
+        for i in range(snapshot.dir_starts[d], snapshot.dir_ends[d]):
+            yield snapshot.file(i)
+
+    def select(self, rel_dir: str, choose: Callable[[Snapshot, int], Iterable[int]]) -> List[str]:
+        """
+        Select files below a directory by their number in the snapshot.
+
+        Choosing and looking up the files use the same snapshot, so the numbers
+        stay valid even if the index changes meanwhile.
+
+        Args:
+            rel_dir (str): Directory path relative to the base path
+            choose (Callable[[Snapshot, int], Iterable[int]]): Given the snapshot and the
+                directory's number in it, returns the numbers of the files to pick, each in
+                the directory's (start, end) range; not called if there are no files
+
+        Returns:
+            List[str]: Relative paths of the picked files
+        """
+        snapshot, d = self._find(rel_dir)
+        if d is None or snapshot.dir_starts[d] == snapshot.dir_ends[d]:
+            return []
+        return [snapshot.file(i) for i in choose(snapshot, d)]
+
+    def random_file(self, rel_dir: str = '') -> Optional[Path]:
+        """
+        Pick a random file below a directory.
+
+        Args:
+            rel_dir (str): Directory path relative to the base path
+
+        Returns:
+            Optional[Path]: Absolute path of the chosen file or None if there are none
+        """
+        snapshot, d = self._find(rel_dir)
+        if d is None or snapshot.dir_starts[d] == snapshot.dir_ends[d]:
+            return None
+        return self.base_path / snapshot.file(random.randrange(snapshot.dir_starts[d], snapshot.dir_ends[d]))
+
+# One index per library root, shared by all requests in this process
+_indexes: Dict[Path, LibraryIndex] = {}
+_indexes_lock = threading.Lock()
+
+def get_library_index(base_path: Path, refresh_interval: float = 0,
+                      extensions: Tuple[str, ...] = ('.mp3',),
+                      snapshot_path: Optional[Path] = None) -> LibraryIndex:
+    """
+    Get the shared index for a library root, creating it on first use.
+
+    Args:
+        base_path (Path): The library root
+        refresh_interval (float): Seconds between checks for changes on disk (0 disables them)
+        extensions (Tuple[str, ...]): Lowercase file extensions to index
+        snapshot_path (Optional[Path]): Location of the shared snapshot file
+
+    Returns:
+        LibraryIndex: The index for the library
+    """
+    base_path = Path(base_path)
+    with _indexes_lock:
+        index = _indexes.get(base_path)
+        if index is None:
+            index = LibraryIndex(base_path, extensions, refresh_interval, snapshot_path)
+            _indexes[base_path] = index
+        return index
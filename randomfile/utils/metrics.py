@@ -0,0 +1,512 @@
+import json
+import math
+import mmap
+import os
+import struct
+import threading
+import time
+import uuid
+from collections import defaultdict
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+from flask import Flask, Response, g, has_request_context, request
+
+try:
+    import fcntl
+except ImportError:
+    # Without locks the files of exited processes cannot be told apart and are never merged
+    fcntl = None
+
+# Value file layout, in native byte order since the files never leave their host:
+#   header: bytes used (uint64)
+#   entries: key length (uint32), UTF-8 key padded to 8 bytes together with the
+#            length, value (float64)
+# Entries are only appended and values are aligned, so a reader sees either
+# the old or the new value of an entry and never a partial one.
+_USED = struct.Struct('=Q')
+_KEY_LENGTH = struct.Struct('=I')
+_VALUE = struct.Struct('=d')
+_INITIAL_SIZE = 64 * 1024
+
+# Values of the processes that have exited, merged into a single file
+_ARCHIVE = 'archive.json'
+_LOCK = '.lock'
+
+# Keys of the WSGI environ holding the endpoint a request was counted under,
+# the number of body bytes sent for it and the status the ASGI adapter sent
+# in place of the app's
+ENDPOINT_ENVIRON = 'randomfile.endpoint'
+BYTES_SENT_ENVIRON = 'randomfile.bytes_sent'
+STATUS_ENVIRON = 'randomfile.status'
+
+# Default latency buckets in seconds
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+class _ValueFile:
+    """
+    One process's metric values in a memory-mapped file.
+
+    Only the owning process writes the file; the others read it while it is
+    written. The owner holds an exclusive lock on it for as long as it runs,
+    so a file whose lock can be taken belongs to a process that has exited.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        if fcntl is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        os.ftruncate(self._fd, _INITIAL_SIZE)
+        self._mmap = mmap.mmap(self._fd, _INITIAL_SIZE)
+        self._used = _USED.size
+        _USED.pack_into(self._mmap, 0, self._used)
+        self._positions: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def add(self, key: str, amount: float) -> None:
+        """Add to the value of a key, creating it at zero first."""
+        with self._lock:
+            position = self._positions.get(key)
+            if position is None:
+                position = self._append(key)
+            value = _VALUE.unpack_from(self._mmap, position)[0]
+            _VALUE.pack_into(self._mmap, position, value + amount)
+
+    def _append(self, key: str) -> int:
+        encoded = key.encode()
+        padded = _KEY_LENGTH.size + len(encoded)
+        padded += -padded % 8
+        size = padded + _VALUE.size
+        if self._used + size > len(self._mmap):
+            capacity = len(self._mmap)
+            while self._used + size > capacity:
+                capacity *= 2
+            os.ftruncate(self._fd, capacity)
+            self._mmap.close()
+            self._mmap = mmap.mmap(self._fd, capacity)
+
+        _KEY_LENGTH.pack_into(self._mmap, self._used, len(encoded))
+        self._mmap[self._used + _KEY_LENGTH.size:self._used + _KEY_LENGTH.size + len(encoded)] = encoded
+        position = self._used + padded
+        _VALUE.pack_into(self._mmap, position, 0.0)
+        # Publish the entry only once it is complete
+        self._used += size
+        _USED.pack_into(self._mmap, 0, self._used)
+        self._positions[key] = position
+        return position
+
+    def values(self) -> Dict[str, float]:
+        with self._lock:
+            return _parse(self._mmap[:self._used])
+
+def _parse(data: bytes) -> Dict[str, float]:
+    """Read the entries of a value file's contents."""
+    values = {}
+    if len(data) < _USED.size:
+        return values
+    used = min(_USED.unpack_from(data, 0)[0], len(data))
+    offset = _USED.size
+    while offset + _KEY_LENGTH.size <= used:
+        length = _KEY_LENGTH.unpack_from(data, offset)[0]
+        padded = _KEY_LENGTH.size + length
+        padded += -padded % 8
+        if offset + padded + _VALUE.size > used:
+            break
+        key = bytes(data[offset + _KEY_LENGTH.size:offset + _KEY_LENGTH.size + length]).decode()
+        values[key] = _VALUE.unpack_from(data, offset + padded)[0]
+        offset += padded + _VALUE.size
+    return values
+
+def _read(fd: int) -> Dict[str, float]:
+    """Read a value file written by another process."""
+    header = os.pread(fd, _USED.size, 0)
+    if len(header) < _USED.size:
+        return {}
+    return _parse(os.pread(fd, _USED.unpack(header)[0], 0))
+
+class MetricsStore:
+    """
+    Metric values shared by every process of the app through a directory.
+
+    Each process adds to its own value file, so recording needs no
+    cross-process locking. Reading sums the files of all processes. Files of
+    processes that have exited, e.g. restarted gunicorn workers, are merged
+    into an archive, so counters never go backwards.
+    """
+
+    def __init__(self):
+        self.directory: Optional[Path] = None
+        self._file: Optional[_ValueFile] = None
+        self._pid: Optional[int] = None
+        self._lock = threading.Lock()
+
+    def configure(self, directory: Optional[Path]) -> None:
+        """
+        Set the directory the values are kept in.
+
+        Args:
+            directory (Optional[Path]): The directory, or None to stop recording
+        """
+        with self._lock:
+            if directory is not None:
+                directory = Path(directory)
+                directory.mkdir(parents=True, exist_ok=True)
+            if directory != self.directory:
+                self.directory = directory
+                self._file = None
+
+    def _value_file(self) -> Optional[_ValueFile]:
+        """Get this process's value file, creating it after a fork or a change of directory."""
+        pid = os.getpid()
+        value_file = self._file
+        if value_file is not None and self._pid == pid:
+            return value_file
+        if self.directory is None:
+            return None
+        with self._lock:
+            if self.directory is None:
+                return None
+            if self._file is None or self._pid != pid:
+                self._file = _ValueFile(self.directory / f"{pid}-{uuid.uuid4().hex[:8]}.db")
+                self._pid = pid
+            return self._file
+
+    def add(self, key: str, amount: float) -> None:
+        """Add to a value, if a directory is configured."""
+        value_file = self._value_file()
+        if value_file is not None:
+            value_file.add(key, amount)
+
+    @contextmanager
+    def _locked(self) -> Iterator[None]:
+        with open(self.directory / _LOCK, 'a') as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            yield
+
+    def collect(self) -> Dict[str, float]:
+        """
+        Sum the values of every process, merging the files of exited processes into the archive.
+
+        Returns:
+            Dict[str, float]: Value by key
+        """
+        if self.directory is None:
+            return {}
+        own = self._value_file()
+        totals: Dict[str, float] = defaultdict(float)
+
+        with self._locked():
+            archive_path = self.directory / _ARCHIVE
+            try:
+                archive = json.loads(archive_path.read_text())
+            except (OSError, ValueError):
+                archive = {'values': {}, 'merged': []}
+            merged = set(archive['merged'])
+            present = set()
+            exited: List[Tuple[str, int]] = []
+
+            for path in self.directory.glob('*.db'):
+                if own is not None and path == own.path:
+                    continue
+                try:
+                    fd = os.open(path, os.O_RDONLY)
+                except FileNotFoundError:
+                    continue
+                present.add(path.name)
+                try:
+                    alive = True
+                    if fcntl is not None:
+                        try:
+                            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                            alive = False
+                        except BlockingIOError:
+                            pass
+                    if alive:
+                        for key, value in _read(fd).items():
+                            totals[key] += value
+                    elif path.name not in merged:
+                        for key, value in _read(fd).items():
+                            archive['values'][key] = archive['values'].get(key, 0.0) + value
+                        exited.append((path.name, fd))
+                        fd = -1
+                    else:
+                        # Merged before, but the file outlived an interrupted clean-up
+                        path.unlink(missing_ok=True)
+                finally:
+                    if fd >= 0:
+                        os.close(fd)
+
+            if exited:
+                # Record which files were merged before removing them, so none is counted twice
+                archive['merged'] = sorted((merged & present) | {name for name, _ in exited})
+                temp_path = archive_path.with_name(f".{uuid.uuid4().hex}.tmp")
+                temp_path.write_text(json.dumps(archive))
+                os.replace(temp_path, archive_path)
+                for name, fd in exited:
+                    (self.directory / name).unlink(missing_ok=True)
+                    os.close(fd)
+
+        for key, value in archive['values'].items():
+            totals[key] += value
+        if own is not None:
+            for key, value in own.values().items():
+                totals[key] += value
+        return totals
+
+# The store of this process, configured by init_metrics
+_store = MetricsStore()
+
+# Metrics by name, in the order they are exposed
+_registry: Dict[str, "_Metric"] = {}
+
+class _Metric:
+    """A metric family with a fixed set of label names."""
+    kind = ''
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._keys: Dict[tuple, str] = {}
+        _registry[name] = self
+
+    def _key(self, suffix: str, labels: Dict[str, str], extra: Tuple[Tuple[str, str], ...] = ()) -> str:
+        """Get the value file key of a sample, cached since label values repeat."""
+        cache_key = (suffix, tuple(labels.items()), extra)
+        key = self._keys.get(cache_key)
+        if key is None:
+            if set(labels) != set(self.labelnames):
+                raise ValueError(f"{self.name} takes the labels {', '.join(self.labelnames)}")
+            key = json.dumps([self.name, suffix, [[name, str(labels[name])] for name in self.labelnames] + list(extra)])
+            self._keys[cache_key] = key
+        return key
+
+class Counter(_Metric):
+    """A value that only goes up, e.g. a number of requests."""
+    kind = 'counter'
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        """
+        Increase the counter.
+
+        Args:
+            amount (float): How much to add
+            **labels (str): Value of each label
+        """
+        _store.add(self._key('_total', labels), amount)
+
+class Histogram(_Metric):
+    """Observations counted in buckets, with their count and sum, e.g. request latencies."""
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value: float, **labels: str) -> None:
+        """
+        Record an observation.
+
+        Args:
+            value (float): The observed value
+            **labels (str): Value of each label
+        """
+        # Buckets are stored individually and made cumulative when exposed
+        bucket = next(bound for bound in self.buckets if value <= bound)
+        _store.add(self._key('_bucket', labels, (('le', _format_value(bucket)),)), 1)
+        _store.add(self._key('_count', labels), 1)
+        _store.add(self._key('_sum', labels), value)
+
+    @contextmanager
+    def time(self, **labels: str) -> Iterator[None]:
+        """Observe the seconds a block of code takes."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+# Requests and responses
+REQUEST_SECONDS = Histogram('randomfile_request_duration_seconds',
+                            "Seconds from receiving a request until its response is sent", ('endpoint', 'method'))
+REQUESTS = Counter('randomfile_requests', "Requests answered", ('endpoint', 'method', 'status'))
+RESPONSE_BYTES = Counter('randomfile_response_bytes', "Bytes of response bodies sent", ('endpoint',))
+
+# Filesystem scans
+FS_SCANS = Counter('randomfile_fs_scans', "Directories listed with scandir or os.walk", ('scan',))
+FS_ENTRIES = Counter('randomfile_fs_entries', "Directory entries visited while scanning", ('scan',))
+FS_SCAN_SECONDS = Histogram('randomfile_fs_scan_duration_seconds', "Seconds spent scanning directories", ('scan',))
+
+# Conversions and transcodes
+CONVERSIONS = Counter('randomfile_conversions', "Files converted or transcoded", ('kind', 'outcome'))
+CONVERSION_SECONDS = Histogram('randomfile_conversion_duration_seconds',
+                               "Seconds to convert or transcode a file", ('kind',),
+                               (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0))
+
+# Caches
+CACHE_LOOKUPS = Counter('randomfile_cache_lookups', "Cache lookups by cache and result (hit or miss)",
+                        ('cache', 'result'))
+
+def cache_lookup(cache: str, hit: bool) -> None:
+    """Count a lookup in one of the caches, noting its result on the current request."""
+    result = 'hit' if hit else 'miss'
+    CACHE_LOOKUPS.inc(cache=cache, result=result)
+    if has_request_context():
+        # The last lookup in each cache wins, which is what the access log reports
+        g.setdefault('cache_lookups', {})[cache] = result
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return '+Inf'
+    if value.is_integer() and abs(value) < 1e15:
+        return str(int(value))
+    return repr(value)
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def _format_labels(labels: List[Tuple[str, str]]) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in labels) + '}'
+
+def render() -> str:
+    """
+    Expose the metrics of all processes in the Prometheus text format.
+
+    Returns:
+        str: The exposition
+    """
+    samples: Dict[str, Dict[str, Dict[tuple, float]]] = defaultdict(lambda: defaultdict(dict))
+    for key, value in _store.collect().items():
+        try:
+            name, suffix, labels = json.loads(key)
+        except ValueError:
+            continue
+        samples[name][suffix][tuple(tuple(label) for label in labels)] = value
+
+    lines = []
+    for name, metric in _registry.items():
+        lines.append(f"# HELP {name} {metric.documentation}")
+        lines.append(f"# TYPE {name} {metric.kind}")
+        family = samples.get(name, {})
+        if metric.kind == 'counter':
+            for labels, value in sorted(family.get('_total', {}).items()):
+                lines.append(f"{name}_total{_format_labels(list(labels))} {_format_value(value)}")
+            continue
+
+        # Histogram buckets are cumulative: each counts the observations up to its bound
+        bounds = {_format_value(bound): i for i, bound in enumerate(metric.buckets)}
+        for labels, count in sorted(family.get('_count', {}).items()):
+            counts = [0.0] * len(metric.buckets)
+            for bucket_labels, value in family.get('_bucket', {}).items():
+                if bucket_labels[:-1] == labels and bucket_labels[-1][1] in bounds:
+                    counts[bounds[bucket_labels[-1][1]]] += value
+            cumulative = 0.0
+            for bound, value in zip(metric.buckets, counts):
+                cumulative += value
+                bucket = list(labels) + [('le', _format_value(bound))]
+                lines.append(f"{name}_bucket{_format_labels(bucket)} {_format_value(cumulative)}")
+            lines.append(f"{name}_count{_format_labels(list(labels))} {_format_value(count)}")
+            lines.append(f"{name}_sum{_format_labels(list(labels))} {repr(family.get('_sum', {}).get(labels, 0.0))}")
+    return '\n'.join(lines) + '\n'
+
+def _count_bytes(body: Iterator[bytes], endpoint: str, environ: dict) -> Iterator[bytes]:
+    """Pass a streamed response body through, counting its bytes."""
+    sent = 0
+    try:
+        for chunk in body:
+            sent += len(chunk)
+            yield chunk
+    finally:
+        environ[BYTES_SENT_ENVIRON] = sent
+        RESPONSE_BYTES.inc(sent, endpoint=endpoint)
+
+def on_response_sent(response: Response, callback: Callable[[], None]) -> None:
+    """
+    Run a callback once a response has been sent, or the client has gone away.
+
+    Werkzeug hands the file wrapper of a send_file response to the server as
+    it is, so the server can use sendfile, and never runs the response's
+    call_on_close callbacks for it. The wrapper's own close is extended
+    instead; the callback still runs only once if both are called.
+
+    Args:
+        response (Response): The response being returned
+        callback (Callable[[], None]): What to run
+    """
+    done = []
+
+    def run_once() -> None:
+        if not done:
+            done.append(True)
+            callback()
+
+    body = response.response
+    if response.direct_passthrough and hasattr(body, 'close'):
+        close = body.close
+
+        def close_and_run() -> None:
+            try:
+                close()
+            finally:
+                run_once()
+        body.close = close_and_run
+    response.call_on_close(run_once)
+
+def configure(directory: Optional[Path]) -> None:
+    """
+    Set the directory this process keeps its metric values in.
+
+    Args:
+        directory (Optional[Path]): The directory shared by the app's processes, or None to stop recording
+    """
+    _store.configure(directory)
+
+def init_metrics(app: Flask) -> None:
+    """
+    Record request metrics for an app and keep the values in its METRICS_PATH.
+
+    Requests are timed until their response has been sent, so the latency of
+    a download includes sending the file. The endpoint and bytes sent are
+    left in the WSGI environ for the access log whether or not metrics are
+    enabled.
+
+    Args:
+        app (Flask): The Flask application
+    """
+    if app.config.get('METRICS_ENABLED'):
+        configure(app.config['METRICS_PATH'])
+
+    @app.before_request
+    def start_timer():
+        g.metrics_start = time.perf_counter()
+
+    @app.after_request
+    def record_request(response):
+        start = g.pop('metrics_start', None)
+        if start is None:
+            return response
+        # Unmatched URLs share one label, so scanners cannot add series
+        endpoint = request.endpoint or 'unmatched'
+        method = request.method
+        environ = request.environ
+        # The ASGI adapter counts the bytes of the files it sends itself
+        environ[ENDPOINT_ENVIRON] = endpoint
+        REQUESTS.inc(endpoint=endpoint, method=method, status=str(response.status_code))
+
+        if response.is_streamed and response.content_length is None:
+            response.response = _count_bytes(response.response, endpoint, environ)
+        else:
+            sent = (response.content_length or 0) if method != 'HEAD' else 0
+            environ[BYTES_SENT_ENVIRON] = sent
+            if sent:
+                RESPONSE_BYTES.inc(sent, endpoint=endpoint)
+
+        on_response_sent(response, lambda: REQUEST_SECONDS.observe(time.perf_counter() - start,
+                                                                  endpoint=endpoint, method=method))
+        return response
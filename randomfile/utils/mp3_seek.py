@@ -0,0 +1,191 @@
+import mmap
+from array import array
+from pathlib import Path
+from typing import Iterator, NamedTuple, Optional, Tuple
+
+# Layer III bitrates in kbit/s by bitrate index, for MPEG-1 and for MPEG-2/2.5
+_MPEG1_BITRATES = (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320)
+_MPEG2_BITRATES = (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160)
+
+# Sample rates by version bits (3: MPEG-1, 2: MPEG-2, 0: MPEG-2.5) and sample rate index
+_SAMPLE_RATES = {3: (44100, 48000, 32000), 2: (22050, 24000, 16000), 0: (11025, 12000, 8000)}
+
+# Bytes searched after the ID3v2 tags for the first frame before a file is deemed not to be MPEG audio
+_SYNC_LIMIT = 64 * 1024
+
+# Seconds of audio between the frames whose offsets are kept
+SEEK_POINT_SECONDS = 1.0
+
+class _Frame(NamedTuple):
+    length: int
+    samples: int
+    sample_rate: int
+    header: int
+
+class SeekTable(NamedTuple):
+    """
+    Positions of the audio frames of an MP3 file.
+
+    Every frame of a file holds the same number of samples, so the frame
+    playing at a time follows from the sample rate; ``offsets`` holds the
+    byte offset of every ``step``-th frame, and the frames in between are
+    found by reading the few frame headers that follow.
+    """
+    sample_rate: int
+    frame_samples: int
+    frames: int
+    step: int
+    offsets: array
+
+    @property
+    def duration(self) -> float:
+        """Seconds of audio in the file."""
+        return self.frames * self.frame_samples / self.sample_rate if self.frames else 0.0
+
+# Table of files without MPEG audio frames, which cannot be seeked in
+EMPTY_SEEK_TABLE = SeekTable(0, 0, 0, 1, array('Q'))
+
+def _parse_header(data: mmap.mmap, pos: int) -> Optional[_Frame]:
+    """Parse the Layer III frame header at a position, None if there is none."""
+    header = int.from_bytes(data[pos:pos + 4], 'big')
+    if header & 0xFFE00000 != 0xFFE00000:
+        return None
+    version = (header >> 19) & 3
+    layer = (header >> 17) & 3
+    bitrate_index = (header >> 12) & 15
+    rate_index = (header >> 10) & 3
+    if version == 1 or layer != 1 or bitrate_index in (0, 15) or rate_index == 3:
+        # Reserved values, other layers and free-format streams
+        return None
+    mpeg1 = version == 3
+    bitrate = (_MPEG1_BITRATES if mpeg1 else _MPEG2_BITRATES)[bitrate_index] * 1000
+    sample_rate = _SAMPLE_RATES[version][rate_index]
+    samples = 1152 if mpeg1 else 576
+    return _Frame(samples // 8 * bitrate // sample_rate + ((header >> 9) & 1), samples, sample_rate, header)
+
+def _sync(data: mmap.mmap, pos: int, sample_rate: Optional[int] = None, limit: Optional[int] = None) -> Optional[int]:
+    """
+    Find the next frame, taking a header for one only when another follows it.
+
+    Args:
+        data (mmap.mmap): The file
+        pos (int): Where to start looking
+        sample_rate (Optional[int]): The sample rate of the stream's frames, once known
+        limit (Optional[int]): Where to stop looking (default: the end of the file)
+
+    Returns:
+        Optional[int]: The frame's offset, or None if there is none
+    """
+    end = len(data)
+    while True:
+        pos = data.find(b'\xff', pos, end if limit is None else min(limit, end))
+        if pos < 0:
+            return None
+        frame = _parse_header(data, pos)
+        if frame is not None and sample_rate in (None, frame.sample_rate):
+            following = pos + frame.length
+            if following == end:
+                return pos
+            if following + 4 <= end:
+                next_frame = _parse_header(data, following)
+                if next_frame is not None and next_frame.sample_rate == frame.sample_rate:
+                    return pos
+        pos += 1
+
+def _frames(data: mmap.mmap, pos: int, sample_rate: int) -> Iterator[int]:
+    """Get the offsets of the frames from a frame on, skipping junk between frames and stopping at the tags at the end."""
+    end = len(data)
+    while pos + 4 <= end:
+        frame = _parse_header(data, pos)
+        if frame is not None and frame.sample_rate == sample_rate and pos + frame.length <= end:
+            yield pos
+            pos += frame.length
+            continue
+        if data[pos:pos + 3] == b'TAG' or data[pos:pos + 8] == b'APETAGEX':
+            return
+        pos = _sync(data, pos + 1, sample_rate)
+        if pos is None:
+            return
+
+def _audio_start(data: mmap.mmap) -> Optional[Tuple[int, _Frame]]:
+    """Find the first audio frame, after any ID3v2 tags and Xing, Info or VBRI header frame."""
+    pos = 0
+    while data[pos:pos + 3] == b'ID3' and pos + 10 <= len(data):
+        size = 0
+        for byte in data[pos + 6:pos + 10]:
+            size = size << 7 | byte & 0x7F
+        # A footer, flagged in the header, adds another ten bytes
+        pos += 10 + size + (10 if data[pos + 5] & 0x10 else 0)
+
+    pos = _sync(data, pos, limit=pos + _SYNC_LIMIT)
+    if pos is None:
+        return None
+    frame = _parse_header(data, pos)
+
+    # The header frames of VBR encoders hold no audio: Xing or Info after the side information, VBRI at 32 bytes
+    mpeg1 = (frame.header >> 19) & 3 == 3
+    mono = (frame.header >> 6) & 3 == 3
+    side_info = (17 if mono else 32) if mpeg1 else (9 if mono else 17)
+    if data[pos + 4 + side_info:pos + 8 + side_info] in (b'Xing', b'Info') or data[pos + 36:pos + 40] == b'VBRI':
+        pos = next(_frames(data, pos + frame.length, frame.sample_rate), None)
+        if pos is None:
+            return None
+    return pos, frame
+
+def build_seek_table(file_path: Path) -> SeekTable:
+    """
+    Scan the frames of an MP3 file for its seek table.
+
+    The table records where every frame starts rather than the hundred
+    positions of a Xing or VBRI header, which are only accurate to a
+    hundredth of the duration; the scan reads the file once.
+
+    Args:
+        file_path (Path): The MP3 file
+
+    Returns:
+        SeekTable: The file's seek table, EMPTY_SEEK_TABLE if it holds no MPEG audio
+    """
+    with open(file_path, 'rb') as file:
+        if not file.seek(0, 2):
+            return EMPTY_SEEK_TABLE
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            start = _audio_start(data)
+            if start is None:
+                return EMPTY_SEEK_TABLE
+            pos, first = start
+            step = max(1, round(SEEK_POINT_SECONDS * first.sample_rate / first.samples))
+            offsets = array('Q')
+            frames = 0
+            for offset in _frames(data, pos, first.sample_rate):
+                if frames % step == 0:
+                    offsets.append(offset)
+                frames += 1
+    return SeekTable(first.sample_rate, first.samples, frames, step, offsets)
+
+def find_frame(file_path: Path, table: SeekTable, seconds: float) -> Optional[Tuple[int, float]]:
+    """
+    Find the frame of an MP3 file playing at a time.
+
+    Args:
+        file_path (Path): The MP3 file
+        table (SeekTable): The file's seek table
+        seconds (float): Time from the start of the audio
+
+    Returns:
+        Optional[Tuple[int, float]]: The frame's byte offset and the time it starts
+            at, or None if the file has no audio at that time
+    """
+    frame = int(seconds * table.sample_rate / table.frame_samples) if table.frames else 0
+    if not 0 <= frame < table.frames:
+        return None
+    offset = table.offsets[frame // table.step]
+    if frame % table.step:
+        with open(file_path, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            frames = _frames(data, offset, table.sample_rate)
+            for _ in range(frame % table.step + 1):
+                offset = next(frames, None)
+                if offset is None:
+                    # The file changed since it was scanned
+                    return None
+    return offset, frame * table.frame_samples / table.sample_rate
@@ -0,0 +1,112 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Optional
+
+from flask import Flask, current_app, render_template, session
+from markupsafe import Markup
+
+from randomfile.utils.metrics import cache_lookup
+
+class FragmentCache:
+    """
+    Rendered template fragments, least recently used first out.
+
+    Keys carry the version of the data a fragment was rendered from, so a
+    change makes new keys and the old fragments age out.
+    """
+
+    def __init__(self, max_entries: int):
+        """
+        Args:
+            max_entries (int): Number of fragments kept
+        """
+        self.max_entries = max_entries
+        self._fragments: "OrderedDict[Hashable, Markup]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def render(self, template: str, key: Hashable, context: Callable[[], Dict[str, Any]]) -> Markup:
+        """
+        Render a template fragment, or reuse the one rendered for the same key.
+
+        Args:
+            template (str): The template to render
+            key (Hashable): What the fragment depends on, including the data's version
+            context (Callable[[], Dict[str, Any]]): Builds the template's variables on a cache miss
+
+        Returns:
+            Markup: The rendered fragment, safe to insert into another template
+        """
+        key = (template, key)
+        with self._lock:
+            fragment = self._fragments.get(key)
+            if fragment is not None:
+                self._fragments.move_to_end(key)
+        cache_lookup('fragment', fragment is not None)
+        if fragment is not None:
+            return fragment
+
+        fragment = Markup(render_template(template, **context()))
+        with self._lock:
+            self._fragments[key] = fragment
+            while len(self._fragments) > self.max_entries:
+                self._fragments.popitem(last=False)
+        return fragment
+
+    def clear(self) -> None:
+        """Drop every fragment."""
+        with self._lock:
+            self._fragments.clear()
+
+def get_fragment_cache(app: Flask) -> FragmentCache:
+    """
+    Get the fragment cache of an app.
+
+    Args:
+        app (Flask): The Flask application
+
+    Returns:
+        FragmentCache: The app's fragment cache
+    """
+    cache = app.extensions.get('randomfile_fragments')
+    if cache is None:
+        cache = FragmentCache(app.config['BROWSE_CACHE_SIZE'])
+        app.extensions['randomfile_fragments'] = cache
+    return cache
+
+# Digest of the templates, so a deploy changing them changes every ETag
+_templates_digest: Optional[str] = None
+
+def _templates_version() -> str:
+    global _templates_digest
+    if _templates_digest is None:
+        digest = hashlib.sha1()
+        for name in sorted(current_app.jinja_loader.list_templates()):
+            source, _, _ = current_app.jinja_loader.get_source(current_app.jinja_env, name)
+            digest.update(f"{name}\0{source}\0".encode())
+        _templates_digest = digest.hexdigest()
+    return _templates_digest
+
+def page_etag(version: str) -> str:
+    """
+    Get the ETag of a page rendered from data at a version for the current session.
+
+    Pages embed the session's CSRF token, so the ETag changes with it. The
+    token is signed with the time it was rendered at and expires after
+    WTF_CSRF_TIME_LIMIT, so the ETag also changes every half of that
+    period, before a revalidated copy's token expires.
+
+    Args:
+        version (str): The version of the data the page shows
+
+    Returns:
+        str: The ETag
+    """
+    parts = [_templates_version(), version]
+    if current_app.config.get('WTF_CSRF_ENABLED'):
+        parts.append(str(session.get(current_app.config.get('WTF_CSRF_FIELD_NAME', 'csrf_token'), '')))
+        time_limit = current_app.config.get('WTF_CSRF_TIME_LIMIT', 3600)
+        if time_limit:
+            parts.append(str(int(time.time() // (time_limit / 2))))
+    return hashlib.sha1('\0'.join(parts).encode()).hexdigest()
@@ -0,0 +1,305 @@
+import datetime
+import hmac
+import itertools
+import json
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from pathlib import Path
+from types import CodeType, FrameType
+from typing import Any, Dict, List, Optional
+
+from flask import Flask, current_app, g, request
+
+from randomfile.utils.delivery import ASGI_SENDFILE_HEADER
+from randomfile.utils.metrics import STATUS_ENVIRON, on_response_sent
+
+# Request header asking for a profile of the request, holding the ADMIN_TOKEN
+PROFILE_HEADER = 'X-Randomfile-Profile'
+# Response header naming the profile that will be kept for the request
+PROFILE_ID_HEADER = 'X-Randomfile-Profile-Id'
+
+class _Capture:
+    """Stack samples of one request's thread."""
+
+    def __init__(self, profile_id: str, thread_id: int, forced: bool):
+        self.profile_id = profile_id
+        self.thread_id = thread_id
+        self.forced = forced
+        self.started = time.time()
+        self.start = time.perf_counter()
+        self.stacks: Counter = Counter()
+        self.samples = 0
+
+class Profiler:
+    """
+    Statistical profiler for requests.
+
+    While requests are being profiled, a background thread looks at their
+    threads' stacks every ``interval`` seconds and counts each distinct
+    stack. Nothing is traced, so the cost is one stack walk per request and
+    sample whatever the request does; when no request is in flight the
+    thread sleeps.
+
+    Profiles of requests slower than ``slow_seconds``, or asked for with the
+    profile header, are kept in ``directory``, where only the ``keep`` most
+    recent are retained. Stacks are stored in the folded format of
+    flamegraph.pl, which speedscope also reads.
+    """
+
+    def __init__(self, directory: Path, interval: float = 0.01, slow_seconds: float = 1.0, keep: int = 100):
+        """
+        Args:
+            directory (Path): Where profiles are kept, shared by the worker processes
+            interval (float): Seconds between samples
+            slow_seconds (float): Latency above which a request's profile is kept, or 0 to only keep asked for ones
+            keep (int): Number of profiles retained
+        """
+        self.directory = Path(directory)
+        self.interval = interval
+        self.slow_seconds = slow_seconds
+        self.keep = keep
+        self._lock = threading.Lock()
+        self._busy = threading.Event()
+        self._active: Dict[int, _Capture] = {}
+        self._labels: Dict[CodeType, str] = {}
+        self._ids = itertools.count()
+        self._pid: Optional[int] = None
+
+    def begin(self, forced: bool = False) -> _Capture:
+        """
+        Start sampling the current thread.
+
+        Args:
+            forced (bool): Keep the profile whatever the request's latency
+
+        Returns:
+            _Capture: The samples, to pass to ``end``
+        """
+        if self._pid != os.getpid():
+            self._start_sampler()
+        profile_id = f"{int(time.time() * 1000)}-{os.getpid()}-{next(self._ids)}"
+        capture = _Capture(profile_id, threading.get_ident(), forced)
+        with self._lock:
+            self._active[id(capture)] = capture
+            self._busy.set()
+        return capture
+
+    def end(self, capture: _Capture, info: Dict[str, Any]) -> Optional[str]:
+        """
+        Stop sampling a request and keep its profile if it was slow or asked for.
+
+        Args:
+            capture (_Capture): What ``begin`` returned
+            info (Dict[str, Any]): Details of the request stored with the profile
+
+        Returns:
+            Optional[str]: The id of the profile kept, or None
+        """
+        duration = time.perf_counter() - capture.start
+        with self._lock:
+            self._active.pop(id(capture), None)
+            if not self._active:
+                self._busy.clear()
+        slow = self.slow_seconds > 0 and duration >= self.slow_seconds
+        if not capture.forced and not (slow and capture.samples):
+            return None
+
+        profile = dict(
+            info,
+            id=capture.profile_id,
+            started=datetime.datetime.fromtimestamp(capture.started, datetime.timezone.utc).isoformat(
+                timespec='milliseconds'),
+            duration_ms=round(duration * 1000, 3),
+            trigger='header' if capture.forced else 'slow',
+            interval_ms=self.interval * 1000,
+            samples=capture.samples,
+            stacks=dict(capture.stacks)
+        )
+        self._save(profile)
+        return capture.profile_id
+
+    def _start_sampler(self) -> None:
+        """Start this process's sampler; a forked process inherits the profiler but not the thread."""
+        with self._lock:
+            pid = os.getpid()
+            if self._pid == pid:
+                return
+            self._active.clear()
+            threading.Thread(target=self._run, name="profiler", daemon=True).start()
+            self._pid = pid
+
+    def _run(self) -> None:
+        """Sample the stacks of the requests in flight."""
+        while True:
+            self._busy.wait()
+            time.sleep(self.interval)
+            frames = sys._current_frames()
+            with self._lock:
+                for capture in self._active.values():
+                    frame = frames.get(capture.thread_id)
+                    if frame is not None:
+                        capture.stacks[self._fold(frame)] += 1
+                        capture.samples += 1
+            del frames
+
+    def _fold(self, frame: Optional[FrameType]) -> str:
+        """Turn a stack into a line of the folded format, outermost frame first."""
+        labels = []
+        while frame is not None:
+            code = frame.f_code
+            label = self._labels.get(code)
+            if label is None:
+                module = frame.f_globals.get('__name__') or code.co_filename
+                label = f"{module}:{getattr(code, 'co_qualname', code.co_name)}".replace(';', ':').replace(' ', '_')
+                self._labels[code] = label
+            labels.append(label)
+            frame = frame.f_back
+        labels.reverse()
+        return ';'.join(labels)
+
+    def _save(self, profile: Dict[str, Any]) -> None:
+        """Write a profile and drop the oldest beyond the ones retained."""
+        self.directory.mkdir(parents=True, exist_ok=True)
+        path = self.directory / f"{profile['id']}.json"
+        temp_path = path.with_suffix('.tmp')
+        temp_path.write_text(json.dumps(profile))
+        os.replace(temp_path, path)
+
+        # Ids start with the time in milliseconds, so names sort oldest first
+        profiles = sorted(self.directory.glob('*.json'))
+        for old in profiles[:max(0, len(profiles) - self.keep)]:
+            try:
+                old.unlink()
+            except FileNotFoundError:
+                # Another worker pruned it
+                pass
+
+    def list(self) -> List[Dict[str, Any]]:
+        """
+        List the profiles kept, most recent first.
+
+        Returns:
+            List[Dict[str, Any]]: Details of each profile, without its stacks
+        """
+        profiles = []
+        for path in sorted(self.directory.glob('*.json'), reverse=True):
+            try:
+                profile = json.loads(path.read_text())
+            except (OSError, ValueError):
+                continue
+            profile.pop('stacks', None)
+            profiles.append(profile)
+        return profiles
+
+    def get(self, profile_id: str) -> Optional[Dict[str, Any]]:
+        """
+        Get a profile.
+
+        Args:
+            profile_id (str): The profile's id
+
+        Returns:
+            Optional[Dict[str, Any]]: The profile, or None if it is unknown or was dropped
+        """
+        if not profile_id.replace('-', '').isdigit():
+            return None
+        try:
+            return json.loads((self.directory / f"{profile_id}.json").read_text())
+        except (OSError, ValueError):
+            return None
+
+def folded(profile: Dict[str, Any]) -> str:
+    """
+    Render a profile's stacks in the folded format read by flamegraph.pl and speedscope.
+
+    Args:
+        profile (Dict[str, Any]): A profile from ``Profiler.get``
+
+    Returns:
+        str: One ``frame;frame;frame count`` line per distinct stack
+    """
+    return ''.join(f"{stack} {count}\n" for stack, count in profile['stacks'].items())
+
+def is_admin() -> bool:
+    """Check the current request carries the ADMIN_TOKEN as a bearer token; always false without one."""
+    token = current_app.config.get('ADMIN_TOKEN')
+    if not token:
+        return False
+    scheme, _, credentials = request.headers.get('Authorization', '').partition(' ')
+    return scheme.lower() == 'bearer' and hmac.compare_digest(credentials.strip().encode(), token.encode())
+
+def get_profiler(app: Flask) -> Optional[Profiler]:
+    """
+    Get the profiler of an app.
+
+    Args:
+        app (Flask): The Flask application
+
+    Returns:
+        Optional[Profiler]: The profiler, or None if PROFILER is disabled
+    """
+    return app.extensions.get('randomfile_profiler')
+
+def init_profiler(app: Flask) -> None:
+    """
+    Profile an app's requests that are slower than PROFILE_SLOW_MS or carry the profile header.
+
+    Requests are sampled until their response has been sent, or for file
+    responses until the handler returns. The profile
+    header must hold the ADMIN_TOKEN; its response names the profile in
+    the profile id header.
+
+    Args:
+        app (Flask): The Flask application
+    """
+    if not app.config.get('PROFILER'):
+        return
+    profiler = Profiler(
+        app.config['PROFILE_PATH'],
+        app.config['PROFILE_INTERVAL_MS'] / 1000,
+        app.config['PROFILE_SLOW_MS'] / 1000,
+        app.config['PROFILE_KEEP']
+    )
+    app.extensions['randomfile_profiler'] = profiler
+    token = app.config.get('ADMIN_TOKEN')
+
+    @app.before_request
+    def start_profile():
+        asked = request.headers.get(PROFILE_HEADER)
+        forced = bool(asked and token and hmac.compare_digest(asked.encode(), token.encode()))
+        if forced or profiler.slow_seconds > 0:
+            g.profile = profiler.begin(forced)
+
+    @app.after_request
+    def finish_profile(response):
+        capture = g.pop('profile', None)
+        if capture is None:
+            return response
+        if capture.forced:
+            response.headers[PROFILE_ID_HEADER] = capture.profile_id
+        info = {'method': request.method, 'path': request.path, 'endpoint': request.endpoint}
+        status = response.status_code
+        environ = request.environ
+
+        if response.direct_passthrough or ASGI_SENDFILE_HEADER in response.headers:
+            # Files are sent by the server's file wrapper or the ASGI adapter at the client's pace,
+            # which says nothing about the app, so the request is measured to the end of its handler
+            info['status'] = status
+            profiler.end(capture, info)
+            return response
+
+        def end() -> None:
+            info['status'] = environ.get(STATUS_ENVIRON, status)
+            profiler.end(capture, info)
+        on_response_sent(response, end)
+        return response
+
+    @app.teardown_request
+    def drop_profile(exc):
+        # Requests whose response was never finished, e.g. when another after_request hook failed
+        capture = g.pop('profile', None)
+        if capture is not None:
+            profiler.end(capture, {'method': request.method, 'path': request.path, 'endpoint': request.endpoint})
@@ -0,0 +1,343 @@
+import logging
+import random
+import sqlite3
+import threading
+import time
+from array import array
+from bisect import bisect_right
+from contextlib import closing
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+
+from flask import Flask
+
+from randomfile.utils.catalog import Catalog
+from randomfile.utils.library_index import LibraryIndex, Snapshot
+
+# Sampling strategies
+UNIFORM_FILE = 'file'            # Every file equally likely
+UNIFORM_DIRECTORY = 'directory'  # Every directory with files equally likely, then a file in it
+WEIGHTED_DURATION = 'duration'   # Longer files more likely
+WEIGHTED_PLAYS = 'plays'         # Files played less often more likely
+SHUFFLE = 'shuffle'              # Every file once before any repeats, per listener
+WEIGHTED_UNIQUE = 'unique'       # Every distinct content equally likely, however many copies it has
+STRATEGIES = (UNIFORM_FILE, UNIFORM_DIRECTORY, WEIGHTED_DURATION, WEIGHTED_PLAYS, SHUFFLE, WEIGHTED_UNIQUE)
+
+logger = logging.getLogger(__name__)
+
+_MASK64 = (1 << 64) - 1
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS bags (
+    session TEXT NOT NULL,
+    scope TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    seed INTEGER NOT NULL,
+    position INTEGER NOT NULL,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (session, scope)
+)
+"""
+
+def _mix(value: int) -> int:
+    """Scramble a 64-bit integer (the splitmix64 finalizer)."""
+    value = ((value ^ (value >> 30)) * 0xBF58476D1CE4E5B9) & _MASK64
+    value = ((value ^ (value >> 27)) * 0x94D049BB133111EB) & _MASK64
+    return value ^ (value >> 31)
+
+def permute(i: int, n: int, seed: int) -> int:
+    """
+    Map a position to its place in a pseudo-random permutation of range(n).
+
+    A four-round Feistel network shuffles the smallest even power of two
+    covering n, and positions that land outside range(n) are walked through
+    the network again until they come back inside. Every seed gives a
+    different permutation, and no state beyond the seed is needed.
+
+    Args:
+        i (int): Position in range(n)
+        n (int): Size of the permutation
+        seed (int): Selects the permutation
+
+    Returns:
+        int: The permuted position, also in range(n)
+    """
+    half = max(1, ((n - 1).bit_length() + 1) // 2)
+    mask = (1 << half) - 1
+    while True:
+        left, right = i >> half, i & mask
+        for round_key in range(4):
+            left, right = right, left ^ (_mix((right + seed * 4 + round_key) & _MASK64) & mask)
+        i = (left << half) | right
+        if i < n:
+            return i
+
+class ShuffleBagStore:
+    """
+    Shuffle bags shared by all workers through SQLite.
+
+    A bag deals every file of a scope once, in random order, before any file
+    repeats. It is stored as a permutation seed and a position, so a draw
+    costs O(1) per file however large the library is. Bags are reshuffled
+    when the number of files in their scope changes.
+    """
+
+    def __init__(self, db_path: Path, ttl: float = 7 * 24 * 3600):
+        """
+        Args:
+            db_path (Path): Location of the SQLite database
+            ttl (float): Seconds after which unused bags are deleted
+        """
+        self.db_path = Path(db_path)
+        self.ttl = ttl
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        with closing(self._connect()) as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(_SCHEMA)
+
+    def _connect(self) -> sqlite3.Connection:
+        """Open a connection to the bag database in autocommit mode."""
+        return sqlite3.connect(str(self.db_path), timeout=30, isolation_level=None)
+
+    def draw(self, session: str, scope: str, size: int, count: int) -> List[int]:
+        """
+        Deal positions from a bag, starting a new round once it is empty.
+
+        Args:
+            session (str): Listener the bag belongs to
+            scope (str): What the bag deals from, e.g. a directory
+            size (int): Number of items in the scope
+            count (int): Number of positions to deal, at most size
+
+        Returns:
+            List[int]: Distinct positions in range(size)
+        """
+        count = min(count, size)
+        now = time.time()
+        with closing(self._connect()) as conn:
+            # Take the write lock up front so two workers never deal the same position
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute(
+                    "SELECT size, seed, position FROM bags WHERE session = ? AND scope = ?", (session, scope)
+                ).fetchone()
+                if row is None or row[0] != size:
+                    seed, position = random.getrandbits(62), 0
+                else:
+                    _, seed, position = row
+
+                dealt: List[int] = []
+                while len(dealt) < count:
+                    if position >= size:
+                        # Round finished: reshuffle, skipping what this draw already dealt
+                        seed, position = random.getrandbits(62), 0
+                    item = permute(position, size, seed)
+                    position += 1
+                    if item not in dealt:
+                        dealt.append(item)
+
+                conn.execute(
+                    "INSERT OR REPLACE INTO bags (session, scope, size, seed, position, updated_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (session, scope, size, seed, position, now)
+                )
+                if random.random() < 0.01:
+                    conn.execute("DELETE FROM bags WHERE updated_at < ?", (now - self.ttl,))
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        return dealt
+
+class Sampler:
+    """
+    Draws random files from the library index with a selectable strategy.
+
+    Non-uniform strategies use tables laid out in the index's depth-first
+    order, where every directory's subtree is a contiguous range: a running
+    count of the directories that hold files, and running sums of the file
+    weights. A draw picks a point in the directory's slice of a table and
+    finds it by binary search, so it costs O(log n). The tables are rebuilt
+    in each process when the index changes, by one thread while draws on
+    the others wait for it. Weight tables also follow the catalog: after
+    ``weights_ttl`` seconds a background thread rebuilds them, and draws
+    use the old table until the new one is ready.
+    """
+
+    def __init__(self, index: LibraryIndex, catalog: Catalog, bags: ShuffleBagStore, weights_ttl: float = 60):
+        """
+        Args:
+            index (LibraryIndex): The library index to draw from
+            catalog (Catalog): Source of durations, play counts and duplicates
+            bags (ShuffleBagStore): Shuffle bags for the shuffle strategy
+            weights_ttl (float): Seconds a weight table is used before it is rebuilt
+        """
+        self.index = index
+        self.catalog = catalog
+        self.bags = bags
+        self.weights_ttl = weights_ttl
+        # Strategy -> (snapshot, time built, table)
+        self._tables: Dict[str, Tuple[Snapshot, float, array]] = {}
+        self._lock = threading.Lock()
+        # Held while a strategy's table is built, so it is built once
+        self._build_locks = {strategy: threading.Lock() for strategy in STRATEGIES}
+        # Strategies whose expired weights are being rebuilt in the background
+        self._refreshing = set()
+
+    def draw(self, rel_dir: str, count: int, strategy: str = UNIFORM_FILE,
+             session: Optional[str] = None) -> List[str]:
+        """
+        Draw up to ``count`` distinct files from a directory including subdirectories.
+
+        Args:
+            rel_dir (str): Directory path relative to the base path
+            count (int): Number of files to draw
+            strategy (str): One of STRATEGIES
+            session (Optional[str]): Listener id, required by the shuffle strategy
+
+        Returns:
+            List[str]: Relative paths of the drawn files
+
+        Raises:
+            ValueError: If the strategy is unknown or a shuffle has no session
+        """
+        if strategy not in STRATEGIES:
+            raise ValueError(f"Unsupported strategy: {strategy}")
+        if strategy == SHUFFLE and session is None:
+            raise ValueError("The shuffle strategy needs a session")
+
+        def choose(snapshot: Snapshot, d: int) -> List[int]:
+            start, end = snapshot.dir_starts[d], snapshot.dir_ends[d]
+            n = end - start
+            if strategy == UNIFORM_FILE:
+                return [start + i for i in random.sample(range(n), min(count, n))]
+            if strategy == SHUFFLE:
+                return [start + i for i in self.bags.draw(session, rel_dir, n, count)]
+            if strategy == UNIFORM_DIRECTORY:
+                return _distinct(lambda: self._draw_directory(snapshot, d), count, n)
+            return _distinct(lambda: self._draw_weighted(snapshot, strategy, start, end), count, n)
+
+        return self.index.select(rel_dir, choose)
+
+    def _table(self, snapshot: Snapshot, strategy: str, build: Callable[[Snapshot], array]) -> array:
+        """Get a table for the snapshot, building it if it is missing and refreshing it if it expired."""
+        with self._lock:
+            cached = self._tables.get(strategy)
+            if cached is not None and cached[0] is snapshot:
+                if (strategy != UNIFORM_DIRECTORY and time.monotonic() - cached[1] >= self.weights_ttl
+                        and strategy not in self._refreshing):
+                    # The expired table still matches the snapshot, so it serves until the new one is built
+                    self._refreshing.add(strategy)
+                    threading.Thread(target=self._refresh, args=(snapshot, strategy, build),
+                                     name=f"sampling-{strategy}", daemon=True).start()
+                return cached[2]
+
+        with self._build_locks[strategy]:
+            with self._lock:
+                cached = self._tables.get(strategy)
+            # Another thread may have built it while this one waited
+            if cached is not None and cached[0] is snapshot:
+                return cached[2]
+            table = build(snapshot)
+            with self._lock:
+                self._tables[strategy] = (snapshot, time.monotonic(), table)
+        return table
+
+    def _refresh(self, snapshot: Snapshot, strategy: str, build: Callable[[Snapshot], array]) -> None:
+        """Rebuild an expired table in the background."""
+        try:
+            with self._build_locks[strategy]:
+                table = build(snapshot)
+                with self._lock:
+                    # Unless a table for a newer snapshot took its place meanwhile
+                    cached = self._tables.get(strategy)
+                    if cached is not None and cached[0] is snapshot:
+                        self._tables[strategy] = (snapshot, time.monotonic(), table)
+        except Exception:
+            logger.exception(f"Error rebuilding the {strategy} sampling weights")
+        finally:
+            with self._lock:
+                self._refreshing.discard(strategy)
+
+    @staticmethod
+    def _directory_counts(snapshot: Snapshot) -> array:
+        """Count, before each directory, the directories that hold files themselves."""
+        counts = array('I', [0])
+        total = 0
+        for d in range(snapshot.n_dirs):
+            total += snapshot.dir_files_end[d] > snapshot.dir_starts[d]
+            counts.append(total)
+        return counts
+
+    def _weight_sums(self, snapshot: Snapshot, strategy: str) -> array:
+        """Sum the file weights of a strategy, before each file."""
+        if strategy == WEIGHTED_DURATION:
+            durations = self.catalog.durations()
+            # Files that have not been probed yet count as average length
+            default = sum(durations.values()) / len(durations) if durations else 1.0
+            weight = lambda rel_path: durations.get(rel_path, default)
+        elif strategy == WEIGHTED_PLAYS:
+            plays = self.catalog.play_counts()
+            weight = lambda rel_path: 1.0 / (1 + plays.get(rel_path, 0))
+        else:
+            # Copies of the same content share the chance of a single file
+            copies = self.catalog.copy_counts()
+            weight = lambda rel_path: 1.0 / copies.get(rel_path, 1)
+
+        sums = array('d', [0.0])
+        total = 0.0
+        for i in range(snapshot.n_files):
+            total += max(0.0, weight(snapshot.file(i)))
+            sums.append(total)
+        return sums
+
+    def _draw_directory(self, snapshot: Snapshot, d: int) -> int:
+        """Pick a directory with files below ``d`` uniformly, then one of its own files."""
+        counts = self._table(snapshot, UNIFORM_DIRECTORY, self._directory_counts)
+        k = random.randrange(counts[d], counts[snapshot.dir_subdirs[d]])
+        chosen = bisect_right(counts, k) - 1
+        return random.randrange(snapshot.dir_starts[chosen], snapshot.dir_files_end[chosen])
+
+    def _draw_weighted(self, snapshot: Snapshot, strategy: str, start: int, end: int) -> int:
+        """Pick a file in [start, end) with probability proportional to its weight."""
+        sums = self._table(snapshot, strategy, lambda s: self._weight_sums(s, strategy))
+        low, high = sums[start], sums[end]
+        if high <= low:
+            return random.randrange(start, end)
+        i = bisect_right(sums, random.uniform(low, high)) - 1
+        return min(max(i, start), end - 1)
+
+def _distinct(draw_one: Callable[[], int], count: int, n: int) -> List[int]:
+    """
+    Repeat a draw until it has produced ``count`` distinct results.
+
+    Gives up after a bounded number of attempts, so heavily skewed weights
+    can yield fewer results than asked for.
+    """
+    count = min(count, n)
+    picked: List[int] = []
+    seen = set()
+    for _ in range(count * 20):
+        if len(picked) == count:
+            break
+        i = draw_one()
+        if i not in seen:
+            seen.add(i)
+            picked.append(i)
+    return picked
+
+def get_shuffle_bags(app: Flask) -> ShuffleBagStore:
+    """
+    Get the shuffle bag store for an application, creating it on first use.
+
+    Args:
+        app (Flask): The Flask application
+
+    Returns:
+        ShuffleBagStore: The shuffle bag store
+    """
+    store = app.extensions.get('randomfile_bags')
+    if store is None:
+        store = ShuffleBagStore(app.config['SAMPLING_DB_PATH'])
+        app.extensions['randomfile_bags'] = store
+    return store
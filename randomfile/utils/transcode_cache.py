@@ -0,0 +1,315 @@
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import BinaryIO, Generator, Iterator, Optional
+
+from flask import Flask
+
+from randomfile.utils.audio_utils import stream_transcode
+from randomfile.utils.metrics import CONVERSIONS, CONVERSION_SECONDS, cache_lookup
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Seconds between checks of the cache's total size
+EVICT_INTERVAL = 60.0
+
+# Share of the size limit that may be written to the cache before it is checked sooner
+EVICT_SLACK = 0.05
+
+# Bytes read from a cached file at a time when it is streamed
+_READ_SIZE = 64 * 1024
+
+# Seconds a request streaming a transcode that is still being written waits for more output
+_FOLLOW_INTERVAL = 0.05
+
+logger = logging.getLogger(__name__)
+
+def _mark_used(path: Path) -> None:
+    """Set the access time of a cache file to now, keeping its mtime."""
+    stat = os.stat(path)
+    os.utime(path, ns=(time.time_ns(), stat.st_mtime_ns))
+
+class TranscodeCache:
+    """
+    Size-bounded disk cache of files transcoded to MP3.
+
+    Entries are keyed by the source path and mtime, so editing a source file
+    produces a new entry and the old one ages out. The access time of a cache
+    file records its last use, so its mtime, and with it the ETag and
+    Last-Modified it is served with, stay those of when it was written. The
+    least recently used entries are evicted once the cache grows past its
+    size limit. The size is checked every EVICT_INTERVAL seconds while
+    transcodes are written, or sooner once EVICT_SLACK of the limit has been
+    written since the last check.
+
+    A file is transcoded once at a time on the host, by a background thread
+    writing a part file next to its entry and holding a lock on it until the
+    part file is complete and published as the entry. The request that
+    started it and any others asking for the file meanwhile stream the part
+    file as it grows, so none of them waits on another's client.
+    """
+
+    def __init__(self, cache_dir: Path, max_bytes: int):
+        """
+        Args:
+            cache_dir (Path): Directory holding the cached files
+            max_bytes (int): Maximum total size of the cache
+        """
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_bytes
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self._evict_lock = threading.Lock()
+        # Bytes this process has written to the cache since it last checked its size
+        self._written = 0
+        self._evicted_at: Optional[float] = None
+
+    def path_for(self, source: Path) -> Path:
+        """
+        Get the cache location for a source file.
+
+        Args:
+            source (Path): The source audio file
+
+        Returns:
+            Path: Where the transcoded file is (or would be) cached
+        """
+        key = hashlib.sha1(f"{source}\0{source.stat().st_mtime_ns}".encode()).hexdigest()
+        return self.cache_dir / key[:2] / f"{key}.mp3"
+
+    def lookup(self, source: Path) -> Optional[Path]:
+        """
+        Find a cached transcode of a source file and mark it as recently used.
+
+        Args:
+            source (Path): The source audio file
+
+        Returns:
+            Optional[Path]: The cached MP3, or None on a cache miss
+        """
+        cached = self.path_for(source)
+        try:
+            _mark_used(cached)
+        except FileNotFoundError:
+            cache_lookup('transcode', False)
+            return None
+        cache_lookup('transcode', True)
+        return cached
+
+    def stream(self, source: Path) -> Iterator[bytes]:
+        """
+        Transcode a source file to MP3, yielding chunks as they are produced.
+
+        The output only becomes visible in the cache once the whole file has
+        been transcoded, which carries on if the client goes away. If another
+        request is already transcoding the file, this streams its output
+        instead of starting ffmpeg again.
+
+        Args:
+            source (Path): The source audio file
+
+        Yields:
+            bytes: The next chunk of MP3 data
+
+        Raises:
+            RuntimeError: If the transcode fails after its output started
+        """
+        cached = self.path_for(source)
+        cached.parent.mkdir(parents=True, exist_ok=True)
+        if fcntl is None:
+            yield from self._transcode_inline(source, cached)
+            return
+
+        part = cached.with_suffix('.part')
+        while True:
+            try:
+                file = open(cached, 'rb')
+            except FileNotFoundError:
+                pass
+            else:
+                # Transcoded since the lookup
+                with file:
+                    try:
+                        _mark_used(cached)
+                    except FileNotFoundError:
+                        pass
+                    yield from iter(lambda: file.read(_READ_SIZE), b'')
+                return
+
+            fd = os.open(part, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # Another request is transcoding the file; if it stopped before writing anything, start over
+                if (yield from self._follow(fd, cached)):
+                    return
+                continue
+            except BaseException:
+                os.close(fd)
+                raise
+
+            try:
+                own = os.stat(part).st_ino == os.fstat(fd).st_ino
+            except FileNotFoundError:
+                own = False
+            if not own or cached.exists():
+                # Published or given up on while this request was opening it
+                if own:
+                    os.unlink(part)
+                os.close(fd)
+                continue
+
+            try:
+                # Left behind by a process that died while transcoding
+                os.ftruncate(fd, 0)
+                reader = os.open(part, os.O_RDONLY)
+            except BaseException:
+                os.unlink(part)
+                os.close(fd)
+                raise
+            threading.Thread(
+                target=self._write, args=(source, fd, part, cached), name="transcode", daemon=True
+            ).start()
+            if not (yield from self._follow(reader, cached)):
+                raise RuntimeError(f"Transcoding {source.name} failed")
+            return
+
+    def _write(self, source: Path, fd: int, part: Path, cached: Path) -> None:
+        """Transcode a source file into its locked part file, releasing the lock once it is published or removed."""
+        try:
+            with open(fd, 'wb') as output:
+                written = sum(len(chunk) for chunk in self._transcode(source, output, part, cached))
+        except Exception:
+            logger.exception("Error transcoding %s", source)
+            return
+        self._added(written)
+
+    @staticmethod
+    def _follow(fd: int, cached: Path) -> Generator[bytes, None, bool]:
+        """
+        Stream a part file as it is written, until its writer releases its lock.
+
+        Args:
+            fd (int): The part file, opened by the caller
+            cached (Path): The cache entry the part file is published as
+
+        Yields:
+            bytes: The next chunk of MP3 data
+
+        Returns:
+            bool: True if the part file was published, False if it was given up
+                on before anything was written to it
+
+        Raises:
+            RuntimeError: If the part file was given up on after chunks were sent
+        """
+        sent = False
+        with open(fd, 'rb', buffering=0) as file:
+            done = False
+            while True:
+                chunk = file.read(_READ_SIZE)
+                if chunk:
+                    sent = True
+                    yield chunk
+                elif done:
+                    break
+                else:
+                    try:
+                        fcntl.flock(file, fcntl.LOCK_SH | fcntl.LOCK_NB)
+                        # The writer is finished; read what it wrote last
+                        done = True
+                    except BlockingIOError:
+                        time.sleep(_FOLLOW_INTERVAL)
+
+            try:
+                published = os.stat(cached).st_ino == os.fstat(file.fileno()).st_ino
+            except FileNotFoundError:
+                published = False
+        if not published and sent:
+            raise RuntimeError("Transcoding failed after its output started")
+        return published
+
+    def _transcode_inline(self, source: Path, cached: Path) -> Iterator[bytes]:
+        """Transcode a source file into its cache entry on the request's own thread, where files cannot be locked."""
+        fd, temp_path = tempfile.mkstemp(dir=cached.parent, suffix='.part')
+        written = 0
+        with os.fdopen(fd, 'wb') as output:
+            for chunk in self._transcode(source, output, Path(temp_path), cached):
+                written += len(chunk)
+                yield chunk
+        self._added(written)
+
+    def _transcode(self, source: Path, output: BinaryIO, part: Path, cached: Path) -> Iterator[bytes]:
+        """Transcode a source file through its part file into its cache entry, yielding chunks as they are written."""
+        start = time.perf_counter()
+        try:
+            for chunk in stream_transcode(str(source), 'mp3'):
+                output.write(chunk)
+                # Other requests read the part file while it is written
+                output.flush()
+                yield chunk
+            os.replace(part, cached)
+        except BaseException:
+            # ffmpeg failures and, without locks, client disconnects leave nothing behind
+            os.unlink(part)
+            CONVERSIONS.inc(kind='transcode', outcome='failed')
+            raise
+
+        CONVERSIONS.inc(kind='transcode', outcome='converted')
+        CONVERSION_SECONDS.observe(time.perf_counter() - start, kind='transcode')
+
+    def _added(self, written: int) -> None:
+        """Count bytes written to the cache, evicting entries once a size check is due."""
+        with self._evict_lock:
+            self._written += written
+            due = (self._evicted_at is None or self._written >= self.max_bytes * EVICT_SLACK
+                   or time.monotonic() - self._evicted_at >= EVICT_INTERVAL)
+        if due:
+            self.evict()
+
+    def evict(self) -> None:
+        """Delete the least recently used entries until the cache fits its size limit."""
+        with self._evict_lock:
+            self._written = 0
+            self._evicted_at = time.monotonic()
+            entries = []
+            total = 0
+            for path in self.cache_dir.glob('*/*.mp3'):
+                try:
+                    stat = path.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_atime, stat.st_size, path))
+                total += stat.st_size
+
+            entries.sort()
+            for _, size, path in entries:
+                if total <= self.max_bytes:
+                    break
+                try:
+                    path.unlink()
+                except FileNotFoundError:
+                    pass
+                total -= size
+
+def get_transcode_cache(app: Flask) -> TranscodeCache:
+    """
+    Get the transcode cache for an application, creating it on first use.
+
+    Args:
+        app (Flask): The Flask application
+
+    Returns:
+        TranscodeCache: The transcode cache
+    """
+    cache = app.extensions.get('randomfile_transcodes')
+    if cache is None:
+        cache = TranscodeCache(app.config['TRANSCODE_CACHE_PATH'], app.config['TRANSCODE_CACHE_MAX_BYTES'])
+        app.extensions['randomfile_transcodes'] = cache
+    return cache
@@ -0,0 +1,423 @@
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import closing, contextmanager
+from pathlib import Path
+from typing import Any, BinaryIO, Dict, Iterator, Optional, Tuple
+
+from flask import Flask
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS uploads (
+    id TEXT PRIMARY KEY,
+    directory TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    received INTEGER NOT NULL DEFAULT 0,
+    sha256 TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+)
+"""
+
+# Bytes read from the request at a time
+_READ_SIZE = 64 * 1024
+
+class UploadError(Exception):
+    """Exception raised when an upload request cannot be accepted."""
+
+    def __init__(self, message: str, status: int = 400):
+        super().__init__(message)
+        self.status = status
+
+class UploadStore:
+    """
+    Resumable uploads written in chunks.
+
+    Each upload is assembled in a hidden ``.part`` file next to its
+    destination, so the final rename is atomic. Chunks must arrive in order;
+    a client that lost its connection asks for the received offset and
+    continues from there. The content hash is computed while the chunks are
+    written, with the hash state kept by the process that received the last
+    chunk. If a chunk arrives at another worker, the file is hashed again
+    when it completes.
+    """
+
+    def __init__(self, db_path: Path, max_bytes: int, chunk_size: int, expiry: float = 24 * 3600):
+        """
+        Args:
+            db_path (Path): Location of the SQLite database tracking uploads
+            max_bytes (int): Largest file that can be uploaded
+            chunk_size (int): Largest chunk accepted in one request
+            expiry (float): Seconds after which an idle upload is discarded
+        """
+        self.db_path = Path(db_path)
+        self.max_bytes = max_bytes
+        self.chunk_size = chunk_size
+        self.expiry = expiry
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        with closing(self._connect()) as conn, conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(_SCHEMA)
+        # Upload id -> (offset, running hash) for uploads this process received chunks of
+        self._hashes: "OrderedDict[str, Any]" = OrderedDict()
+        self._hashes_lock = threading.Lock()
+        self._sweeper: Optional[threading.Thread] = None
+
+    def _connect(self) -> sqlite3.Connection:
+        """Open a connection to the upload database."""
+        conn = sqlite3.connect(str(self.db_path), timeout=30)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    @staticmethod
+    def part_path(upload: Dict[str, Any]) -> Path:
+        """Get the file an upload is assembled in."""
+        return Path(upload['directory']) / f".{upload['id']}.upload.part"
+
+    def create(self, directory: Path, filename: str, size: int, sha256: Optional[str] = None) -> Dict[str, Any]:
+        """
+        Start an upload.
+
+        Args:
+            directory (Path): Directory the file is saved to
+            filename (str): Name of the file, already sanitized
+            size (int): Size of the file in bytes
+            sha256 (Optional[str]): Expected SHA-256 of the file, checked once it is complete
+
+        Returns:
+            Dict[str, Any]: The upload
+
+        Raises:
+            UploadError: If the file is too large or already exists
+        """
+        if size < 0 or size > self.max_bytes:
+            raise UploadError(f"File size must be between 0 and {self.max_bytes} bytes", 413)
+        if (directory / filename).exists():
+            raise UploadError("A file with that name already exists", 409)
+
+        self.expire()
+        now = time.time()
+        upload_id = uuid.uuid4().hex
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                "INSERT INTO uploads (id, directory, filename, size, sha256, created_at, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (upload_id, str(directory), filename, size, sha256.lower() if sha256 else None, now, now)
+            )
+        upload = self.get(upload_id)
+        self.part_path(upload).touch()
+        return upload
+
+    def get(self, upload_id: str) -> Optional[Dict[str, Any]]:
+        """
+        Get the state of an upload.
+
+        Args:
+            upload_id (str): The upload id
+
+        Returns:
+            Optional[Dict[str, Any]]: The upload, or None if it does not exist
+        """
+        with closing(self._connect()) as conn:
+            row = conn.execute("SELECT * FROM uploads WHERE id = ?", (upload_id,)).fetchone()
+        return dict(row) if row is not None else None
+
+    def _forget(self, upload: Dict[str, Any]) -> None:
+        """Delete an upload and its partial file."""
+        with closing(self._connect()) as conn, conn:
+            conn.execute("DELETE FROM uploads WHERE id = ?", (upload['id'],))
+        with self._hashes_lock:
+            self._hashes.pop(upload['id'], None)
+        try:
+            self.part_path(upload).unlink()
+        except FileNotFoundError:
+            pass
+
+    def cancel(self, upload_id: str) -> bool:
+        """
+        Abandon an upload.
+
+        Args:
+            upload_id (str): The upload id
+
+        Returns:
+            bool: False if the upload does not exist
+        """
+        upload = self.get(upload_id)
+        if upload is None:
+            return False
+        self._forget(upload)
+        return True
+
+    def expire(self) -> None:
+        """Discard uploads that have been idle for longer than the expiry."""
+        with closing(self._connect()) as conn:
+            rows = conn.execute("SELECT * FROM uploads WHERE updated_at < ?", (time.time() - self.expiry,)).fetchall()
+        for row in rows:
+            self._forget(dict(row))
+
+    def start_sweeper(self, interval: float = 3600) -> None:
+        """
+        Discard expired uploads periodically in a background thread.
+
+        Uploads are otherwise only expired when a new one starts, so the
+        partial files of abandoned uploads would stay until then.
+
+        Args:
+            interval (float): Seconds between sweeps
+        """
+        if self._sweeper is None or not self._sweeper.is_alive():
+            self._sweeper = threading.Thread(target=self._sweep, args=(interval,), name="upload-sweeper", daemon=True)
+            self._sweeper.start()
+
+    def _sweep(self, interval: float) -> None:
+        """Expire uploads every interval seconds."""
+        while True:
+            try:
+                self.expire()
+            except Exception:
+                logger.exception("Error expiring uploads")
+            time.sleep(interval)
+
+    @contextmanager
+    def _locked(self, part_path: Path) -> Iterator[BinaryIO]:
+        """Open a partial file for writing, excluding other writers of the same upload."""
+        with open(part_path, 'r+b') as part:
+            if fcntl:
+                fcntl.flock(part, fcntl.LOCK_EX)
+            yield part
+
+    def write_chunk(self, upload_id: str, offset: int, stream: BinaryIO, length: int,
+                    checksum: Optional[str] = None) -> Dict[str, Any]:
+        """
+        Append a chunk to an upload.
+
+        Args:
+            upload_id (str): The upload id
+            offset (int): Position of the chunk in the file, which must equal the bytes received so far
+            stream (BinaryIO): The chunk's data
+            length (int): Size of the chunk in bytes
+            checksum (Optional[str]): Expected SHA-256 of the chunk in hex
+
+        Returns:
+            Dict[str, Any]: The upload; once it is complete, 'complete' is set along with
+                'sha256', the file's hash, and it is ready for finish()
+
+        Raises:
+            UploadError: If the upload does not exist, the offset is wrong, the chunk
+                is too large or incomplete, or a checksum does not match
+        """
+        upload = self.get(upload_id)
+        if upload is None:
+            raise UploadError("Upload not found", 404)
+        if length > self.chunk_size:
+            raise UploadError(f"Chunks may be at most {self.chunk_size} bytes", 413)
+
+        part_path = self.part_path(upload)
+        with self._locked(part_path) as part:
+            # Re-read under the lock in case another worker just wrote a chunk
+            upload = self.get(upload_id)
+            if upload is None:
+                raise UploadError("Upload not found", 404)
+            if offset != upload['received']:
+                raise UploadError(f"Expected offset {upload['received']}", 409)
+            if offset + length > upload['size']:
+                raise UploadError("Chunk extends past the end of the file", 413)
+
+            with self._hashes_lock:
+                cached = self._hashes.pop(upload_id, None)
+            file_hash = cached[1] if cached is not None and cached[0] == offset else None
+            if file_hash is None and offset == 0:
+                file_hash = hashlib.sha256()
+            chunk_hash = hashlib.sha256()
+
+            part.seek(offset)
+            remaining = length
+            while remaining:
+                data = stream.read(min(_READ_SIZE, remaining))
+                if not data:
+                    raise UploadError("Chunk ended early", 400)
+                part.write(data)
+                chunk_hash.update(data)
+                if file_hash is not None:
+                    file_hash.update(data)
+                remaining -= len(data)
+
+            if checksum and chunk_hash.hexdigest() != checksum.lower():
+                # The received offset is unchanged, so the client simply sends the chunk again
+                raise UploadError("Chunk checksum does not match", 422)
+
+            part.flush()
+            received = offset + length
+            with closing(self._connect()) as conn, conn:
+                conn.execute(
+                    "UPDATE uploads SET received = ?, updated_at = ? WHERE id = ?",
+                    (received, time.time(), upload_id)
+                )
+            upload['received'] = received
+
+            if received < upload['size']:
+                if file_hash is not None:
+                    with self._hashes_lock:
+                        self._hashes[upload_id] = (received, file_hash)
+                        while len(self._hashes) > 64:
+                            self._hashes.popitem(last=False)
+                return upload
+
+            part.truncate(received)
+            os.fsync(part.fileno())
+
+        return self._complete(upload, file_hash)
+
+    def _complete(self, upload: Dict[str, Any], file_hash: Any) -> Dict[str, Any]:
+        """Check the hash of a fully received upload."""
+        part_path = self.part_path(upload)
+        if file_hash is None:
+            file_hash = hashlib.sha256()
+            with open(part_path, 'rb') as part:
+                for data in iter(lambda: part.read(1024 * 1024), b''):
+                    file_hash.update(data)
+        digest = file_hash.hexdigest()
+
+        if upload['sha256'] and digest != upload['sha256']:
+            self._forget(upload)
+            raise UploadError("File checksum does not match, the upload was discarded", 422)
+
+        upload['sha256'] = digest
+        upload['complete'] = True
+        return upload
+
+    def finish(self, upload: Dict[str, Any], source: Optional[Path] = None) -> bool:
+        """
+        Move a complete upload to its destination and forget it.
+
+        Args:
+            upload (Dict[str, Any]): An upload returned complete by write_chunk
+            source (Optional[Path]): A file with identical content to link to instead
+
+        Returns:
+            bool: True if the destination was linked to the source
+
+        Raises:
+            UploadError: If the destination already exists
+        """
+        try:
+            return publish(self.part_path(upload), Path(upload['directory']) / upload['filename'], source)
+        finally:
+            self._forget(upload)
+
+def link_file(source: Path, destination: Path) -> bool:
+    """
+    Atomically hard link a file into place without replacing an existing file.
+
+    Args:
+        source (Path): The file to link to
+        destination (Path): The new name
+
+    Returns:
+        bool: False if the filesystem cannot link the two, e.g. across devices
+
+    Raises:
+        UploadError: If the destination already exists
+    """
+    try:
+        os.link(source, destination)
+    except FileExistsError:
+        raise UploadError("A file with that name already exists", 409)
+    except OSError:
+        return False
+    return True
+
+def publish(part_path: Path, destination: Path, source: Optional[Path] = None) -> bool:
+    """
+    Atomically move a received file into place without replacing an existing one.
+
+    The file is linked to its new name, which fails if the name is taken,
+    and its temporary name removed. Only on filesystems without hard links
+    is it renamed instead, after checking the name is free.
+
+    Args:
+        part_path (Path): The received file
+        destination (Path): Where it belongs
+        source (Optional[Path]): A file with identical content; if given, the destination
+            is linked to it where possible and the received file is discarded
+
+    Returns:
+        bool: True if the destination was linked to the source
+
+    Raises:
+        UploadError: If the destination already exists
+    """
+    if source is not None and link_file(source, destination):
+        part_path.unlink()
+        return True
+    if not link_file(part_path, destination):
+        if destination.exists():
+            raise UploadError("A file with that name already exists", 409)
+        os.replace(part_path, destination)
+        return False
+    part_path.unlink()
+    return False
+
+def receive_stream(stream: BinaryIO, directory: Path, max_bytes: int) -> Tuple[Path, int, str]:
+    """
+    Save a stream to a temporary file in a directory, hashing it on the way.
+
+    Args:
+        stream (BinaryIO): The data to save
+        directory (Path): The directory the file will be published in
+        max_bytes (int): Largest size accepted
+
+    Returns:
+        Tuple[Path, int, str]: The temporary file, its size and its SHA-256 in hex
+
+    Raises:
+        UploadError: If the stream is too large
+    """
+    part_path = directory / f".{uuid.uuid4().hex}.upload.part"
+    file_hash = hashlib.sha256()
+    size = 0
+    try:
+        with open(part_path, 'xb') as part:
+            for data in iter(lambda: stream.read(_READ_SIZE), b''):
+                size += len(data)
+                if size > max_bytes:
+                    raise UploadError(f"Files may be at most {max_bytes} bytes", 413)
+                part.write(data)
+                file_hash.update(data)
+            part.flush()
+            os.fsync(part.fileno())
+    except BaseException:
+        part_path.unlink(missing_ok=True)
+        raise
+    return part_path, size, file_hash.hexdigest()
+
+def get_upload_store(app: Flask) -> UploadStore:
+    """
+    Get the upload store for an application, creating it on first use.
+
+    Args:
+        app (Flask): The Flask application
+
+    Returns:
+        UploadStore: The upload store
+    """
+    store = app.extensions.get('randomfile_uploads')
+    if store is None:
+        store = UploadStore(app.config['UPLOAD_DB_PATH'], app.config['UPLOAD_MAX_BYTES'],
+                            app.config['UPLOAD_CHUNK_SIZE'])
+        app.extensions['randomfile_uploads'] = store
+    return store
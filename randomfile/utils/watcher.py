@@ -0,0 +1,281 @@
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import struct
+import sys
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from randomfile.utils.library_index import CREATED, DELETED, LibraryIndex
+from randomfile.utils.metrics import FS_ENTRIES, FS_SCANS
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# Seconds to poll for after inotify fails before trying it again
+INOTIFY_RETRY_SECONDS = 300
+
+# inotify event flags (see inotify(7))
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+_WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_ONLYDIR
+_EVENT_HEADER = struct.Struct('iIII')
+
+class _Inotify:
+    """Minimal ctypes binding for Linux inotify."""
+
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self._libc = libc
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+
+    def add_watch(self, path: str) -> int:
+        """Watch a directory, returning the watch descriptor or -1 on failure."""
+        return self._libc.inotify_add_watch(self.fd, os.fsencode(path), _WATCH_MASK)
+
+    def read(self, timeout: float) -> List[Tuple[int, int, str]]:
+        """
+        Wait for events.
+
+        Args:
+            timeout (float): Seconds to wait
+
+        Returns:
+            List[Tuple[int, int, str]]: (watch descriptor, mask, name) for each event
+        """
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+
+        events = []
+        offset = 0
+        while offset + _EVENT_HEADER.size <= len(data):
+            wd, mask, _, length = _EVENT_HEADER.unpack_from(data, offset)
+            offset += _EVENT_HEADER.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+            events.append((wd, mask, name))
+        return events
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+class LibraryWatcher:
+    """
+    Keeps the library index up to date as files change on disk.
+
+    Uses inotify where available and otherwise polls directory mtimes,
+    relisting only the directories that changed. Changes are batched for
+    ``debounce`` seconds and applied to the index incrementally. Only one
+    process per host watches at a time; the others wait on a file lock and
+    take over if the watching process exits.
+    """
+
+    def __init__(self, index: LibraryIndex, poll_interval: float = 5.0, debounce: float = 0.5,
+                 on_changes: Optional[Callable[[List[Tuple[str, str]]], Any]] = None):
+        """
+        Args:
+            index (LibraryIndex): The index to update
+            poll_interval (float): Seconds between scans when inotify is unavailable
+            debounce (float): Seconds to collect changes before applying them
+            on_changes (Optional[Callable[[List[Tuple[str, str]]], Any]]): Further work run with each
+                batch of (CREATED or DELETED, relative path) changes once the index has them,
+                e.g. queueing the files for the catalog scanner
+        """
+        self.index = index
+        self.on_changes = on_changes
+        self.poll_interval = poll_interval
+        self.debounce = debounce
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        """Start watching in a background thread."""
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="library-watcher", daemon=True)
+            self._thread.start()
+
+    def stop(self) -> None:
+        """Stop watching."""
+        self._stop.set()
+
+    def _run(self) -> None:
+        """Wait to become the host's watcher, then watch until stopped."""
+        lock_path = f"{self.index.snapshot_path}.watch"
+        self.index.snapshot_path.parent.mkdir(parents=True, exist_ok=True)
+        with open(lock_path, 'w') as lock_file:
+            while fcntl and not self._stop.is_set():
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except OSError:
+                    self._stop.wait(self.poll_interval)
+
+            while not self._stop.is_set():
+                try:
+                    if sys.platform.startswith('linux'):
+                        self._watch_inotify()
+                    else:
+                        self._watch_polling()
+                except Exception:
+                    # Poll for a while if inotify is unavailable (e.g. out of watches), then retry it
+                    logger.exception("Library watcher error, polling for %d seconds", INOTIFY_RETRY_SECONDS)
+                    try:
+                        self._watch_polling(time.monotonic() + INOTIFY_RETRY_SECONDS)
+                    except Exception:
+                        logger.exception("Library watcher error while polling")
+                        self._stop.wait(self.poll_interval)
+
+    def _watch_inotify(self) -> None:
+        """Apply inotify events to the index until stopped."""
+        inotify = _Inotify()
+        watches: Dict[int, str] = {}
+
+        def add_tree(rel_dir: str) -> None:
+            for root, dirs, files in os.walk(self.index.base_path / rel_dir):
+                FS_SCANS.inc(scan='watcher')
+                FS_ENTRIES.inc(len(dirs) + len(files), scan='watcher')
+                wd = inotify.add_watch(root)
+                if wd >= 0:
+                    rel_root = os.path.relpath(root, self.index.base_path)
+                    watches[wd] = '' if rel_root == '.' else rel_root.replace(os.sep, '/')
+
+        try:
+            add_tree('')
+            # Catch anything that changed before the watches were in place
+            self.index.ensure_fresh()
+            if self.index.has_changed():
+                self.index.build()
+
+            pending: List[Tuple[str, str]] = []
+            deadline = None
+            while not self._stop.is_set():
+                timeout = self.poll_interval if deadline is None else max(0.0, deadline - time.monotonic())
+                for wd, mask, name in inotify.read(timeout):
+                    if mask & IN_Q_OVERFLOW:
+                        # Events were lost, so only a full rescan is reliable
+                        pending.clear()
+                        self.index.build()
+                        continue
+                    if mask & IN_IGNORED:
+                        watches.pop(wd, None)
+                        continue
+                    rel_dir = watches.get(wd)
+                    if rel_dir is None or not name:
+                        continue
+
+                    rel_path = f"{rel_dir}/{name}" if rel_dir else name
+                    if mask & (IN_DELETE | IN_MOVED_FROM):
+                        pending.append((DELETED, rel_path))
+                    elif mask & (IN_CREATE | IN_MOVED_TO | IN_CLOSE_WRITE):
+                        if mask & IN_ISDIR:
+                            add_tree(rel_path)
+                        pending.append((CREATED, rel_path))
+
+                if pending and deadline is None:
+                    deadline = time.monotonic() + self.debounce
+                if deadline is not None and time.monotonic() >= deadline:
+                    self._apply(pending)
+                    pending = []
+                    deadline = None
+        finally:
+            inotify.close()
+
+    def _watch_polling(self, until: Optional[float] = None) -> None:
+        """
+        Poll directory mtimes and apply the differences.
+
+        Args:
+            until (Optional[float]): time.monotonic() value to stop polling at (default: poll until stopped)
+        """
+        while not self._stop.wait(self.poll_interval):
+            if until is not None and time.monotonic() >= until:
+                return
+            snapshot = self.index.snapshot
+            changes: List[Tuple[str, str]] = []
+            refreshed: List[str] = []
+
+            for d in range(snapshot.n_dirs):
+                rel_dir = snapshot.dir_path(d)
+                directory = self.index.base_path / rel_dir
+                try:
+                    if os.stat(directory).st_mtime_ns == snapshot.dir_mtimes[d]:
+                        continue
+                    with os.scandir(directory) as it:
+                        entries = {entry.name: entry.is_dir(follow_symlinks=False) for entry in it}
+                except OSError:
+                    # The parent directory's listing reports the deletion
+                    continue
+                FS_SCANS.inc(scan='watcher')
+                FS_ENTRIES.inc(len(entries), scan='watcher')
+
+                prefix = f"{rel_dir}/" if rel_dir else ""
+                known_dirs = {snapshot.dir_path(child)[len(prefix):] for child in snapshot.child_dirs(d)}
+                known_files = {
+                    snapshot.file(i)[len(prefix):]
+                    for i in range(snapshot.dir_starts[d], snapshot.dir_files_end[d])
+                }
+                for name in (known_dirs | known_files) - set(entries):
+                    changes.append((DELETED, prefix + name))
+                for name, is_dir in entries.items():
+                    if (is_dir and name not in known_dirs) or (not is_dir and name not in known_files):
+                        changes.append((CREATED, prefix + name))
+                refreshed.append(rel_dir)
+
+            if changes or refreshed:
+                self._apply(changes, refreshed)
+
+    def _apply(self, changes: List[Tuple[str, str]], refreshed_dirs: List[str] = ()) -> None:
+        """Apply changes to the index and pass them on."""
+        self.index.apply_changes(changes, refreshed_dirs)
+        if changes and self.on_changes is not None:
+            self.on_changes(changes)
+
+# One watcher per library index in this process
+_watchers: Dict[int, LibraryWatcher] = {}
+
+def start_watcher(index: LibraryIndex, poll_interval: float = 5.0,
+                  on_changes: Optional[Callable[[List[Tuple[str, str]]], Any]] = None) -> LibraryWatcher:
+    """
+    Start watching a library index, unless this process already does.
+
+    Args:
+        index (LibraryIndex): The index to keep up to date
+        poll_interval (float): Seconds between scans when inotify is unavailable
+        on_changes (Optional[Callable[[List[Tuple[str, str]]], Any]]): Further work run with each batch of changes
+
+    Returns:
+        LibraryWatcher: The watcher
+    """
+    watcher = _watchers.get(id(index))
+    if watcher is None:
+        watcher = LibraryWatcher(index, poll_interval, on_changes=on_changes)
+        _watchers[id(index)] = watcher
+    watcher.start()
+    return watcher
@@ -40,27 +40,389 @@ function showMoveModal(filePath) {
     moveModal.show();
 }
 
+// Build a tree item element for a node returned by the tree API
+function createTreeItem(node) {
+    const item = document.createElement('li');
+    item.className = 'tree-item';
+
+    const content = document.createElement('div');
+    content.className = 'tree-item-content';
+    content.setAttribute('data-path', node.path);
+    content.setAttribute('data-type', node.type);
+
+    const toggle = document.createElement('span');
+    toggle.className = 'tree-toggle';
+    const icon = document.createElement('i');
+    if (node.type === 'directory') {
+        toggle.textContent = node.has_children ? '+' : '\u00a0';
+        icon.className = 'bi tree-icon folder-icon ' + (node.has_children ? 'bi-folder-fill' : 'bi-folder');
+    } else {
+        toggle.textContent = '\u00a0';
+        icon.className = 'bi bi-file-music-fill tree-icon file-icon';
+    }
+
+    const label = document.createElement('span');
+    label.className = 'tree-label';
+    label.textContent = node.name;
+
+    content.append(toggle, icon, label);
+    item.appendChild(content);
+
+    if (node.type === 'directory' && node.has_children) {
+        const children = document.createElement('ul');
+        children.className = 'tree-children';
+        children.setAttribute('data-lazy', 'true');
+        item.appendChild(children);
+    }
+    return item;
+}
+
+// Encode a library path for a URL, one segment at a time so names with '#', '?' or '%' survive
+function encodePath(path) {
+    return path.replace(/\\/g, '/').split('/').map(encodeURIComponent).join('/');
+}
+
+// Fetch the children of a collapsed directory from the tree API, once even if clicked again while loading
+function loadTreeChildren(tree, path, children) {
+    const url = tree.getAttribute('data-tree-url') + encodePath(path === '.' ? '' : path);
+    children.removeAttribute('data-lazy');
+    children.setAttribute('data-loading', 'true');
+    return fetch(url)
+        .then(response => response.json())
+        .then(data => {
+            (data.children || []).forEach(child => children.appendChild(createTreeItem(child)));
+        })
+        .catch(error => {
+            // Let the next click try again
+            children.setAttribute('data-lazy', 'true');
+            throw error;
+        })
+        .finally(() => children.removeAttribute('data-loading'));
+}
+
+// Build a file list item for an entry returned by the listing API
+function createFileItem(list, entry) {
+    const item = document.createElement('li');
+    item.className = 'list-group-item';
+
+    const header = document.createElement('div');
+    header.className = 'd-flex justify-content-between align-items-center mb-2';
+    const name = document.createElement('span');
+    name.textContent = entry.name;
+
+    const actions = document.createElement('div');
+    actions.className = 'file-actions';
+    const deleteButton = document.createElement('button');
+    deleteButton.className = 'btn btn-sm btn-danger';
+    deleteButton.textContent = 'Delete';
+    deleteButton.addEventListener('click', () => confirmDelete(entry.path));
+    const moveButton = document.createElement('button');
+    moveButton.className = 'btn btn-sm btn-warning';
+    moveButton.textContent = 'Move';
+    moveButton.addEventListener('click', () => showMoveModal(entry.path));
+    actions.append(deleteButton, ' ', moveButton);
+    header.append(name, actions);
+
+    const audio = document.createElement('audio');
+    audio.controls = true;
+    audio.preload = 'none';
+    audio.className = 'w-100';
+    audio.src = list.getAttribute('data-audio-url') + '/' + encodePath(entry.path) + '?static=true';
+
+    item.append(header, audio);
+    return item;
+}
+
+// Fetch the next page of the file list, or the first page when reset is set
+function loadFilePage(list, reset) {
+    const cursor = list.getAttribute('data-next-cursor');
+    if (!reset && (list.dataset.loading || !cursor)) {
+        return Promise.resolve();
+    }
+    const [sort, order] = document.getElementById('fileSort').value.split(':');
+    const params = new URLSearchParams({
+        type: 'file',
+        sort: sort,
+        order: order,
+        prefix: document.getElementById('fileFilter').value
+    });
+    if (!reset) {
+        params.set('cursor', cursor);
+    }
+
+    // A newer request (e.g. a changed filter) supersedes any page still loading
+    const request = (list.latestRequest || 0) + 1;
+    list.latestRequest = request;
+    list.dataset.loading = 'true';
+    return fetch(list.getAttribute('data-list-url') + '?' + params)
+        .then(response => response.json())
+        .then(data => {
+            if (list.latestRequest !== request) {
+                return;
+            }
+            if (reset) {
+                list.innerHTML = '';
+            }
+            (data.entries || []).forEach(entry => list.appendChild(createFileItem(list, entry)));
+            if (!list.children.length) {
+                const empty = document.createElement('li');
+                empty.className = 'list-group-item';
+                empty.textContent = 'No files found';
+                list.appendChild(empty);
+            }
+            list.setAttribute('data-next-cursor', data.next_cursor || '');
+        })
+        .finally(() => {
+            if (list.latestRequest === request) {
+                delete list.dataset.loading;
+            }
+        });
+}
+
+// Random player: keeps a queue of picks from the batch API and buffers the next track
+function setupRandomPlayer(player) {
+    const audio = player.querySelector('audio');
+    const title = player.querySelector('.random-title');
+    const queue = [];
+    let refilling = null;
+    let buffered = null;
+
+    // Start downloading the next track so it is in the browser cache when needed
+    function bufferNext() {
+        if (queue.length && buffered !== queue[0]) {
+            buffered = queue[0];
+            const preload = new Audio();
+            preload.preload = 'auto';
+            preload.src = buffered.url;
+        }
+    }
+
+    // Fetch another batch once the queue runs low
+    function refill() {
+        if (refilling || queue.length >= 3) {
+            return refilling || Promise.resolve();
+        }
+        const url = player.getAttribute('data-random-url') + '?count=10&no_repeat=true';
+        refilling = fetch(url)
+            .then(response => response.json())
+            .then(data => {
+                queue.push(...(data.files || []));
+                bufferNext();
+            })
+            .finally(() => {
+                refilling = null;
+            });
+        return refilling;
+    }
+
+    function playNext() {
+        const ready = queue.length ? Promise.resolve() : refill();
+        return ready.then(() => {
+            const track = queue.shift();
+            if (!track) {
+                title.textContent = 'No audio files found';
+                return;
+            }
+            title.textContent = [track.artist, track.title || track.name].filter(Boolean).join(' - ');
+            audio.src = track.url;
+            audio.play().catch(error => console.error('Error playing audio:', error));
+            bufferNext();
+            refill();
+        });
+    }
+
+    const onError = error => console.error('Error loading random files:', error);
+    player.querySelector('.random-play').addEventListener('click', () => playNext().catch(onError));
+    player.querySelector('.random-skip').addEventListener('click', () => playNext().catch(onError));
+    audio.addEventListener('ended', () => playNext().catch(onError));
+}
+
+// Headers for requests that change state, including the CSRF token when the app uses one
+function requestHeaders(headers) {
+    const token = document.querySelector('meta[name="csrf-token"]');
+    return Object.assign(token ? {'X-CSRFToken': token.content} : {}, headers);
+}
+
+// SHA-256 of a blob in hex, or null where browsers do not offer SubtleCrypto (plain HTTP other than localhost)
+async function sha256Hex(blob) {
+    if (!window.crypto || !crypto.subtle) {
+        return null;
+    }
+    const digest = await crypto.subtle.digest('SHA-256', await blob.arrayBuffer());
+    return Array.from(new Uint8Array(digest), b => b.toString(16).padStart(2, '0')).join('');
+}
+
+// Upload a file in chunks, resuming an interrupted upload of the same file
+async function uploadInChunks(form, file, onProgress) {
+    const subpath = form.querySelector('input[name="subpath"]').value;
+    const key = `upload:${subpath}/${file.name}:${file.size}:${file.lastModified}`;
+    let upload = null;
+
+    const resumeId = localStorage.getItem(key);
+    if (resumeId) {
+        const response = await fetch(`${form.action}/${resumeId}`);
+        if (response.ok) {
+            upload = await response.json();
+        }
+    }
+    if (!upload) {
+        const body = {directory: subpath, filename: file.name, size: file.size};
+        // With the file's hash up front, content already in the library is not sent again
+        if (file.size <= 256 * 1024 * 1024) {
+            body.sha256 = await sha256Hex(file) || undefined;
+        }
+        const response = await fetch(form.action, {
+            method: 'POST',
+            headers: requestHeaders({'Content-Type': 'application/json'}),
+            body: JSON.stringify(body)
+        });
+        upload = await response.json();
+        if (!response.ok) {
+            throw new Error(upload.error);
+        }
+        if (upload.id) {
+            localStorage.setItem(key, upload.id);
+        }
+    }
+
+    let offset = upload.offset;
+    let failures = 0;
+    while (offset < file.size || (file.size === 0 && !upload.path)) {
+        onProgress(offset / file.size);
+        const chunk = file.slice(offset, offset + upload.chunk_size);
+        const headers = {'Upload-Offset': String(offset)};
+        const checksum = await sha256Hex(chunk);
+        if (checksum) {
+            headers['X-Chunk-SHA256'] = checksum;
+        }
+
+        let response;
+        try {
+            response = await fetch(`${form.action}/${upload.id}`, {
+                method: 'PUT',
+                headers: requestHeaders(headers),
+                body: chunk
+            });
+        } catch (error) {
+            response = null;
+        }
+
+        if (response && response.headers.has('Upload-Offset') && (response.ok || response.status === 409)) {
+            // 409 means the server has a different offset, e.g. after a lost response; continue from there
+            const data = await response.json();
+            offset = Number(response.headers.get('Upload-Offset'));
+            if (response.ok) {
+                upload = Object.assign(upload, data);
+            }
+            failures = 0;
+            continue;
+        }
+        if (response && response.status !== 422 && response.status < 500) {
+            localStorage.removeItem(key);
+            throw new Error((await response.json()).error);
+        }
+        // Connection lost, server error or corrupted chunk: wait and send it again
+        if (++failures > 5) {
+            throw new Error('Upload interrupted, select the file again to resume');
+        }
+        await new Promise(resolve => setTimeout(resolve, 1000 * 2 ** failures));
+    }
+
+    localStorage.removeItem(key);
+    onProgress(1);
+    return upload;
+}
+
+function setupUploadForm(form) {
+    const progress = document.getElementById('uploadProgress');
+    const bar = progress.querySelector('.progress-bar');
+    const errorText = document.getElementById('uploadError');
+
+    form.addEventListener('submit', function (e) {
+        const file = form.querySelector('input[type="file"]').files[0];
+        if (!file || !window.fetch) {
+            return;
+        }
+        e.preventDefault();
+        const submit = form.querySelector('button[type="submit"]');
+        submit.disabled = true;
+        errorText.textContent = '';
+        progress.classList.remove('d-none');
+
+        uploadInChunks(form, file, fraction => {
+            bar.style.width = `${Math.round(fraction * 100)}%`;
+        })
+            .then(() => window.location.reload())
+            .catch(error => {
+                errorText.textContent = `Error uploading file: ${error.message}`;
+                submit.disabled = false;
+            });
+    });
+}
+
 // Tree view functionality
 document.addEventListener('DOMContentLoaded', function () {
-    // Handle tree item clicks
-    document.querySelectorAll('.tree-item-content').forEach(item => {
-        item.addEventListener('click', function (e) {
-            const path = this.getAttribute('data-path');
-            const type = this.getAttribute('data-type');
-            const toggle = this.querySelector('.tree-toggle');
+    const tree = document.getElementById('directoryTree');
+
+    // Handle tree item clicks, including items added after page load
+    if (tree) {
+        tree.addEventListener('click', function (e) {
+            const item = e.target.closest('.tree-item-content');
+            if (!item) {
+                return;
+            }
+            const path = item.getAttribute('data-path');
+            const type = item.getAttribute('data-type');
+            const toggle = item.querySelector('.tree-toggle');
 
             // If clicking on the toggle button or if it's a directory
             if (e.target === toggle || (type === 'directory' && toggle.textContent === '+' || toggle.textContent === '-')) {
                 // Toggle the children's visibility
-                const children = this.nextElementSibling;
-                if (children && children.classList.contains('tree-children')) {
+                const children = item.nextElementSibling;
+                if (children && children.classList.contains('tree-children') && !children.hasAttribute('data-loading')) {
+                    if (children.hasAttribute('data-lazy')) {
+                        loadTreeChildren(tree, path, children)
+                            .catch(error => console.error('Error loading directory:', error));
+                    }
                     children.classList.toggle('show');
                     toggle.textContent = children.classList.contains('show') ? '-' : '+';
                 }
                 e.stopPropagation(); // Prevent navigation
             }
         });
-    });
+    }
+
+    // Load large directories page by page as the end of the file list comes into view
+    const fileList = document.getElementById('fileList');
+    const more = document.getElementById('fileListMore');
+    if (fileList && more) {
+        const loadMore = () => loadFilePage(fileList, false)
+            .catch(error => console.error('Error loading files:', error));
+        new IntersectionObserver(entries => {
+            if (entries.some(entry => entry.isIntersecting)) {
+                loadMore();
+            }
+        }, {rootMargin: '400px'}).observe(more);
+
+        const reload = () => loadFilePage(fileList, true)
+            .catch(error => console.error('Error loading files:', error));
+        let filterTimer;
+        document.getElementById('fileFilter').addEventListener('input', function () {
+            clearTimeout(filterTimer);
+            filterTimer = setTimeout(reload, 250);
+        });
+        document.getElementById('fileSort').addEventListener('change', reload);
+    }
+
+    const randomPlayer = document.getElementById('randomPlayer');
+    if (randomPlayer) {
+        setupRandomPlayer(randomPlayer);
+    }
+
+    const uploadForm = document.getElementById('uploadForm');
+    if (uploadForm) {
+        setupUploadForm(uploadForm);
+    }
 
     // Auto-dismiss flash messages after 5 seconds
     setTimeout(function () {